@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+# kate: space-indent on; tab-indent off;
+
+""" @package docstring
+Async IMAP
+
+An asyncio based IMAP transport, with tagged command multiplexing, TLS and
+literal handling, plus an AsyncImapUtil counterpart of ImapUtil built on top
+of it, to sync many accounts concurrently from a single process.
+
+Responses are returned in the same format used by imaplib, so the parsing
+helpers in ImapUtil can be shared.
+
+@author Gabriele Tozzi <gabriele@tozzi.eu>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import re
+import ssl
+import asyncio
+import collections
+
+from imaputil import ImapUtil
+
+
+class AsyncImapError(Exception):
+    """ Raised when the connection is lost or the server says BYE """
+    pass
+
+
+class AsyncImapConnection:
+    """ A single IMAP connection
+
+        Many commands may be in flight at the same time: every command gets
+        its own tag and its own future, resolved by a background reader task.
+        Untagged responses received while a command is pending are handed to
+        that command.
+    """
+
+    UNTAGGED_STATUS_RE = re.compile(rb'^\* (?P<num>\d+) (?P<type>[A-Z-]+)( (?P<data>.*))?$', re.I)
+    UNTAGGED_RE = re.compile(rb'^\* (?P<type>[A-Z-]+)( (?P<data>.*))?$', re.I)
+    RESPONSE_CODE_RE = re.compile(rb'^\[(?P<type>[A-Z-]+)( (?P<data>[^\]]*))?\]', re.I)
+    TAGGED_RE = re.compile(rb'^(?P<tag>[A-Za-z0-9]+) (?P<type>[A-Z]+)( (?P<data>.*))?$', re.I)
+
+    # Max length of a response line, i.e. a SEARCH result
+    LINE_LIMIT = 16 * 1024 * 1024
+
+    def __init__(self, host, port=143, usessl=None, timeout=None):
+        """
+            @param usessl: use TLS, defaults to True for port 993
+            @param timeout: connect timeout, in seconds
+        """
+        self.host = host
+        self.port = port
+        self.usessl = port == 993 if usessl is None else usessl
+        self.timeout = timeout
+        self.welcome = None
+        self.capabilities = ()
+        self.tagnum = 0
+        self.pending = {}
+        self.continuation = None
+        self.writeLock = asyncio.Lock()
+        self.readerTask = None
+        self.error = None
+        self.loggingOut = False
+
+    async def open(self):
+        """ Connects and reads the greeting """
+        context = None
+        if self.usessl:
+            # Same (non verifying) context used by imaplib.IMAP4_SSL
+            context = ssl.create_default_context()
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port, ssl=context, limit=self.LINE_LIMIT), self.timeout)
+        self.welcome = (await self.reader.readline()).rstrip(b'\r\n')
+        if not self.welcome.startswith((b'* OK', b'* PREAUTH')):
+            raise AsyncImapError('Unexpected greeting: {}'.format(self.welcome))
+        self.readerTask = asyncio.ensure_future(self.readLoop())
+
+    def newTag(self):
+        self.tagnum += 1
+        return b'A%d' % self.tagnum
+
+    async def readParts(self):
+        """
+            Reads a full response, including its literals
+
+            @return list of parts: text lines, each one ending with a {size}
+                    marker followed by the literal itself, and a final line
+        """
+        parts = []
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                raise AsyncImapError('socket error: EOF')
+            line = line.rstrip(b'\r\n')
+            m = ImapUtil.LITERAL_RE.search(line)
+            parts.append(line)
+            if not m:
+                return parts
+            parts.append(await self.reader.readexactly(int(m.group('size'))))
+
+    def untaggedData(self, parts):
+        """ @return (type, data) of an untagged response, data in imaplib format """
+        m = self.UNTAGGED_STATUS_RE.match(parts[0])
+        if m:
+            head = m.group('num') + (b' ' + m.group('data') if m.group('data') else b'')
+        else:
+            m = self.UNTAGGED_RE.match(parts[0])
+            if not m:
+                raise AsyncImapError('Unexpected response: {}'.format(parts[0]))
+            head = m.group('data') or b''
+        typ = m.group('type').decode().upper()
+        data = []
+        parts = [head] + parts[1:]
+        for i in range(0, len(parts) - 1, 2):
+            data.append((parts[i], parts[i+1]))
+        data.append(parts[-1])
+        return typ, data
+
+    def dispatchUntagged(self, typ, data):
+        responses = [ (typ, d) for d in data ]
+        if typ in ('OK', 'NO', 'BAD') and data and isinstance(data[0], bytes):
+            m = self.RESPONSE_CODE_RE.match(data[0])
+            if m:
+                responses.append((m.group('type').decode().upper(), m.group('data')))
+        for fut, untagged in self.pending.values():
+            untagged.extend(responses)
+
+    async def readLoop(self):
+        try:
+            while True:
+                parts = await self.readParts()
+                if parts[0].startswith(b'+'):
+                    if self.continuation:
+                        tag, fut = self.continuation
+                        self.continuation = None
+                        if not fut.done():
+                            fut.set_result(parts[0][1:].strip())
+                    continue
+                if parts[0].startswith(b'* '):
+                    typ, data = self.untaggedData(parts)
+                    if typ == 'BYE' and not self.loggingOut:
+                        self.error = AsyncImapError('BYE: {}'.format(data[-1]))
+                    self.dispatchUntagged(typ, data)
+                    continue
+                m = self.TAGGED_RE.match(parts[0])
+                if not m or m.group('tag') not in self.pending:
+                    raise AsyncImapError('Unexpected response: {}'.format(parts[0]))
+                tag = m.group('tag')
+                if self.continuation and self.continuation[0] == tag:
+                    # Command rejected before sending its literal
+                    self.continuation[1].set_exception(AsyncImapError(parts[0].decode(errors='replace')))
+                    self.continuation = None
+                fut, untagged = self.pending.pop(tag)
+                if not fut.done():
+                    fut.set_result((m.group('type').decode().upper(), m.group('data') or b'', untagged))
+        except (AsyncImapError, ConnectionError, asyncio.IncompleteReadError, OSError, ValueError) as e:
+            self.error = self.error or AsyncImapError(str(e))
+        except asyncio.CancelledError:
+            self.error = self.error or AsyncImapError('Connection closed')
+        for fut, untagged in self.pending.values():
+            if not fut.done():
+                fut.set_exception(self.error)
+        self.pending = {}
+        if self.continuation and not self.continuation[1].done():
+            self.continuation[1].set_exception(self.error)
+
+    async def command(self, *parts):
+        """
+            Sends a command and waits for its completion
+
+            @param parts: alternating text and literals: bytes text parts
+                   are sent as they are, bytes literals are sent as
+                   synchronizing (or LITERAL+) literals
+            @return tuple (type, text, untagged), untagged is a list of
+                    (type, data) tuples
+        """
+        if self.error:
+            raise self.error
+        tag = self.newTag()
+        fut = asyncio.get_event_loop().create_future()
+        self.pending[tag] = (fut, [])
+        plus = 'LITERAL+' in self.capabilities
+        async with self.writeLock:
+            buf = tag + b' ' + parts[0]
+            try:
+                for i in range(1, len(parts), 2):
+                    literal = parts[i]
+                    if plus:
+                        buf += b' {%d+}\r\n' % len(literal)
+                    else:
+                        buf += b' {%d}\r\n' % len(literal)
+                        cont = asyncio.get_event_loop().create_future()
+                        self.continuation = (tag, cont)
+                        self.writer.write(buf)
+                        await self.writer.drain()
+                        await cont
+                        buf = b''
+                    buf += literal
+                    if i + 1 < len(parts):
+                        buf += parts[i+1]
+                self.writer.write(buf + b'\r\n')
+                await self.writer.drain()
+            except AsyncImapError:
+                # Rejected literal, the tagged response is already there
+                pass
+        return await fut
+
+    async def simple(self, name, *parts):
+        """
+            imaplib-like command execution
+
+            @param name: command name
+            @return tuple (type, data): data is the list of untagged data
+                    for the command name, or the tagged text when missing
+        """
+        typ, text, untagged = await self.command(*parts)
+        if typ != 'OK':
+            return typ, [text]
+        data = [ d for t, d in untagged if t == name ]
+        return typ, data or [text]
+
+    async def login(self, user, password):
+        typ, data = await self.simple('LOGIN', b'LOGIN ' + self.quote(user) + b' ' + self.quote(password))
+        if typ != 'OK':
+            raise AsyncImapError('Login failed: {}'.format(data[-1]))
+        typ, data = await self.simple('CAPABILITY', b'CAPABILITY')
+        if typ == 'OK':
+            self.capabilities = tuple(data[-1].upper().decode().split())
+        return typ, data
+
+    async def logout(self):
+        self.loggingOut = True
+        try:
+            await self.command(b'LOGOUT')
+        except AsyncImapError:
+            pass
+        await self.close()
+
+    async def close(self):
+        if self.readerTask:
+            self.readerTask.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
+
+    def quote(self, arg):
+        """ @return arg as an IMAP quoted string """
+        if isinstance(arg, str):
+            arg = arg.encode()
+        return b'"' + arg.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+
+
+class ConnectionLimiter:
+    """ Caps the number of connections opened to every server
+
+        All the slots needed by a task are acquired at once, so tasks
+        connecting to more servers can not deadlock each other.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = collections.Counter()
+        self.cond = asyncio.Condition()
+
+    async def acquire(self, keys):
+        """ @param keys: list of server keys, repeated for multiple slots """
+        need = collections.Counter(keys)
+        for k, n in need.items():
+            if n > self.limit:
+                raise ValueError('{} connections needed to {}, limit is {}'.format(n, k, self.limit))
+        async with self.cond:
+            await self.cond.wait_for(lambda: all(self.used[k] + n <= self.limit for k, n in need.items()))
+            self.used.update(need)
+
+    async def release(self, keys):
+        async with self.cond:
+            self.used.subtract(collections.Counter(keys))
+            self.cond.notify_all()
+
+
+class AsyncImapUtil(ImapUtil):
+    """ Async counterpart of ImapUtil """
+
+    async def connect(self, endpoint):
+        """
+            Opens an authenticated connection
+
+            @param endpoint: dict with user, pass, host and port keys
+            @return the AsyncImapConnection
+        """
+        conn = AsyncImapConnection(endpoint['host'], endpoint['port'])
+        await conn.open()
+        try:
+            await conn.login(endpoint['user'], endpoint['pass'])
+        except Exception:
+            await conn.close()
+            raise
+        return conn
+
+    async def listMailboxes(self, conn):
+        """ @return Returns a list of Mailbox objects """
+        (res, data) = await conn.simple('LIST', b'LIST "" *')
+        if res != 'OK':
+            raise RuntimeError('Invalid reply: ' + res)
+        return self.parseMailboxes(conn, data)
+
+    async def createMailbox(self, conn, folder):
+        return await conn.simple('CREATE', b'CREATE ' + self.quoteFolderName(folder))
+
+    async def selectMailbox(self, conn, folder, readonly=False):
+        """
+            Selects a mailbox
+
+            @return tuple (type, info), info is a dict with EXISTS,
+                    UIDVALIDITY and UIDNEXT keys, see getMailboxInfo()
+        """
+        cmd = b'EXAMINE ' if readonly else b'SELECT '
+        typ, text, untagged = await conn.command(cmd + self.quoteFolderName(folder))
+        info = { 'EXISTS': None, 'UIDVALIDITY': None, 'UIDNEXT': None }
+        for t, d in untagged:
+            if t in info and isinstance(d, bytes) and d.split()[:1]:
+                info[t] = int(d.split()[0])
+        return typ, info
+
+    async def listMessages(self, conn):
+        """ @returns a list of message UIDs in the selected mailbox, see ImapUtil.listMessages() """
+        if self.hasCapability(conn, 'ESEARCH'):
+            (res, data) = await conn.simple('ESEARCH', b'UID SEARCH RETURN (ALL) ALL')
+            if res != 'OK':
+                raise RuntimeError('Unvalid reply: ' + res)
+            m = self.ESEARCH_ALL_RE.search(b' '.join(d for d in data if isinstance(d, bytes)))
+            return [ b'%d' % i for i in self.parseUidSet(m.group(1)) ] if m else []
+        (res, data) = await conn.simple('SEARCH', b'UID SEARCH ALL')
+        if res != 'OK':
+            raise RuntimeError('Unvalid reply: ' + res)
+        return b' '.join(d for d in data if isinstance(d, bytes)).split()
+
+    async def fetchBulk(self, conn, ids, items, chunk=None):
+        """ Async version of ImapUtil.fetchBulk() """
+        query = b'(' + ' '.join(items).encode() + b')'
+        res = {}
+        for seqset in self.getSequenceSets(ids, chunk):
+            (typ, data) = await conn.simple('FETCH', b'UID FETCH ' + seqset + b' ' + query)
+            if typ != 'OK':
+                raise RuntimeError('Unvalid reply: ' + typ)
+            for seq, attrs in self.parseFetch(data).items():
+                if b'UID' in attrs:
+                    res[attrs[b'UID']] = attrs
+        return res
+
+    async def getMessageKeys(self, conn, ids, chunk=None):
+        """
+            Fetches message keys, along with flags and arrival dates
+
+            @return tuple (dict UID -> MessageIndex key, dict UID -> size,
+                    dict UID -> (flags, date), see parseMessageMeta())
+        """
+        res = await self.fetchBulk(conn, ids, self.KEY_ITEMS + self.META_ITEMS, chunk)
+        sizes = { i: int(d[b'RFC822.SIZE']) for i, d in res.items() if d.get(b'RFC822.SIZE') }
+        return self.parseMessageKeys(res, ids), sizes, self.parseMessageMeta(res)
+
+    async def fetchMessages(self, conn, ids):
+        """ @return dict UID -> full RFC822 message, missing ones are skipped """
+        res = await self.fetchBulk(conn, ids, ('BODY.PEEK[]', ), len(ids))
+        return { i: self.getSection(d) for i, d in res.items() if self.getSection(d) is not None }
+
+    async def appendMessages(self, conn, mailbox, messages):
+        """
+            Appends many messages, in a single MULTIAPPEND command when
+            supported, or else as concurrent APPEND commands
+
+            @param messages: list of tuples (bytes message, flags, date),
+                   see ImapUtil.appendFiles()
+        """
+        mailbox = self.quoteFolderName(mailbox)
+
+        def header(flags, date):
+            h = b''
+            if flags:
+                h += b' (' + flags + b')'
+            if date:
+                h += b' "' + date + b'"'
+            return h
+
+        if 'MULTIAPPEND' in conn.capabilities and len(messages) > 1:
+            parts = [b'APPEND ' + mailbox]
+            for m, flags, date in messages:
+                parts[-1] += header(flags, date)
+                parts += [m, b'']
+            results = [ await conn.simple('APPEND', *parts) ]
+        else:
+            results = await asyncio.gather(*[ conn.simple('APPEND', b'APPEND ' + mailbox + header(flags, date),
+                    m, b'') for m, flags, date in messages ])
+        for typ, data in results:
+            if typ != 'OK':
+                raise RuntimeError('Unvalid reply: {} {}'.format(typ, data[-1]))
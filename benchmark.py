@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# kate: space-indent on; tab-indent off;
+
+""" @package docstring
+IMAP Copy Benchmark
+
+Measures imapcp and getaddr throughput against local fake IMAP servers, see
+fakeimap.py, so performance can be compared across changes without live mail
+servers.
+
+Every scenario runs the tool in a child process and reports messages/sec,
+bytes/sec, IMAP commands (round trips) per message and the child peak RSS.
+
+Scenarios:
+  - full: first sync into an empty destination
+  - incremental: re-sync after a few new messages arrived in source
+  - date: sync of the last 90 days only into an empty destination
+  - getaddr: address harvest of the whole source account
+  - export: sync of the whole source account into a local Maildir
+  - local: sync between two local Maildirs, with no network at all
+
+@author Gabriele Tozzi <gabriele@tozzi.eu>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import os
+import time
+import json
+import datetime
+import tempfile
+import subprocess
+
+from optparse import OptionParser
+from fakeimap import FakeImapServer
+
+
+class main:
+
+    NAME = 'benchmark'
+    VERSION = '0.1'
+
+    SCENARIOS = ('full', 'incremental', 'date', 'getaddr', 'export', 'local')
+
+    def run(self):
+
+        # Read command line
+        usage = "%prog [options] [-- <extra imapcp options>]"
+        parser = OptionParser(usage=usage, version=self.NAME + ' ' + self.VERSION)
+        parser.add_option("-n", "--messages", dest="messages", type="int", default=2000,
+            help="Number of messages in source account (default: %default)")
+        parser.add_option("-F", "--folders", dest="folders", type="int", default=4,
+            help="Number of source folders, messages are spread among them (default: %default)")
+        parser.add_option("--size", dest="size", type="int", default=4096,
+            help="Approximate message size, in bytes (default: %default)")
+        parser.add_option("-l", "--latency", dest="latency", type="float", default=0.001,
+            help="Per-command latency of both servers, in seconds (default: %default)")
+        parser.add_option("--src-profile", dest="srcprofile", default=FakeImapServer.PROFILE_DOVECOT,
+            help="Source server to impersonate: dovecot, courier or exchange (default: %default)")
+        parser.add_option("--dst-profile", dest="dstprofile", default=FakeImapServer.PROFILE_DOVECOT,
+            help="Destination server to impersonate (default: %default)")
+        parser.add_option("--new", dest="new", type="int", default=20,
+            help="Number of new messages for the incremental scenario (default: %default)")
+        parser.add_option("-S", "--scenario", dest="scenarios", action="append", choices=self.SCENARIOS,
+            help="Only run the given scenario (can be specified multiple times)")
+        parser.add_option("--json", dest="json",
+            help="Also write results to this JSON file")
+
+        (options, args) = parser.parse_args()
+        scenarios = options.scenarios or self.SCENARIOS
+
+        here = os.path.dirname(os.path.abspath(__file__))
+        src = FakeImapServer(options.srcprofile, options.latency).start()
+        dst = FakeImapServer(options.dstprofile, options.latency).start()
+        src.addAccount('bench', 'bench')
+        dst.addAccount('full', 'bench')
+        dst.addAccount('date', 'bench')
+
+        # Populate source folders
+        prefix = b'' if options.srcprofile == FakeImapServer.PROFILE_EXCHANGE else b'INBOX' + src.DELIMITERS[options.srcprofile]
+        delim = src.DELIMITERS[options.srcprofile]
+        for i in range(options.folders):
+            name = b'INBOX' if i == 0 else prefix + b'Folder %d' % i if i % 2 else prefix + b'Archive' + delim + b'%d' % i
+            src.populate('bench', name, options.messages // options.folders, options.size, seed=i, days=3 * 365)
+        print("Source: {} messages in {} folders, {} bytes each, {}s latency".format(
+            options.messages, options.folders, options.size, options.latency))
+
+        results = []
+        with tempfile.TemporaryDirectory() as tmp:
+            state = os.path.join(tmp, 'state.db')
+            endpoint = lambda srv, user: '{}:bench:127.0.0.1:{}'.format(user, srv.port)
+            imapcp = [ sys.executable, os.path.join(here, 'imapcp.py') ]
+            getaddr = [ sys.executable, os.path.join(here, 'getaddr.py') ]
+
+            if 'full' in scenarios or 'incremental' in scenarios:
+                results.append(self.measure('full', src, dst, imapcp +
+                    [ endpoint(src, 'bench'), endpoint(dst, 'full'), '--state', state ] + args, here))
+            if 'incremental' in scenarios:
+                src.populate('bench', b'INBOX', options.new, options.size, seed=1000, days=1)
+                results.append(self.measure('incremental', src, dst, imapcp +
+                    [ endpoint(src, 'bench'), endpoint(dst, 'full'), '--state', state ] + args, here,
+                    options.new))
+            if 'date' in scenarios:
+                since = datetime.date.today() - datetime.timedelta(days=90)
+                results.append(self.measure('date', src, dst, imapcp +
+                    [ endpoint(src, 'bench'), endpoint(dst, 'date'), '--from', since.isoformat() ] + args, here))
+            if 'getaddr' in scenarios:
+                results.append(self.measure('getaddr', src, dst, getaddr +
+                    [ endpoint(src, 'bench'), '-o', os.path.join(tmp, 'out.csv') ], here,
+                    options.messages + options.new))
+            total = sum(len(mb.messages) for mb in src.account('bench').mailboxes.values())
+            if 'export' in scenarios or 'local' in scenarios:
+                results.append(self.measure('export', src, dst, imapcp +
+                    [ endpoint(src, 'bench'), 'maildir:' + os.path.join(tmp, 'export') ] + args, here, total))
+            if 'local' in scenarios:
+                results.append(self.measure('local', src, dst, imapcp +
+                    [ 'maildir:' + os.path.join(tmp, 'export'), 'maildir:' + os.path.join(tmp, 'local') ] + args,
+                    here, total))
+
+        src.stop()
+        dst.stop()
+
+        print()
+        print('{:<12} {:>9} {:>9} {:>11} {:>12} {:>10} {:>10}'.format(
+            'scenario', 'messages', 'seconds', 'msg/s', 'bytes/s', 'cmds/msg', 'peak RSS'))
+        for r in results:
+            print('{:<12} {:>9} {:>9.2f} {:>11.1f} {:>12.0f} {:>10.2f} {:>9.1f}M'.format(r['scenario'],
+                r['messages'], r['seconds'], r['messages_per_sec'], r['bytes_per_sec'],
+                r['commands_per_message'], r['peak_rss'] / 1024 / 1024))
+
+        if options.json:
+            with open(options.json, 'w') as f:
+                json.dump(results, f, indent=2)
+
+    def measure(self, name, src, dst, cmd, cwd, messages=None):
+        """
+            Runs a command in a child process, measuring it
+
+            @param messages: number of messages processed, defaults to the
+                   number of messages appended to destination
+            @return dict of results
+        """
+        src.resetStats()
+        dst.resetStats()
+        print("Running", name, "...", flush=True)
+        start = time.monotonic()
+        with open(os.devnull, 'w') as devnull:
+            proc = subprocess.Popen(cmd, cwd=cwd, stdout=devnull)
+            pid, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+        seconds = time.monotonic() - start
+        if proc.returncode != 0:
+            raise RuntimeError('{} failed with exit code {}'.format(name, proc.returncode))
+
+        if messages is None:
+            messages = dst.stats.get('appended', 0)
+        commands = src.stats.get('commands', 0) + dst.stats.get('commands', 0)
+        transferred = src.stats.get('bytes_out', 0) + dst.stats.get('bytes_in', 0)
+        # ru_maxrss is in KiB on Linux, bytes on macOS
+        rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+        return {
+            'scenario': name,
+            'messages': messages,
+            'seconds': seconds,
+            'messages_per_sec': messages / seconds if seconds else 0,
+            'bytes': transferred,
+            'bytes_per_sec': transferred / seconds if seconds else 0,
+            'commands': commands,
+            'commands_per_message': commands / messages if messages else 0,
+            'peak_rss': rss,
+        }
+
+
+if __name__ == '__main__':
+    app = main()
+    app.run()
+    sys.exit(0)
@@ -0,0 +1,1093 @@
+#!/usr/bin/env python3
+# kate: space-indent on; tab-indent off;
+
+""" @package docstring
+Fake IMAP
+
+A scriptable, in-process IMAP4rev1 stand-in server, used to measure and
+regression-test imapcp without live mail servers.
+
+It can impersonate the Dovecot, Courier and MS Exchange greetings matched by
+ImapUtil.getServerType(), add a configurable latency to every command and
+counts commands and bytes, so the number of round trips can be measured.
+Bytes are counted uncompressed; after COMPRESS DEFLATE, bytes on the wire are
+counted as wire_in and wire_out too.
+
+@author Gabriele Tozzi <gabriele@tozzi.eu>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import io
+import re
+import time
+import zlib
+import random
+import datetime
+import threading
+import socket
+import socketserver
+import email
+import email.utils
+import email.parser
+import email.policy
+
+from optparse import OptionParser
+
+
+class FakeMessage:
+    """ A message stored in a FakeMailbox """
+
+    def __init__(self, uid, data, flags=(), internaldate=None):
+        self.uid = uid
+        self.data = data
+        self.flags = set(flags)
+        self.internaldate = internaldate or datetime.datetime.now(datetime.timezone.utc)
+        self.modseq = 1
+        self._headers = None
+
+    def headers(self):
+        """ @return the parsed message headers """
+        if self._headers is None:
+            self._headers = email.parser.BytesHeaderParser(policy=email.policy.compat32).parsebytes(self.data)
+        return self._headers
+
+    def headerBlock(self):
+        """ @return the raw header block, including the empty separator line """
+        idx = self.data.find(b'\r\n\r\n')
+        if idx < 0:
+            return self.data
+        return self.data[:idx+4]
+
+    def sentDate(self):
+        """ @return the date in the Date: header or None """
+        d = self.headers()['Date']
+        if not d:
+            return None
+        d = email.utils.parsedate(d)
+        if not d:
+            return None
+        return datetime.date(d[0], d[1], d[2])
+
+
+class FakeMailbox:
+    """ A mailbox in a FakeAccount """
+
+    def __init__(self, name):
+        self.name = name
+        self.uidvalidity = random.randint(1, 2**31)
+        self.uidnext = 1
+        self.modseq = 1
+        self.messages = []
+        self.lock = threading.RLock()
+
+    def add(self, data, flags=(), internaldate=None):
+        """ Adds a message, @return the new FakeMessage """
+        with self.lock:
+            m = FakeMessage(self.uidnext, data, flags, internaldate)
+            self.uidnext += 1
+            self.messages.append(m)
+            self.touch(m)
+            return m
+
+    def touch(self, m):
+        """ Bumps the MODSEQ of a changed message """
+        with self.lock:
+            self.modseq += 1
+            m.modseq = self.modseq
+
+
+class FakeAccount:
+    """ A user account: a password and a set of mailboxes """
+
+    def __init__(self, password, delimiter=b'.'):
+        self.password = password
+        self.delimiter = delimiter
+        self.mailboxes = {}
+        self.lock = threading.RLock()
+        self.create(b'INBOX')
+
+    def create(self, name):
+        """ Creates a mailbox if missing, @return the FakeMailbox """
+        with self.lock:
+            if name.upper() == b'INBOX':
+                name = b'INBOX'
+            if name not in self.mailboxes:
+                self.mailboxes[name] = FakeMailbox(name)
+            return self.mailboxes[name]
+
+    def get(self, name):
+        """ @return the FakeMailbox with the given name or None """
+        if name.upper() == b'INBOX':
+            name = b'INBOX'
+        return self.mailboxes.get(name)
+
+
+class DeflateReader(io.RawIOBase):
+    """ Reads and inflates a COMPRESS DEFLATE stream from a socket """
+
+    def __init__(self, sock, fs):
+        super().__init__()
+        self.sock = sock
+        self.fs = fs
+        self.decompressor = zlib.decompressobj(-15)
+        self.pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while not self.pending:
+            data = self.sock.recv(65536)
+            if not data:
+                return 0
+            self.fs.count('wire_in', len(data))
+            self.pending = self.decompressor.decompress(data)
+        size = min(len(buf), len(self.pending))
+        buf[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+class DeflateWriter:
+    """ Deflates data written to a socket, flushing it at every flush() """
+
+    closed = False
+
+    def __init__(self, sock, fs):
+        self.sock = sock
+        self.fs = fs
+        self.compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+
+    def write(self, data):
+        out = self.compressor.compress(data)
+        if out:
+            self.fs.count('wire_out', len(out))
+            self.sock.sendall(out)
+
+    def flush(self):
+        out = self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.fs.count('wire_out', len(out))
+        self.sock.sendall(out)
+
+    def close(self):
+        pass
+
+
+class ProtocolError(Exception):
+    """ Raised on a malformed client command """
+    pass
+
+
+class FakeImapHandler(socketserver.StreamRequestHandler):
+    """ Handles a single client connection """
+
+    MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+
+    # Seconds between checks for new messages while IDLEing
+    IDLE_POLL = 0.05
+
+    def setup(self):
+        super().setup()
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.fs = self.server.fake
+        self.account = None
+        self.mailbox = None
+        self.readonly = True
+        self.condstore = False
+        self.compressed = False
+        self.done = False
+        # Names of the mailboxes watched by NOTIFY
+        self.notify = []
+
+    # -- I/O --------------------------------------------------------------
+
+    def send(self, data):
+        self.fs.count('bytes_out', len(data))
+        self.wfile.write(data)
+        self.wfile.flush()
+
+    def readLine(self):
+        line = self.rfile.readline()
+        if not line:
+            raise EOFError()
+        self.fs.count('bytes_in', len(line))
+        return line
+
+    def readCommand(self):
+        """ Reads a full command, including literals
+            @return list of segments: bytes lines (without CRLF) and bytearray literals
+        """
+        segs = []
+        while True:
+            line = self.readLine().rstrip(b'\r\n')
+            m = re.search(rb'\{(\d+)(\+?)\}$', line)
+            if not m:
+                segs.append(line)
+                return segs
+            segs.append(line[:m.start()])
+            if not m.group(2):
+                self.send(b'+ Ready for literal data\r\n')
+            size = int(m.group(1))
+            lit = self.rfile.read(size)
+            self.fs.count('bytes_in', len(lit))
+            segs.append(bytearray(lit))
+
+    # -- Parsing ----------------------------------------------------------
+
+    def tokenize(self, segs):
+        """ @return a nested list of tokens from the given command segments """
+        root = []
+        stack = [root]
+        for seg in segs:
+            if isinstance(seg, bytearray):
+                stack[-1].append(bytes(seg))
+                continue
+            i = 0
+            while i < len(seg):
+                c = seg[i:i+1]
+                if c == b' ':
+                    i += 1
+                elif c == b'(':
+                    n = []
+                    stack[-1].append(n)
+                    stack.append(n)
+                    i += 1
+                elif c == b')':
+                    if len(stack) < 2:
+                        raise ProtocolError('Unbalanced parenthesis')
+                    stack.pop()
+                    i += 1
+                elif c == b'"':
+                    i += 1
+                    s = b''
+                    while i < len(seg) and seg[i:i+1] != b'"':
+                        if seg[i:i+1] == b'\\':
+                            i += 1
+                        s += seg[i:i+1]
+                        i += 1
+                    i += 1
+                    stack[-1].append(s)
+                else:
+                    j = i
+                    depth = 0
+                    while j < len(seg):
+                        cj = seg[j:j+1]
+                        if cj == b'[':
+                            depth += 1
+                        elif cj == b']':
+                            depth -= 1
+                        elif depth == 0 and cj in (b' ', b'(', b')'):
+                            break
+                        j += 1
+                    stack[-1].append(seg[i:j])
+                    i = j
+        return root
+
+    def quote(self, s):
+        """ @return given bytes as an IMAP string (quoted or literal) """
+        if s is None:
+            return b'NIL'
+        if isinstance(s, str):
+            s = s.encode('utf-8', 'replace')
+        if b'\r' in s or b'\n' in s or b'"' in s or b'\\' in s or any(c > 0x7f for c in s):
+            return b'{%d}\r\n%s' % (len(s), s)
+        return b'"' + s + b'"'
+
+    def seqSet(self, spec, maxval):
+        """ @return set of numbers matched by a sequence set """
+        res = set()
+        for part in spec.split(b','):
+            if b':' in part:
+                a, b = part.split(b':')
+                a = maxval if a == b'*' else int(a)
+                b = maxval if b == b'*' else int(b)
+                if a > b:
+                    a, b = b, a
+                res.update(range(a, b+1))
+            else:
+                res.add(maxval if part == b'*' else int(part))
+        return res
+
+    def parseDate(self, s):
+        d, m, y = s.decode().split('-')
+        return datetime.date(int(y), self.MONTHS.index(m.capitalize()) + 1, int(d))
+
+    def internalDate(self, dt):
+        return dt.strftime('%d-') + self.MONTHS[dt.month-1] + dt.strftime('-%Y %H:%M:%S %z')
+
+    # -- Main loop --------------------------------------------------------
+
+    def handle(self):
+        self.send(b'* OK ' + self.fs.greeting() + b'\r\n')
+        while not self.done:
+            try:
+                segs = self.readCommand()
+            except (EOFError, ConnectionError, OSError):
+                return
+            try:
+                toks = self.tokenize(segs)
+            except ProtocolError as e:
+                self.send(b'* BAD ' + str(e).encode() + b'\r\n')
+                continue
+            if len(toks) < 2:
+                self.send(b'* BAD Missing command\r\n')
+                continue
+            tag = toks[0]
+            cmd = toks[1].upper()
+            args = toks[2:]
+            uid = False
+            if cmd == b'UID' and args:
+                uid = True
+                cmd = b'UID ' + args[0].upper()
+                args = args[1:]
+            self.fs.count('commands')
+            self.fs.count('cmd ' + cmd.decode())
+            if self.fs.fault(cmd.decode()):
+                self.send(b'* BYE Fault injected\r\n')
+                return
+            if self.account is not None and cmd != b'LOGOUT' and self.fs.throttled():
+                self.send(tag + b' NO [UNAVAILABLE] Too many commands, try again later\r\n')
+                continue
+            if self.fs.latency:
+                time.sleep(self.fs.latency)
+            method = getattr(self, 'do_' + cmd.decode().replace(' ', '_'), None)
+            if method is None:
+                self.send(tag + b' BAD Unknown command\r\n')
+                continue
+            try:
+                res = method(tag, args)
+            except (ProtocolError, ValueError, IndexError, TypeError) as e:
+                self.send(tag + b' BAD ' + str(e).encode() + b'\r\n')
+                continue
+            except (ConnectionError, OSError):
+                return
+            if res is not None:
+                self.send(tag + b' ' + res + b'\r\n')
+
+    # -- Commands ---------------------------------------------------------
+
+    def needAuth(self):
+        if self.account is None:
+            raise ProtocolError('Not authenticated')
+
+    def needSelected(self):
+        self.needAuth()
+        if self.mailbox is None:
+            raise ProtocolError('No mailbox selected')
+
+    def do_CAPABILITY(self, tag, args):
+        self.send(b'* CAPABILITY ' + b' '.join(self.fs.capabilities) + b'\r\n')
+        return b'OK CAPABILITY completed'
+
+    def do_NOOP(self, tag, args):
+        return b'OK NOOP completed'
+
+    def do_LOGOUT(self, tag, args):
+        self.send(b'* BYE Logging out\r\n')
+        self.done = True
+        return b'OK LOGOUT completed'
+
+    def do_LOGIN(self, tag, args):
+        user, password = args[0], args[1]
+        acct = self.fs.accounts.get(user)
+        if acct is None or acct.password != password:
+            return b'NO [AUTHENTICATIONFAILED] Authentication failed'
+        self.account = acct
+        return b'OK [CAPABILITY ' + b' '.join(self.fs.capabilities) + b'] Logged in'
+
+    def listLine(self, cmd, mbox):
+        d = self.account.delimiter
+        flags = b'\\HasNoChildren'
+        if any(n.startswith(mbox.name + d) for n in self.account.mailboxes):
+            flags = b'\\HasChildren'
+        return b'* ' + cmd + b' (' + flags + b') "' + d + b'" ' + self.quote(mbox.name) + b'\r\n'
+
+    def do_LIST(self, tag, args, cmd=b'LIST'):
+        self.needAuth()
+        pattern = args[1] if len(args) > 1 else b'*'
+        # LIST-STATUS (RFC 5819): RETURN (STATUS (items))
+        status = None
+        if len(args) > 3 and args[2].upper() == b'RETURN' and b'LIST-STATUS' in self.fs.capabilities:
+            ret = args[3]
+            for i in range(0, len(ret) - 1, 2):
+                if ret[i].upper() == b'STATUS':
+                    status = ret[i+1]
+        rx = re.escape(pattern).replace(rb'\*', b'.*').replace(b'%', b'[^' + re.escape(self.account.delimiter) + b']*')
+        rx = re.compile(b'^' + rx + b'$')
+        with self.account.lock:
+            boxes = sorted(self.account.mailboxes.values(), key=lambda m: m.name)
+        for mbox in boxes:
+            if rx.match(mbox.name):
+                self.send(self.listLine(cmd, mbox))
+                if status:
+                    self.send(b'* STATUS ' + self.quote(mbox.name) + b' (' + self.statusItems(mbox, status) + b')\r\n')
+        return b'OK ' + cmd + b' completed'
+
+    def do_LSUB(self, tag, args):
+        return self.do_LIST(tag, args, b'LSUB')
+
+    def do_CREATE(self, tag, args):
+        self.needAuth()
+        if self.account.get(args[0]) is not None:
+            return b'NO [ALREADYEXISTS] Mailbox already exists'
+        self.account.create(args[0])
+        return b'OK CREATE completed'
+
+    def statusItems(self, mbox, items):
+        out = []
+        with mbox.lock:
+            for item in items:
+                item = item.upper()
+                if item == b'MESSAGES':
+                    out.append(b'MESSAGES %d' % len(mbox.messages))
+                elif item == b'UIDNEXT':
+                    out.append(b'UIDNEXT %d' % mbox.uidnext)
+                elif item == b'UIDVALIDITY':
+                    out.append(b'UIDVALIDITY %d' % mbox.uidvalidity)
+                elif item == b'UNSEEN':
+                    out.append(b'UNSEEN %d' % len([m for m in mbox.messages if '\\Seen' not in m.flags]))
+                elif item == b'RECENT':
+                    out.append(b'RECENT 0')
+                elif item == b'HIGHESTMODSEQ' and b'CONDSTORE' in self.fs.capabilities:
+                    out.append(b'HIGHESTMODSEQ %d' % mbox.modseq)
+                else:
+                    raise ProtocolError('Unknown status item')
+        return b' '.join(out)
+
+    def do_STATUS(self, tag, args):
+        self.needAuth()
+        mbox = self.account.get(args[0])
+        if mbox is None:
+            return b'NO [NONEXISTENT] Mailbox does not exist'
+        self.send(b'* STATUS ' + self.quote(mbox.name) + b' (' + self.statusItems(mbox, args[1]) + b')\r\n')
+        return b'OK STATUS completed'
+
+    def do_SELECT(self, tag, args, readonly=False):
+        self.needAuth()
+        mbox = self.account.get(args[0])
+        if mbox is None:
+            self.mailbox = None
+            return b'NO [NONEXISTENT] Mailbox does not exist'
+        self.mailbox = mbox
+        self.readonly = readonly
+        if len(args) > 1 and isinstance(args[1], list) and b'CONDSTORE' in [a.upper() for a in args[1]]:
+            self.condstore = True
+        with mbox.lock:
+            self.send(b'* FLAGS (\\Answered \\Flagged \\Deleted \\Seen \\Draft)\r\n')
+            self.send(b'* %d EXISTS\r\n' % len(mbox.messages))
+            self.send(b'* 0 RECENT\r\n')
+            self.send(b'* OK [UIDVALIDITY %d] UIDs valid\r\n' % mbox.uidvalidity)
+            self.send(b'* OK [UIDNEXT %d] Predicted next UID\r\n' % mbox.uidnext)
+            if self.condstore:
+                self.send(b'* OK [HIGHESTMODSEQ %d] Highest\r\n' % mbox.modseq)
+        if readonly:
+            return b'OK [READ-ONLY] EXAMINE completed'
+        return b'OK [READ-WRITE] SELECT completed'
+
+    def do_ENABLE(self, tag, args):
+        self.needAuth()
+        enabled = []
+        for a in args:
+            if a.upper() == b'CONDSTORE' and b'CONDSTORE' in self.fs.capabilities:
+                self.condstore = True
+                enabled.append(b'CONDSTORE')
+        self.send(b'* ENABLED' + b''.join(b' ' + e for e in enabled) + b'\r\n')
+        return b'OK ENABLE completed'
+
+    def do_COMPRESS(self, tag, args):
+        self.needAuth()
+        if b'COMPRESS=DEFLATE' not in self.fs.capabilities or args[0].upper() != b'DEFLATE':
+            return b'NO Unsupported compression mechanism'
+        if self.compressed:
+            return b'NO [COMPRESSIONACTIVE] Compression already active'
+        # The OK is the last uncompressed response
+        self.send(tag + b' OK DEFLATE active\r\n')
+        self.compressed = True
+        self.rfile = io.BufferedReader(DeflateReader(self.request, self.fs))
+        self.wfile = DeflateWriter(self.request, self.fs)
+        return None
+
+    def do_EXAMINE(self, tag, args):
+        return self.do_SELECT(tag, args, True)
+
+    def do_CLOSE(self, tag, args):
+        self.needSelected()
+        self.mailbox = None
+        return b'OK CLOSE completed'
+
+    def do_UNSELECT(self, tag, args):
+        return self.do_CLOSE(tag, args)
+
+    def do_NOTIFY(self, tag, args):
+        """ NOTIFY (RFC 5465), only with mailboxes filters """
+        self.needAuth()
+        if b'NOTIFY' not in self.fs.capabilities:
+            return b'BAD Unknown command'
+        self.notify = []
+        if args[0].upper() == b'NONE':
+            return b'OK NOTIFY completed'
+        for group in args[1:]:
+            if not isinstance(group, list):
+                continue
+            if group[0].upper() != b'MAILBOXES':
+                return b'NO [BADEVENT] Only mailboxes filters are supported'
+            names = group[1] if isinstance(group[1], list) else [group[1]]
+            self.notify += [ self.account.get(n).name for n in names if self.account.get(n) is not None ]
+        return b'OK NOTIFY completed'
+
+    def idleState(self):
+        """ @return the watched state: messages in the selected mailbox and UIDNEXT of NOTIFY ones """
+        return (len(self.mailbox.messages) if self.mailbox else None,
+                { n: self.account.get(n).uidnext for n in self.notify })
+
+    def do_IDLE(self, tag, args):
+        """ IDLE (RFC 2177), reports new messages until the client sends DONE """
+        self.needAuth()
+        if b'IDLE' not in self.fs.capabilities:
+            return b'BAD Unknown command'
+        self.send(b'+ idling\r\n')
+        done = threading.Event()
+
+        def wait():
+            try:
+                self.readLine()
+            except (EOFError, ConnectionError, OSError):
+                pass
+            done.set()
+
+        threading.Thread(target=wait, daemon=True).start()
+        exists, uidnexts = self.idleState()
+        while not done.wait(self.IDLE_POLL):
+            now, nowuidnexts = self.idleState()
+            if exists is not None and now != exists:
+                self.send(b'* %d EXISTS\r\n' % now)
+            for name, uidnext in nowuidnexts.items():
+                if uidnext != uidnexts.get(name):
+                    mbox = self.account.get(name)
+                    self.send(b'* STATUS ' + self.quote(name) + b' (' +
+                            self.statusItems(mbox, [b'MESSAGES', b'UIDNEXT', b'UIDVALIDITY']) + b')\r\n')
+            exists, uidnexts = now, nowuidnexts
+        return b'OK IDLE terminated'
+
+    def do_APPEND(self, tag, args):
+        self.needAuth()
+        mbox = self.account.get(args[0])
+        if mbox is None:
+            return b'NO [TRYCREATE] Mailbox does not exist'
+        rest = args[1:]
+        queued = []
+        while rest:
+            flags = ()
+            date = None
+            if isinstance(rest[0], list):
+                flags = [f.decode() for f in rest[0]]
+                rest = rest[1:]
+            if len(rest) > 1 and not isinstance(rest[0], list) and re.match(rb'^\d{1,2}-\w{3}-\d{4} ', rest[0]):
+                date = datetime.datetime.strptime(rest[0].decode(), '%d-%b-%Y %H:%M:%S %z')
+                rest = rest[1:]
+            if not rest:
+                raise ProtocolError('Missing message literal')
+            queued.append((rest[0], flags, date))
+            rest = rest[1:]
+            if queued and len(queued) > 1 and b'MULTIAPPEND' not in self.fs.capabilities:
+                raise ProtocolError('MULTIAPPEND not supported')
+        uids = []
+        for data, flags, date in queued:
+            uids.append(mbox.add(data, flags, date).uid)
+        self.fs.count('appended', len(uids))
+        return b'OK [APPENDUID %d %s] APPEND completed' % (mbox.uidvalidity, b','.join(b'%d' % u for u in uids))
+
+    # -- SEARCH -----------------------------------------------------------
+
+    def matchSearch(self, keys, seq, m, maxseq, maxuid):
+        """ @return True when given message matches all search keys, consumes keys """
+        while keys:
+            if not self.matchKey(keys, seq, m, maxseq, maxuid):
+                return False
+        return True
+
+    def matchKey(self, keys, seq, m, maxseq, maxuid):
+        k = keys.pop(0)
+        if isinstance(k, list):
+            return self.matchSearch(list(k), seq, m, maxseq, maxuid)
+        ku = k.upper()
+        if ku == b'ALL':
+            return True
+        if ku == b'UID':
+            return m.uid in self.seqSet(keys.pop(0), maxuid)
+        if ku == b'NOT':
+            return not self.matchKey(keys, seq, m, maxseq, maxuid)
+        if ku == b'OR':
+            a = self.matchKey(keys, seq, m, maxseq, maxuid)
+            b = self.matchKey(keys, seq, m, maxseq, maxuid)
+            return a or b
+        if ku in (b'SINCE', b'BEFORE', b'ON'):
+            d = self.parseDate(keys.pop(0))
+            md = m.internaldate.date()
+            return {b'SINCE': md >= d, b'BEFORE': md < d, b'ON': md == d}[ku]
+        if ku in (b'SENTSINCE', b'SENTBEFORE', b'SENTON'):
+            d = self.parseDate(keys.pop(0))
+            md = m.sentDate()
+            if md is None:
+                return False
+            return {b'SENTSINCE': md >= d, b'SENTBEFORE': md < d, b'SENTON': md == d}[ku]
+        if ku == b'HEADER':
+            field = keys.pop(0).decode()
+            value = keys.pop(0).decode().lower()
+            return any(value in str(v).lower() for v in m.headers().get_all(field, []))
+        if ku in (b'SEEN', b'UNSEEN', b'FLAGGED', b'ANSWERED', b'DELETED', b'DRAFT'):
+            flag = '\\' + ku.decode().replace('UN', '', 1).capitalize() if ku.startswith(b'UN') else '\\' + ku.decode().capitalize()
+            has = flag in m.flags
+            return not has if ku.startswith(b'UN') else has
+        if re.match(rb'^[\d:,*]+$', k):
+            return seq in self.seqSet(k, maxseq)
+        raise ProtocolError('Unsupported search key %s' % k.decode())
+
+    def search(self, args):
+        """ @return list of (seq, message) matching the given criteria """
+        if args and args[0].upper() == b'CHARSET':
+            args = args[2:]
+        with self.mailbox.lock:
+            msgs = list(enumerate(self.mailbox.messages, 1))
+        maxseq = len(msgs)
+        maxuid = msgs[-1][1].uid if msgs else 0
+        return [(s, m) for s, m in msgs if self.matchSearch(list(args), s, m, maxseq, maxuid)]
+
+    def seqRanges(self, nums):
+        """ @return a compact sequence set for a sorted list of numbers, i.e. b'1:3,7' """
+        ranges = []
+        for n in nums:
+            if ranges and ranges[-1][1] == n - 1:
+                ranges[-1][1] = n
+            else:
+                ranges.append([n, n])
+        return b','.join(b'%d' % a if a == b else b'%d:%d' % (a, b) for a, b in ranges)
+
+    def do_SEARCH(self, tag, args, uid=False):
+        self.needSelected()
+        ret = None
+        if args and not isinstance(args[0], list) and args[0].upper() == b'RETURN' \
+                and b'ESEARCH' in self.fs.capabilities:
+            ret = [ r.upper() for r in args[1] ] or [b'ALL']
+            args = args[2:]
+        found = self.search(args)
+        nums = [m.uid if uid else s for s, m in found]
+        if ret is None:
+            self.send(b'* SEARCH' + b''.join(b' %d' % n for n in nums) + b'\r\n')
+            return b'OK SEARCH completed'
+        # ESEARCH (RFC 4731)
+        res = b'* ESEARCH (TAG "' + tag + b'")' + (b' UID' if uid else b'')
+        if nums and b'MIN' in ret:
+            res += b' MIN %d' % min(nums)
+        if nums and b'MAX' in ret:
+            res += b' MAX %d' % max(nums)
+        if nums and b'ALL' in ret:
+            res += b' ALL ' + self.seqRanges(sorted(nums))
+        if b'COUNT' in ret:
+            res += b' COUNT %d' % len(nums)
+        self.send(res + b'\r\n')
+        return b'OK SEARCH completed'
+
+    def do_UID_SEARCH(self, tag, args):
+        return self.do_SEARCH(tag, args, True)
+
+    # -- FETCH ------------------------------------------------------------
+
+    def envelopeAddrs(self, m, field):
+        vals = m.headers().get_all(field, [])
+        if not vals:
+            return b'NIL'
+        out = []
+        for name, addr in email.utils.getaddresses(vals):
+            if '@' in addr:
+                mbox, host = addr.rsplit('@', 1)
+            else:
+                mbox, host = addr, None
+            out.append(b'(' + self.quote(name or None) + b' NIL ' + self.quote(mbox) + b' ' + self.quote(host) + b')')
+        return b'(' + b''.join(out) + b')'
+
+    def envelope(self, m):
+        h = m.headers()
+        parts = [
+            self.quote(h['Date']),
+            self.quote(h['Subject']),
+            self.envelopeAddrs(m, 'From'),
+            self.envelopeAddrs(m, 'Sender') if h['Sender'] else self.envelopeAddrs(m, 'From'),
+            self.envelopeAddrs(m, 'Reply-To') if h['Reply-To'] else self.envelopeAddrs(m, 'From'),
+            self.envelopeAddrs(m, 'To'),
+            self.envelopeAddrs(m, 'Cc'),
+            self.envelopeAddrs(m, 'Bcc'),
+            self.quote(h['In-Reply-To']),
+            self.quote(h['Message-ID']),
+        ]
+        return b'(' + b' '.join(parts) + b')'
+
+    def headerFields(self, m, fields, negate=False):
+        lines = []
+        cur = None
+        for line in m.headerBlock().split(b'\r\n'):
+            if not line:
+                continue
+            if line[:1] in (b' ', b'\t') and cur is not None:
+                if cur[1]:
+                    lines.append(line)
+                continue
+            name = line.split(b':', 1)[0].strip().upper()
+            keep = (name in fields) != negate
+            cur = (name, keep)
+            if keep:
+                lines.append(line)
+        return b''.join(l + b'\r\n' for l in lines) + b'\r\n'
+
+    def fetchItems(self, seq, m, items):
+        out = []
+        seen = False
+        for item in items:
+            if isinstance(item, list):
+                continue
+            iu = item.upper()
+            if iu == b'UID':
+                out.append(b'UID %d' % m.uid)
+            elif iu == b'FLAGS':
+                out.append(b'FLAGS (' + ' '.join(sorted(m.flags)).encode() + b')')
+            elif iu == b'INTERNALDATE':
+                out.append(b'INTERNALDATE "' + self.internalDate(m.internaldate).encode() + b'"')
+            elif iu == b'RFC822.SIZE':
+                out.append(b'RFC822.SIZE %d' % len(m.data))
+            elif iu == b'MODSEQ':
+                out.append(b'MODSEQ (%d)' % m.modseq)
+            elif iu == b'ENVELOPE':
+                out.append(b'ENVELOPE ' + self.envelope(m))
+            elif iu in (b'RFC822', b'BODY[]', b'BODY.PEEK[]', b'RFC822.HEADER'):
+                data = m.headerBlock() if iu == b'RFC822.HEADER' else m.data
+                name = b'BODY[]' if iu.startswith(b'BODY') else iu
+                out.append(name + b' {%d}\r\n' % len(data) + data)
+                seen = seen or iu in (b'RFC822', b'BODY[]')
+            elif iu.startswith(b'BODY'):
+                mo = re.match(rb'^BODY(\.PEEK)?\[(HEADER|TEXT|HEADER\.FIELDS(\.NOT)? \((.*)\))\]$', item, re.I)
+                if not mo:
+                    raise ProtocolError('Unsupported fetch item %s' % item.decode())
+                sect = mo.group(2).upper()
+                if sect == b'HEADER':
+                    data = m.headerBlock()
+                elif sect == b'TEXT':
+                    data = m.data[len(m.headerBlock()):]
+                else:
+                    fields = mo.group(4).upper().split()
+                    data = self.headerFields(m, fields, bool(mo.group(3)))
+                out.append(b'BODY[' + mo.group(2) + b'] {%d}\r\n' % len(data) + data)
+                seen = seen or not mo.group(1)
+            else:
+                raise ProtocolError('Unsupported fetch item %s' % item.decode())
+        if seen and not self.readonly:
+            m.flags.add('\\Seen')
+        return b'* %d FETCH (' % seq + b' '.join(out) + b')\r\n'
+
+    def expandMacro(self, items):
+        if not isinstance(items, list):
+            items = [items]
+        res = []
+        for i in items:
+            iu = i.upper() if not isinstance(i, list) else None
+            if iu == b'ALL':
+                res += [b'FLAGS', b'INTERNALDATE', b'RFC822.SIZE', b'ENVELOPE']
+            elif iu == b'FAST':
+                res += [b'FLAGS', b'INTERNALDATE', b'RFC822.SIZE']
+            elif iu == b'FULL':
+                res += [b'FLAGS', b'INTERNALDATE', b'RFC822.SIZE', b'ENVELOPE']
+            else:
+                res.append(i)
+        return res
+
+    def do_FETCH(self, tag, args, uid=False):
+        self.needSelected()
+        spec, items = args[0], self.expandMacro(args[1])
+        if uid and b'UID' not in [i.upper() for i in items if not isinstance(i, list)]:
+            items = [b'UID'] + items
+        # CONDSTORE (RFC 7162) modifier: (CHANGEDSINCE modseq)
+        since = None
+        if len(args) > 2 and isinstance(args[2], list) and len(args[2]) > 1 and args[2][0].upper() == b'CHANGEDSINCE':
+            if b'CONDSTORE' not in self.fs.capabilities:
+                raise ProtocolError('CONDSTORE not supported')
+            self.condstore = True
+            since = int(args[2][1])
+            items = items + [b'MODSEQ']
+        with self.mailbox.lock:
+            msgs = list(enumerate(self.mailbox.messages, 1))
+        sent = 0
+        if msgs:
+            wanted = self.seqSet(spec, msgs[-1][1].uid if uid else len(msgs))
+            for seq, m in msgs:
+                if (m.uid if uid else seq) in wanted and (since is None or m.modseq > since):
+                    self.send(self.fetchItems(seq, m, items))
+                    sent += 1
+        self.fs.count('fetched_messages', sent)
+        return b'OK FETCH completed'
+
+    def do_UID_FETCH(self, tag, args):
+        return self.do_FETCH(tag, args, True)
+
+    def do_STORE(self, tag, args, uid=False):
+        self.needSelected()
+        if self.readonly:
+            return b'NO Mailbox is read-only'
+        spec, op, flags = args[0], args[1].upper(), args[2]
+        if not isinstance(flags, list):
+            flags = [flags]
+        flags = set(f.decode() for f in flags)
+        silent = op.endswith(b'.SILENT')
+        with self.mailbox.lock:
+            msgs = list(enumerate(self.mailbox.messages, 1))
+        if msgs:
+            wanted = self.seqSet(spec, msgs[-1][1].uid if uid else len(msgs))
+            for seq, m in msgs:
+                if (m.uid if uid else seq) not in wanted:
+                    continue
+                old = set(m.flags)
+                if op.startswith(b'+'):
+                    m.flags |= flags
+                elif op.startswith(b'-'):
+                    m.flags -= flags
+                else:
+                    m.flags = set(flags)
+                if m.flags != old:
+                    self.mailbox.touch(m)
+                    self.fs.count('stored')
+                if not silent:
+                    self.send(self.fetchItems(seq, m, [b'UID', b'FLAGS'] if uid else [b'FLAGS']))
+        return b'OK STORE completed'
+
+    def do_UID_STORE(self, tag, args):
+        return self.do_STORE(tag, args, True)
+
+    def do_COPY(self, tag, args, uid=False):
+        self.needSelected()
+        target = self.account.get(args[1])
+        if target is None:
+            return b'NO [TRYCREATE] Mailbox does not exist'
+        with self.mailbox.lock:
+            msgs = list(enumerate(self.mailbox.messages, 1))
+        if not msgs:
+            return b'OK COPY completed'
+        wanted = self.seqSet(args[0], msgs[-1][1].uid if uid else len(msgs))
+        src = []
+        dst = []
+        for seq, m in msgs:
+            if (m.uid if uid else seq) in wanted:
+                src.append(m.uid)
+                dst.append(target.add(m.data, m.flags, m.internaldate).uid)
+        self.fs.count('copied', len(dst))
+        if not src:
+            return b'OK COPY completed'
+        return b'OK [COPYUID %d %s %s] COPY completed' % (target.uidvalidity,
+                b','.join(b'%d' % u for u in src), b','.join(b'%d' % u for u in dst))
+
+    def do_UID_COPY(self, tag, args):
+        return self.do_COPY(tag, args, True)
+
+
+class FakeImapServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """ The fake IMAP server
+
+        Usage:
+            srv = FakeImapServer(FakeImapServer.PROFILE_DOVECOT)
+            srv.addAccount('user', 'pass')
+            srv.populate('user', b'INBOX', 100)
+            srv.start()
+            ... connect to srv.port ...
+            srv.stop()
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    PROFILE_DOVECOT = 'dovecot'
+    PROFILE_COURIER = 'courier'
+    PROFILE_EXCHANGE = 'exchange'
+
+    GREETINGS = {
+        PROFILE_DOVECOT: b'Dovecot ready.',
+        PROFILE_COURIER: b'Courier-IMAP ready. Copyright 1998-2018 Double Precision, Inc.',
+        PROFILE_EXCHANGE: b'The Microsoft Exchange IMAP4 service is ready.',
+    }
+
+    DELIMITERS = {
+        PROFILE_DOVECOT: b'.',
+        PROFILE_COURIER: b'.',
+        PROFILE_EXCHANGE: b'/',
+    }
+
+    BASE_CAPABILITIES = [b'IMAP4rev1', b'LITERAL+', b'MULTIAPPEND', b'UIDPLUS', b'LIST-STATUS',
+            b'ENABLE', b'CONDSTORE', b'COMPRESS=DEFLATE', b'ESEARCH', b'IDLE', b'NOTIFY']
+
+    def __init__(self, profile=PROFILE_DOVECOT, latency=0, host='127.0.0.1', port=0, capabilities=None):
+        """
+            @param profile: the server to impersonate, one of PROFILE_*
+            @param latency: seconds to wait before answering every command
+            @param capabilities: list of bytes capabilities, defaults to BASE_CAPABILITIES
+        """
+        super().__init__((host, port), FakeImapHandler)
+        self.fake = self
+        self.profile = profile
+        self.latency = latency
+        self.capabilities = list(self.BASE_CAPABILITIES if capabilities is None else capabilities)
+        self.accounts = {}
+        self.stats = {}
+        self.statsLock = threading.Lock()
+        self.thread = None
+        # command -> number of commands before dropping the connection
+        self.faults = {}
+        # (max commands, period) and times of the commands in the period
+        self.rate = None
+        self.recent = []
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def greeting(self):
+        return b'[CAPABILITY ' + b' '.join(self.capabilities) + b'] ' + self.GREETINGS[self.profile]
+
+    def count(self, name, value=1):
+        with self.statsLock:
+            self.stats[name] = self.stats.get(name, 0) + value
+
+    def dropAt(self, command, count=1):
+        """ Drops the connection, with a BYE, at the count-th next command of the given kind """
+        with self.statsLock:
+            self.faults[command.upper()] = count
+
+    def fault(self, command):
+        """ @return True when the connection must be dropped at this command """
+        with self.statsLock:
+            if command not in self.faults:
+                return False
+            self.faults[command] -= 1
+            if self.faults[command] > 0:
+                return False
+            del self.faults[command]
+            return True
+
+    def limit(self, commands, period=1.0):
+        """ Refuses commands beyond the given number per period of seconds, like throttling servers """
+        with self.statsLock:
+            self.rate = (commands, period) if commands else None
+            self.recent = []
+
+    def throttled(self):
+        """ @return True when the current command exceeds the rate set by limit() """
+        with self.statsLock:
+            if not self.rate:
+                return False
+            now = time.monotonic()
+            self.recent = [ t for t in self.recent if t > now - self.rate[1] ]
+            if len(self.recent) >= self.rate[0]:
+                self.stats['throttled'] = self.stats.get('throttled', 0) + 1
+                return True
+            self.recent.append(now)
+            return False
+
+    def resetStats(self):
+        with self.statsLock:
+            self.stats = {}
+
+    def addAccount(self, user, password):
+        """ Adds an user account, @return the FakeAccount """
+        acct = FakeAccount(password.encode() if isinstance(password, str) else password,
+                self.DELIMITERS[self.profile])
+        self.accounts[user.encode() if isinstance(user, str) else user] = acct
+        return acct
+
+    def account(self, user):
+        return self.accounts[user.encode() if isinstance(user, str) else user]
+
+    def populate(self, user, folder, count, size=2048, start=None, days=365, seed=None, noid=0):
+        """ Fills a folder with random messages
+
+            @param count: number of messages to add
+            @param size: approximate size of each message body
+            @param start: date of the newest message, defaults to today
+            @param days: messages are spread over this many days before start
+            @param noid: number of messages without a Message-ID header
+        """
+        rnd = random.Random(seed)
+        mbox = self.account(user).create(folder)
+        start = start or datetime.datetime.now(datetime.timezone.utc)
+        for i in range(count):
+            when = start - datetime.timedelta(seconds=rnd.randint(0, days * 86400))
+            mbox.add(self.makeMessage(rnd, when, size, i >= noid), flags=rnd.choice([(), ('\\Seen',), ('\\Seen', '\\Flagged')]),
+                    internaldate=when)
+        return mbox
+
+    def makeMessage(self, rnd, when, size, withid=True):
+        """ @return a random RFC822 message """
+        words = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do']
+        names = ['alice', 'bob', 'carol', 'dave', 'eve', 'frank', 'grace', 'heidi']
+        body = []
+        length = 0
+        while length < size:
+            line = ' '.join(rnd.choice(words) for i in range(12))
+            body.append(line)
+            length += len(line) + 2
+        hdrs = [
+            'From: %s <%s@example.com>' % (rnd.choice(names).title(), rnd.choice(names)),
+            'To: %s@example.org, %s@example.net' % (rnd.choice(names), rnd.choice(names)),
+            'Cc: %s@example.com' % rnd.choice(names),
+            'Subject: %s' % ' '.join(rnd.choice(words) for i in range(5)),
+            'Date: %s' % email.utils.format_datetime(when),
+        ]
+        if withid:
+            hdrs.append('Message-ID: <%032x@fake.example.com>' % rnd.getrandbits(128))
+        return ('\r\n'.join(hdrs) + '\r\n\r\n' + '\r\n'.join(body) + '\r\n').encode()
+
+    def start(self):
+        """ Starts serving in a background thread """
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+if __name__ == '__main__':
+    usage = "%prog [options] <user>:<password>"
+    parser = OptionParser(usage=usage)
+    parser.add_option("-p", "--port", dest="port", type="int", default=1143,
+        help="Port to listen on (default: 1143)")
+    parser.add_option("-P", "--profile", dest="profile", default=FakeImapServer.PROFILE_DOVECOT,
+        help="Server to impersonate: dovecot, courier or exchange")
+    parser.add_option("-l", "--latency", dest="latency", type="float", default=0,
+        help="Per-command latency, in seconds")
+    parser.add_option("-n", "--messages", dest="messages", type="int", default=0,
+        help="Number of messages to put into INBOX")
+    parser.add_option("--size", dest="size", type="int", default=2048,
+        help="Approximate message size, in bytes")
+    (options, args) = parser.parse_args()
+    if len(args) < 1:
+        parser.error("invalid number of arguments")
+    user, password = args[0].split(':', 1)
+    srv = FakeImapServer(options.profile, options.latency, port=options.port)
+    srv.addAccount(user, password)
+    if options.messages:
+        srv.populate(user, b'INBOX', options.messages, options.size)
+    print("Listening on port", srv.port)
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    sys.exit(0)
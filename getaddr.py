@@ -1,11 +1,17 @@
-#!/usr/bin/env python
-# -*- coding: utf-8 -*-
+#!/usr/bin/env python3
+# kate: space-indent on; tab-indent off;
 
 """ @package docstring
 IMAP GetAddr
 
 Gets email addresses from a source IMAP server and saves them in a CSV file
 
+Addresses are read from the From, To, Cc, Bcc and Reply-To fields of every
+message, using bulk ENVELOPE fetches. For every address the CSV file lists
+the display name, the number of messages it appears in and the date it was
+last seen. The file is periodically rewritten after a folder is done, so partial
+results are available while the harvest is running.
+
 Source IMAP is always accessed READ-ONLY.
 
 @author Gabriele Tozzi <gabriele@tozzi.eu>
@@ -24,105 +30,142 @@ You should have received a copy of the GNU General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
-import imaplib
 import sys
+import os
 import re
-import pprint
-import email
 import csv
+import datetime
+import time
+import email.utils
 
 from optparse import OptionParser
-from imaputil import ImapUtil
+from imaputil import ImapUtil, KeyIndex
 
 class main(ImapUtil):
-    
+
     NAME = 'getaddr'
-    VERSION = '0.1'
-    
+    VERSION = '0.2'
+
+    # Address fields harvested from every message
+    FIELDS = ('From', 'To', 'Cc', 'Bcc', 'Reply-To')
+
+    # Min number of seconds between two partial saves of the CSV file
+    SAVE_INTERVAL = 30
+
     def run(self):
-        
-        # Init pretty printer
-        pp = pprint.PrettyPrinter(indent = 2)
-        
+
         # Read command line
         usage = "%prog <user>:<password>:<host>:<port>"
         parser = OptionParser(usage=usage, version=self.NAME + ' ' + self.VERSION)
+        parser.add_option("-o", "--output", dest="output", default='out.csv',
+            help="Output CSV file (default: %default)")
+        parser.add_option("-e", "--exclude", dest="exclude", action='append',
+            help="Exclude folders matching pattern (can be specified multiple times)")
+        parser.add_option("-c", "--chunk", dest="chunk", type="int", default=self.FETCH_CHUNK,
+            help="Number of messages requested by a single bulk FETCH (default: %default)")
 
         (options, args) = parser.parse_args()
-        
+
         # Parse mandatory arguments
         if len(args) < 1:
             parser.error("invalid number of arguments")
-        src = args[0].split(':')
-        src = {
-            'user': src[0],
-            'pass': src[1],
-            'host': src[2] if len(src) > 2 else 'localhost',
-            'port': int(src[3]) if len(src) > 3 else 143,
-        }
-        
+        try:
+            src = self.parseEndpoint(args[0])
+        except ValueError as e:
+            parser.error(str(e))
+        excludes = [ re.compile(e.encode('ascii')) for e in options.exclude or [] ]
+
         # Make connections and authenticate
-        srcconn = imaplib.IMAP4(src['host'], src['port'])
-        srcconn.login(src['user'], src['pass'])
-        srctype = self.getServerType(srcconn)
-        print "Source server type is", srctype
+        srcconn = self.connect(src)
+        srctype, srcdescr = self.getServerType(srcconn)
+        print("Source server type is", srcdescr)
 
-        print "Source mailboxes:"
+        print("Source mailboxes:")
         srcfolders = self.listMailboxes(srcconn)
-        pp.pprint(srcfolders)
+        for f in srcfolders:
+            print(f)
 
-        addrs = []
-        addrre = re.compile('\<([^>]+@[^>]+)\>')
+        # address -> [name, count, last seen]
+        addrs = KeyIndex()
+        saved = time.monotonic()
 
         # Reading every source folder
         for f in srcfolders:
-            
-            srcfolder = f['mailbox']
-            
-            print "Reading from", srcfolder
-                        
+
+            srcfolder = f.name
+            if any(e.match(srcfolder) for e in excludes):
+                print("Skipping", srcfolder, "(excluded)")
+                continue
+
+            print("Reading from", srcfolder)
+
             # Select source mailbox readonly
-            (res, data) = srcconn.select(srcfolder, True)
-            if res == 'NO' and srctype == 'exchange' and 'special mailbox' in data[0]:
-                print "Skipping special Microsoft Exchange Mailbox", srcfolder
+            (res, data) = srcconn.select(self.quoteFolderName(srcfolder), True)
+            if res == 'NO' and srctype == self.TYPE_EXCHANGE and b'special mailbox' in data[0]:
+                print("Skipping special Microsoft Exchange Mailbox", srcfolder)
                 continue
-            
+            if res != 'OK':
+                raise RuntimeError('Error selecting mailbox "{}": {}'.format(srcfolder.decode(), data))
+
             # Fetch all source messages imap IDS
             srcids = self.listMessages(srcconn)
-            print "Found", len(srcids), "messages in source folder"
-            
-            # Output data
-            for sid in srcids:
-                mid = self.getMessageId(srcconn, sid)
-                print "Reading message", mid
-                mex = self.getHeaders(srcconn, sid)
-                if mex['From']:
-                    f = addrre.search(mex['From'])
-                    if f:
-                        f = f.group(1).strip()
-                else:
-                    f = None
-                if mex['To']:
-                    t = addrre.search(mex['To'])
-                    if t:
-                        t = t.group(1).strip()
-                else:
-                    t = None
-                print f, t
-                if not f in addrs:
-                    addrs.append(f)
-                if not t in addrs:
-                    addrs.append(t)
-        
-        # Save addresses
-        with open('out.csv', 'wb') as csvfile:
-            writer = csv.writer(csvfile)
-            for addr in addrs:
-                writer.writerow([addr, ])
-            
+            print("Found", len(srcids), "messages in source folder")
+
+            # Read envelopes, chunk by chunk
+            for uid, attrs in self.iterFetch(srcconn, srcids, ('ENVELOPE', ), options.chunk):
+                envelope = attrs.get(b'ENVELOPE')
+                if not envelope:
+                    continue
+                date = self.getEnvelopeDate(envelope)
+                seen = set()
+                for field, name, address in self.getEnvelopeAddresses(envelope, self.FIELDS):
+                    if address in seen:
+                        continue
+                    seen.add(address)
+                    if addrs.add(address, [name, 1, date]):
+                        continue
+                    entry = addrs.get(address)
+                    entry[1] += 1
+                    if name and not entry[0]:
+                        entry[0] = name
+                    if date and (not entry[2] or date > entry[2]):
+                        entry[2] = date
+
+            # Save addresses found so far
+            if time.monotonic() - saved >= self.SAVE_INTERVAL:
+                self.save(options.output, addrs)
+                saved = time.monotonic()
+            print(len(addrs), "addresses found so far")
+
         # Logout
         srcconn.logout()
 
+        self.save(options.output, addrs)
+        print("Saved", len(addrs), "addresses to", options.output)
+
+    def getEnvelopeDate(self, envelope):
+        """ @return the date in an ENVELOPE as datetime.date, None if invalid """
+        if not envelope[0]:
+            return None
+        d = email.utils.parsedate(envelope[0].decode('ascii', 'replace'))
+        if not d:
+            return None
+        try:
+            return datetime.date(d[0], d[1], d[2])
+        except ValueError:
+            return None
+
+    def save(self, path, addrs):
+        """ Writes the CSV file, atomically replacing the previous one """
+        tmp = path + '.tmp'
+        with open(tmp, 'w', newline='') as csvfile:
+            writer = csv.writer(csvfile)
+            writer.writerow(['address', 'name', 'count', 'last_seen'])
+            for addr in addrs:
+                name, count, date = addrs.get(addr)
+                writer.writerow([addr, name, count, date.isoformat() if date else ''])
+        os.replace(tmp, path)
+
 if __name__ == '__main__':
     app = main()
     app.run()
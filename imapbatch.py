@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# kate: space-indent on; tab-indent off;
+
+""" @package docstring
+IMAP Batch Copy
+
+Copy emails and folders for many accounts at once, from a single process.
+
+Reads a manifest of source/destination account pairs and syncs them
+concurrently over asyncio connections, capping the number of connections
+opened to every server. Creates missing folders and skips existing messages
+(using message-id), like imapcp.
+
+The manifest is either a CSV file, with a source and a destination column in
+<user>:<password>:<host>:<port> format, or a JSON file containing a list of
+objects with "source" and "destination" keys, each one a string in the same
+format or an object with user, pass, host and port keys.
+
+Source IMAP is always accessed READ-ONLY.
+
+@author Gabriele Tozzi <gabriele@tozzi.eu>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sys
+import re
+import csv
+import json
+import asyncio
+
+from optparse import OptionParser
+from imaputil import MessageIndex
+from aioimap import AsyncImapUtil, ConnectionLimiter
+
+
+class main(AsyncImapUtil):
+
+    NAME = 'imapbatch'
+    VERSION = '0.1'
+
+    def run(self):
+
+        # Read command line
+        usage = "%prog [options] <manifest.csv|manifest.json>"
+        parser = OptionParser(usage=usage, version=self.NAME + ' ' + self.VERSION)
+        parser.add_option("-e", "--exclude", dest="exclude", action='append',
+            help="Exclude folders matching pattern (can be specified multiple times)")
+        parser.add_option("-s", "--simulate", dest="simulate", action='store_true',
+            help="Do not perform any task")
+        parser.add_option("-t", "--trim", dest="trim", action='store_true',
+            help="Trim folder names")
+        parser.add_option("-a", "--accounts", dest="accounts", type="int", default=10,
+            help="Number of accounts synced concurrently (default: %default)")
+        parser.add_option("-m", "--max-connections", dest="maxconn", type="int", default=8,
+            help="Max number of connections opened to a single server (default: %default)")
+        parser.add_option("-c", "--chunk", dest="chunk", type="int", default=self.FETCH_CHUNK,
+            help="Number of messages requested by a single bulk FETCH (default: %default)")
+        parser.add_option("-b", "--batch", dest="batch", type="int", default=self.APPEND_BATCH,
+            help="Max number of messages copied by a single FETCH/APPEND (default: %default)")
+
+        (options, args) = parser.parse_args()
+
+        if len(args) < 1:
+            parser.error("invalid number of arguments")
+        if options.maxconn < 2:
+            parser.error("at least 2 connections per server are needed")
+        try:
+            accounts = self.readManifest(args[0])
+        except (OSError, ValueError, KeyError) as e:
+            parser.error("invalid manifest: {}".format(e))
+        print("Read", len(accounts), "accounts from", args[0])
+
+        self.options = options
+        self.excludes = [ re.compile(e.encode('ascii')) for e in options.exclude or [] ]
+
+        failed = asyncio.run(self.syncAll(accounts))
+        if failed:
+            raise RuntimeError('Failed to sync {} accounts: {}'.format(len(failed), ', '.join(failed)))
+
+        if options.simulate:
+            print("Simulated run, no action taken")
+
+    def readManifest(self, path):
+        """
+            Reads the account manifest
+
+            @return list of (source, destination) endpoint dicts
+        """
+        accounts = []
+        if path.lower().endswith('.json'):
+            with open(path) as f:
+                for item in json.load(f):
+                    accounts.append((self.manifestEndpoint(item['source']),
+                            self.manifestEndpoint(item['destination'])))
+        else:
+            with open(path, newline='') as f:
+                for row in csv.reader(f):
+                    if not row or not row[0].strip() or row[0].startswith('#'):
+                        continue
+                    if row[0].strip().lower() == 'source':
+                        # Header
+                        continue
+                    if len(row) < 2:
+                        raise ValueError('Missing destination for {}'.format(row[0]))
+                    accounts.append((self.parseEndpoint(row[0].strip()), self.parseEndpoint(row[1].strip())))
+        return accounts
+
+    def manifestEndpoint(self, item):
+        """ @return endpoint dict from a JSON manifest entry """
+        if isinstance(item, str):
+            return self.parseEndpoint(item)
+        return {
+            'user': item['user'],
+            'pass': item['pass'],
+            'host': item.get('host', 'localhost'),
+            'port': int(item.get('port', 143)),
+        }
+
+    async def syncAll(self, accounts):
+        """ Syncs all accounts, @return list of failed account names """
+        self.limiter = ConnectionLimiter(self.options.maxconn)
+        slots = asyncio.Semaphore(self.options.accounts)
+        failed = []
+
+        async def sync(src, dst):
+            name = '{}@{}'.format(src['user'], src['host'])
+            async with slots:
+                try:
+                    await self.syncAccount(name, src, dst)
+                except Exception as e:
+                    self.log(name, "Error syncing account:", repr(e))
+                    failed.append(name)
+
+        await asyncio.gather(*[ sync(src, dst) for src, dst in accounts ])
+        return failed
+
+    def log(self, name, *args):
+        print('[{}]'.format(name), *args, flush=True)
+
+    async def syncAccount(self, name, src, dst):
+        """ Syncs every folder of a single account """
+        servers = [ (src['host'], src['port']), (dst['host'], dst['port']) ]
+        await self.limiter.acquire(servers)
+        srcconn = dstconn = None
+        try:
+            srcconn = await self.connect(src)
+            dstconn = await self.connect(dst)
+            srctype, srcdescr = self.getServerType(srcconn)
+            dsttype, dstdescr = self.getServerType(dstconn)
+            self.log(name, "Syncing from", srcdescr, "to", dstdescr)
+
+            srcfolders, dstfolders = await asyncio.gather(self.listMailboxes(srcconn),
+                    self.listMailboxes(dstconn))
+            dstnames = set(f.name for f in dstfolders)
+
+            for f in srcfolders:
+                dstfolder = f.getPathBytes(dsttype, trim=self.options.trim)
+                if any(e.match(f.name) for e in self.excludes):
+                    self.log(name, "Skipping", f.name, "(excluded)")
+                    continue
+                await self.syncFolder(name, srcconn, dstconn, srctype, f.name, dstfolder,
+                        dstfolder in dstnames)
+        finally:
+            for conn in (srcconn, dstconn):
+                if conn:
+                    await conn.logout()
+            await self.limiter.release(servers)
+
+    async def syncFolder(self, name, srcconn, dstconn, srctype, srcfolder, dstfolder, exists):
+        """ Syncs a single source folder into destination folder """
+        options = self.options
+
+        if not exists and not options.simulate:
+            await self.createMailbox(dstconn, dstfolder)
+
+        # Select both mailboxes
+        (res, info), (dres, dinfo) = await asyncio.gather(self.selectMailbox(srcconn, srcfolder, True),
+                self.selectMailbox(dstconn, dstfolder))
+        if res != 'OK':
+            if srctype == self.TYPE_EXCHANGE:
+                self.log(name, "Skipping special Microsoft Exchange Mailbox", srcfolder)
+                return
+            raise RuntimeError('Error selecting source mailbox "{}"'.format(srcfolder.decode()))
+        if dres != 'OK':
+            if options.simulate and not exists:
+                dinfo = None
+            else:
+                raise RuntimeError('Error selecting destination mailbox "{}"'.format(dstfolder.decode()))
+
+        # Scan both sides at the same time
+        if dinfo is None:
+            srcids = await self.listMessages(srcconn)
+            dstids = []
+        else:
+            srcids, dstids = await asyncio.gather(self.listMessages(srcconn), self.listMessages(dstconn))
+        (srckeys, sizes, meta), (dstkeys, dstsizes, dstmeta) = await asyncio.gather(
+                self.getMessageKeys(srcconn, srcids, options.chunk),
+                self.getMessageKeys(dstconn, dstids, options.chunk))
+
+        dstindex = MessageIndex(dstkeys.values())
+        tocopy = []
+        for sid in srcids:
+            if dstindex.add(srckeys[sid]):
+                tocopy.append(sid)
+        self.log(name, srcfolder, "->", dstfolder, ":", len(srcids), "messages,", len(tocopy), "to copy")
+        if not tocopy or options.simulate:
+            return
+
+        # Split in batches, by count and size
+        batches = [[]]
+        total = 0
+        for sid in tocopy:
+            if batches[-1] and (len(batches[-1]) >= options.batch or total >= self.APPEND_BATCH_BYTES):
+                batches.append([])
+                total = 0
+            batches[-1].append(sid)
+            total += sizes.get(sid, 0)
+
+        # Fetch the next batch while the previous one is being appended
+        appending = None
+        try:
+            for batch in batches:
+                messages = await self.fetchMessages(srcconn, batch)
+                if appending:
+                    await appending
+                appending = asyncio.ensure_future(self.appendMessages(dstconn, dstfolder,
+                        [ (messages[i], ) + meta.get(i, (None, None)) for i in batch if i in messages ]))
+            await appending
+        finally:
+            if appending and not appending.done():
+                appending.cancel()
+
+
+if __name__ == '__main__':
+    app = main()
+    app.run()
+    sys.exit(0)
@@ -25,28 +25,66 @@ You should have received a copy of the GNU General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
-import imaplib
 import sys
 import re
-import pprint
-import email
+import json
+import math
 import datetime
+import threading
+import time
+import queue
+import signal
+import contextlib
 
 from optparse import OptionParser
-from imaputil import ImapUtil
+from imaputil import ImapUtil, ImapSession, MessageIndex
+from syncstate import SyncState
+from metrics import Metrics
+from throttle import Throttle, ThrottledError
+
+class FolderShards:
+    """ State shared by the UID ranges of a folder synced in parallel, see main.splitFolder() """
+
+    def __init__(self, count):
+        """ @param count: number of UID ranges """
+        self.lock = threading.Lock()
+        # Ranges not synced yet
+        self.pending = count
+        # Destination scan, see main.scanDestination(), done by the first range
+        self.scan = None
+        # Source UIDNEXT to store, seen by the last range
+        self.uidnext = None
+        # Number of copied messages and destination UID -> key of appended ones
+        self.copied = 0
+        self.appended = {}
+
 
 class main(ImapUtil):
 
     NAME = 'imapcp'
     VERSION = '0.5'
 
-    def run(self):
+    # Version of the --plan file format
+    PLAN_VERSION = 1
+
+    # Throttling responses a folder sync may get before they count against
+    # --retries, so a command the server always refuses does not loop forever
+    THROTTLE_RETRIES = 10
 
-        # Init pretty printer
-        pp = pprint.PrettyPrinter(indent = 2)
+    # Destination folders are searched for the new source messages, instead
+    # of scanned, when they have at least this many times more messages, and
+    # there are at most DEDUP_SEARCH_MAX new source messages
+    DEDUP_SEARCH_RATIO = 10
+    DEDUP_SEARCH_MAX = 1000
+
+    # Seconds to wait for more changes after a watched folder changes, see
+    # runDaemon()
+    DAEMON_DELAY = 1
+
+    def run(self):
 
         # Read command line
-        usage = "%prog <suser>:<spassword>:<shost>:<sport> <duser>:<dpassword>:<dhost>:<dport>"
+        usage = "%prog <suser>:<spassword>:<shost>:<sport>|maildir:<path> <duser>:<dpassword>:<dhost>:<dport>|maildir:<path>"
         parser = OptionParser(usage=usage, version=self.NAME + ' ' + self.VERSION)
         parser.add_option("-e", "--exclude", dest="exclude", action='append',
             help="Exclude folders matching pattern (can be specified multiple times)")
@@ -62,17 +100,96 @@ class main(ImapUtil):
             help="Only copy messages older than this date (inclusive)")
         parser.add_option("--to", dest="to",
             help="Only copy messages newer than this date (inclusive)")
+        parser.add_option("--date-filter", dest="datefilter", type="choice", default='sent',
+            choices=('sent', 'internal', 'client'),
+            help="How --from/--to are applied: 'sent' searches the Date: header on the server "
+                "(SENTSINCE/SENTBEFORE), 'internal' searches the arrival date on the server (SINCE/BEFORE), "
+                "'client' fetches Date: headers and checks them locally, for servers mishandling "
+                "date searches (default: %default)")
         parser.add_option("--ignore", dest="ignore", action="append",
             help="Ignore given message id (without '<>', may be specified multiple times")
+        parser.add_option("-c", "--chunk", dest="chunk", type="int", default=self.FETCH_CHUNK,
+            help="Number of messages requested by a single bulk FETCH (default: %default)")
+        parser.add_option("--state", dest="state",
+            help="Keep sync state in this SQLite file, so later runs only look at new messages "
+                "(assumes the same --from/--to on every run)")
+        parser.add_option("--dedup", dest="dedup", type="choice", default='id', choices=('id', 'hash'),
+            help="How messages already in destination are recognized: 'id' compares Message-ID "
+                "headers, 'hash' compares content fingerprints (size, main headers and body) with "
+                "messages anywhere in the destination account; every message is downloaded once "
+                "and fingerprints are kept in the --state file (default: %default)")
+        parser.add_option("--dedup-search", dest="dedupsearch", type="choice", default='auto',
+            choices=('auto', 'always', 'never'),
+            help="How destination folders are checked for new source messages with --dedup=id: "
+                "'auto' searches them by Message-ID on the server when they are much bigger than the "
+                "new messages and fetches the Message-IDs of all their messages otherwise, 'always' "
+                "always searches them, 'never' always fetches, for servers mishandling header "
+                "searches (default: %default)")
+        parser.add_option("--sync-flags", dest="syncflags", action='store_true',
+            help="Also copy flag changes of already copied messages; only flags changed since "
+                "the last run are fetched when source supports CONDSTORE, needs --state")
+        parser.add_option("--flags-only", dest="flagsonly", action='store_true',
+            help="Only copy flag changes, do not copy new messages (implies --sync-flags)")
+        parser.add_option("--spool", dest="spool", type="int", default=self.SPOOL_THRESHOLD,
+            help="Messages bigger than this many bytes are spooled on disk while copying (default: %default)")
+        parser.add_option("-b", "--batch", dest="batch", type="int", default=self.APPEND_BATCH,
+            help="Max number of messages uploaded by a single APPEND, when the destination "
+                "supports MULTIAPPEND (default: %default)")
+        parser.add_option("--server-copy", dest="servercopy", type="choice", default='auto',
+            choices=('auto', 'always', 'never'),
+            help="Copy messages on server with UID COPY instead of downloading and uploading them: "
+                "'auto' does it when source and destination are the same account, 'always' also "
+                "for different accounts on the same server (source account needs access to "
+                "destination folders) (default: %default)")
+        parser.add_option("--plan", dest="plan",
+            help="Do not copy anything, write the copy plan to this JSON file: messages and bytes to "
+                "copy per folder, with an estimated duration from the measured round-trip times and "
+                "bandwidth")
+        parser.add_option("--execute", dest="execute",
+            help="Copy the messages listed in a plan written by --plan, without scanning folders again")
+        parser.add_option("-j", "--jobs", dest="jobs", type="int", default=1,
+            help="Sync this many folders in parallel, each one using its own connections (default: %default)")
+        parser.add_option("--shard", dest="shard", type="int", default=0,
+            help="Split folders with more than this many new messages into UID ranges of this many "
+                "messages, synced in parallel by the --jobs like different folders (default: no split)")
+        parser.add_option("--src-limit", dest="srclimit",
+            help="Limits for the source server, as a comma separated list of bytes=<bytes/s>, "
+                "commands=<commands/s> and connections=<max connections>, i.e. "
+                "bytes=2M,commands=20,connections=4; rates are lowered automatically when the "
+                "server throttles anyway")
+        parser.add_option("--dst-limit", dest="dstlimit",
+            help="Limits for the destination server, see --src-limit")
+        parser.add_option("--no-compress", dest="compress", action='store_false', default=True,
+            help="Do not compress traffic with COMPRESS=DEFLATE, even when servers support it")
+        parser.add_option("--daemon", dest="daemon", action='store_true',
+            help="Keep running after syncing, copying new messages as they arrive: --watch folders "
+                "are watched with IDLE, or NOTIFY when the source supports it, and all folders are "
+                "checked every --interval seconds; without --state, the sync state is kept in memory")
+        parser.add_option("-w", "--watch", dest="watch", action='append',
+            help="Watch folders matching pattern for new messages in --daemon mode (can be specified "
+                "multiple times, default: INBOX)")
+        parser.add_option("-i", "--interval", dest="interval", type="int", default=300,
+            help="Seconds between checks of all folders in --daemon mode (default: %default)")
+        parser.add_option("-r", "--retries", dest="retries", type="int", default=5,
+            help="When a connection drops, reconnect up to this many times and resume the "
+                "folder being synced (default: %default)")
+        parser.add_option("--stats-json", dest="statsjson",
+            help="Write run statistics (command latency histograms, traffic, per-folder "
+                "throughput, phase times) to this JSON file")
+        parser.add_option("--prometheus", dest="prometheus",
+            help="Write run statistics to this file in Prometheus text format, "
+                "i.e. for the node exporter textfile collector")
+        parser.add_option("--profile", dest="profile", action='store_true',
+            help="Print a per-phase time breakdown and command latencies at the end")
 
         (options, args) = parser.parse_args()
 
         # Parse ignore list
-        ignores = []
+        ignores = MessageIndex()
         if options.ignore:
             for ignore in options.ignore:
-                ignores.append('<' + ignore + '>')
-            print("Ignoring %s" % ignores)
+                ignores.add('<' + ignore + '>')
+            print("Ignoring %s" % list(ignores))
 
         # Parse exclude list
         excludes = []
@@ -80,6 +197,9 @@ class main(ImapUtil):
             for e in options.exclude:
                 excludes.append(re.compile(e.encode('ascii')))
 
+        # Parse watch list
+        watches = [ re.compile(w.encode('ascii')) for w in options.watch or [ r'INBOX$' ] ]
+
         # Parse from/to dates
         fr = None
         if options.fr:
@@ -104,49 +224,123 @@ class main(ImapUtil):
         # Parse mandatory arguments
         if len(args) < 2:
             parser.error("invalid number of arguments")
-        src = args[0].split(':')
-        src = {
-            'user': src[0],
-            'pass': src[1],
-            'host': src[2] if len(src) > 2 else 'localhost',
-            'port': int(src[3]) if len(src) > 3 else 143,
-        }
-        dst = args[1].split(':')
-        dst = {
-            'user': dst[0],
-            'pass': dst[1],
-            'host': dst[2] if len(dst) > 2 else 'localhost',
-            'port': int(dst[3]) if len(dst) > 3 else 143,
-        }
+        try:
+            src = self.parseEndpoint(args[0])
+            dst = self.parseEndpoint(args[1])
+        except ValueError as e:
+            parser.error(str(e))
+        if options.dedup == 'hash' and not options.state:
+            parser.error("--dedup=hash needs --state")
+        if options.flagsonly:
+            options.syncflags = True
+        if options.syncflags and not options.state:
+            parser.error("--sync-flags needs --state")
+        if options.plan and options.execute:
+            parser.error("--plan and --execute can't be used together")
+        if (options.plan or options.execute) and options.dedup == 'hash':
+            parser.error("--plan and --execute need --dedup=id, fingerprints need whole messages")
+        if options.daemon and (options.plan or options.execute or options.skel):
+            parser.error("--daemon can't be used with --plan, --execute or --skel")
+        if options.interval < 1:
+            parser.error("--interval must be at least 1 second")
+        self.plan = None
+        if options.execute:
+            try:
+                self.plan = self.loadPlan(options.execute, src, dst)
+            except (OSError, ValueError) as e:
+                parser.error("Invalid plan: {}".format(e))
+        try:
+            srclimits = Throttle.parseLimits(options.srclimit) if options.srclimit else {}
+            dstlimits = Throttle.parseLimits(options.dstlimit) if options.dstlimit else {}
+        except ValueError as e:
+            parser.error(str(e))
 
-        # Make connections and authenticate
-        if src['port'] == 993:
-            srcconn = imaplib.IMAP4_SSL(src['host'], src['port'])
+        self.options = options
+        self.src = src
+        self.dst = dst
+        if options.state:
+            self.state = SyncState(options.state)
+        elif options.daemon:
+            # Only new messages are looked at after the first sync
+            self.state = SyncState(':memory:')
         else:
-            srcconn = imaplib.IMAP4(src['host'], src['port'])
-        srcconn.login(src['user'], src['pass'])
+            self.state = None
+
+        # Fingerprints of all known destination messages, for --dedup=hash
+        self.fingerprints = None
+        self.dedupLock = threading.Lock()
+        if options.dedup == 'hash':
+            self.fingerprints = MessageIndex(k for k in self.state.getAccountKeys(dst['host'], dst['port'],
+                    dst['user']) if k and k.startswith(MessageIndex.FINGERPRINT_PREFIX))
+            print("Loaded", len(self.fingerprints), "destination message fingerprints")
+
+        # Copy on server when both endpoints are the same account
+        sameaccount = (src['host'].lower(), src['port'], src['user']) == \
+            (dst['host'].lower(), dst['port'], dst['user'])
+        self.serverCopy = options.servercopy == 'always' or (options.servercopy == 'auto' and sameaccount)
+        if self.serverCopy:
+            print("Copying messages on server with UID COPY")
+
+        # Rate limits, shared by all connections to the same account
+        self.throttles = { 'source': Throttle(**srclimits) }
+        if sameaccount:
+            self.throttles['destination'] = self.throttles['source']
+            if dstlimits and not srclimits:
+                self.throttles['source'] = self.throttles['destination'] = Throttle(**dstlimits)
+        else:
+            self.throttles['destination'] = Throttle(**dstlimits)
+        self.ignores = ignores
+        self.excludes = excludes
+        self.watches = watches
+        self.fr = fr
+        self.to = to
+        self.printLock = threading.Lock()
+        # (source folder, destination folder) -> plan entry, for --plan
+        self.planEntries = {}
+        self.planLock = threading.Lock()
+        self.metrics = Metrics()
+        phase = self.metrics.timer()
+
+        # Make connections and authenticate
+        phase('connect')
+        srcsession = self.openSession(src, 'source')
+        srcconn = srcsession.conn
         srctype, srcdescr = self.getServerType(srcconn)
         print("Source server type is", srcdescr)
 
-        if dst['port'] == 993:
-            dstconn = imaplib.IMAP4_SSL(dst['host'], dst['port'])
-        else:
-            dstconn = imaplib.IMAP4(dst['host'], dst['port'])
-        dstconn.login(dst['user'], dst['pass'])
+        dstsession = self.openSession(dst, 'destination')
+        dstconn = dstsession.conn
         dsttype, dstdescr = self.getServerType(dstconn)
         print("Destination server type is", dstdescr)
 
+        # Round-trip times, to estimate the copy time
+        if options.plan:
+            self.rtt = {
+                'source': 0.0 if src.get('maildir') else self.measureRoundTrip(srcconn),
+                'destination': 0.0 if dst.get('maildir') else self.measureRoundTrip(dstconn),
+            }
+
+        phase('list')
         print("Source folders:")
-        srcfolders = self.listMailboxes(srcconn)
+        srcfolders = self.listMailboxes(srcconn, True)
         for f in srcfolders:
              print(f)
 
         print("Destination folders:")
-        dstfolders = self.listMailboxes(dstconn)
+        dstfolders = self.listMailboxes(dstconn, True)
         for f in dstfolders:
             print(f)
+        phase(None)
 
-        # Syncing every source folder
+        # Build the list of folders to sync
+        work = queue.Queue()
+        if self.plan is not None:
+            srcfolders = []
+            for srcfolder, dstfolder in self.plan:
+                if srcfolder in srcconn.mailboxes:
+                    work.put((srcfolder, dstfolder, None))
+                else:
+                    print("Skipping", srcfolder, "(not found)")
         for f in srcfolders:
 
             # Translate folder name
@@ -169,87 +363,1099 @@ class main(ImapUtil):
                 print("Skipping", srcfolder, "(excluded)")
                 continue
 
-            print("Syncing", srcfolder, 'into', dstfolder)
+            work.put((srcfolder, dstfolder, None))
+
+        # Get folder statuses, unless already got by LIST-STATUS
+        self.srcfolders = srcconn.mailboxes
+        self.dstfolders = dstconn.mailboxes
+        if not options.skel:
+            phase('list')
+            self.getStatuses(srcconn, [ self.srcfolders[s] for s, d, r in work.queue ])
+            self.getStatuses(dstconn, [ self.dstfolders[d] for s, d, r in work.queue if d in self.dstfolders ])
+            phase(None)
+
+        # Fingerprint destination folders not being synced, to find messages moved there
+        if self.fingerprints is not None and not options.skel:
+            phase('scan')
+            targets = set(d for s, d, r in work.queue)
+            if sameaccount:
+                # Source folders share their sync state with destination ones
+                targets.update(s for s, d, r in work.queue)
+            others = [ f for f in dstfolders if f.name not in targets and f.isSelectable() ]
+            self.getStatuses(dstconn, others)
+            for f in others:
+                self.indexFolder(dstconn, f)
+            phase(None)
+
+        # Syncing every source folder, every job uses a connection to each server
+        jobs = min([ options.jobs ] + [ t.connections for t in self.throttles.values() if t.connections ])
+        if jobs < options.jobs:
+            print("Using", jobs, "jobs, because of the connection limits")
+            options.jobs = jobs
+
+        # Folders to keep in sync, for --daemon
+        folders = [ (s, d) for s, d, r in work.queue ]
+
+        # Split big folders, so a single one does not keep a job busy while
+        # others are idle. Messages appended to a local Maildir get UIDs on
+        # every connection, so these are never split
+        if options.shard > 0 and options.jobs > 1 and not options.skel and not options.flagsonly \
+                and not options.execute and not dst.get('maildir'):
+            phase('scan')
+            items = list(work.queue)
+            work = queue.Queue()
+            for srcfolder, dstfolder, r in items:
+                for item in self.splitFolder(srcconn, srcfolder, dstfolder):
+                    work.put(item)
+            phase(None)
+
+        failed = []
+        try:
+            if options.jobs > 1:
+                print("Syncing", work.qsize(), "folders using", options.jobs, "jobs")
+                workers = []
+                for i in range(min(options.jobs, work.qsize())):
+                    if i == 0:
+                        sessions = (srcsession, dstsession)
+                    else:
+                        sessions = (self.openSession(src, 'source'), self.openSession(dst, 'destination'))
+                    t = threading.Thread(target=self.worker, args=(sessions, srctype, work, failed),
+                            name='job{}'.format(i))
+                    t.start()
+                    workers.append((t, sessions))
+                for t, sessions in workers:
+                    t.join()
+                    if sessions[0] is not srcsession:
+                        sessions[0].logout()
+                        sessions[1].logout()
+            else:
+                while not work.empty():
+                    srcfolder, dstfolder, uids = work.get()
+                    self.syncFolderRetry((srcsession, dstsession), srctype, srcfolder, dstfolder, uids)
+
+            # Keep copying new messages, until interrupted or terminated.
+            # Failed folders have no UIDNEXT stored, so the daemon retries them
+            if options.daemon:
+                if failed:
+                    print("Failed to sync {} folders, retrying them".format(len(failed)))
+                    failed = []
+                signal.signal(signal.SIGTERM, signal.default_int_handler)
+                try:
+                    self.runDaemon((srcsession, dstsession), srctype, folders)
+                except KeyboardInterrupt:
+                    print("Stopping")
+
+        finally:
+            # Logout
+            srcsession.logout()
+            dstsession.logout()
+
+            if self.state:
+                self.state.close()
+
+            if options.plan:
+                self.writePlan(options.plan, dstconn)
+
+        # Report statistics
+        metrics = self.metrics
+        print("Copied {} messages ({}) in {}".format(metrics.messages, metrics.formatBytes(metrics.bytes),
+                metrics.formatTime(time.monotonic() - metrics.start)))
+        if options.statsjson:
+            metrics.writeJson(options.statsjson)
+        if options.prometheus:
+            metrics.writePrometheus(options.prometheus)
+        if options.profile:
+            metrics.printProfile()
+
+        if options.simulate:
+            print("Simulated run, no action taken")
 
-            # Create dst mailbox when missing
+        if failed:
+            raise RuntimeError('Failed to sync {} folders: {}'.format(len(failed),
+                    ', '.join(f.decode() for f, e in failed)))
+
+    def measureRoundTrip(self, conn, count=3):
+        """ @return the shortest time taken by a few NOOP commands, in seconds """
+        best = None
+        for i in range(count):
+            start = time.monotonic()
+            conn.noop()
+            elapsed = time.monotonic() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def getAccount(self, endpoint):
+        """ @return dict identifying an account in plans """
+        return { 'host': endpoint['host'], 'port': endpoint['port'], 'user': endpoint['user'] }
+
+    def loadPlan(self, path, src, dst):
+        """
+            Reads a plan written by --plan
+
+            @return dict (source folder, destination folder) -> plan entry
+        """
+        with open(path) as f:
+            plan = json.load(f)
+        if plan.get('version') != self.PLAN_VERSION:
+            raise ValueError('unsupported version {}'.format(plan.get('version')))
+        if plan['source'] != self.getAccount(src) or plan['destination'] != self.getAccount(dst):
+            raise ValueError('made for other accounts')
+        print("Executing plan of", plan['created'], "for", plan['messages'], "messages")
+        return { (e['source'].encode(errors='surrogateescape'), e['destination'].encode(errors='surrogateescape')): e
+                for e in plan['folders'] }
+
+    def loadPlanEntry(self, srcconn, dstconn, entry, srcinfo, dstinfo, log):
+        """
+            Gets the messages to copy from a plan entry. Messages added to
+            destination folder since the plan was made are scanned, and not
+            copied again.
+
+            @return tuple (ids, keys, meta, sizes, index) of the messages to
+                    copy and of the index of new destination messages, None
+                    when a folder has been recreated since the plan was made
+        """
+        srcvalidity, dstvalidity = entry['uidvalidity']
+        if srcvalidity != srcinfo['UIDVALIDITY'] or dstvalidity not in (None, dstinfo['UIDVALIDITY']):
+            log("Folders changed since the plan was made, scanning them")
+            return None
+        chunk = self.options.chunk
+        ids = [ b'%d' % uid for uid, size, key in entry['copy'] ]
+        keys = { b'%d' % uid: key for uid, size, key in entry['copy'] }
+        # Flags may have changed since the plan was made
+        res = self.fetchBulk(srcconn, ids, self.META_ITEMS + ('RFC822.SIZE', ), chunk)
+        meta = self.parseMessageMeta(res)
+        sizes = self.parseSizes(res)
+        del res
+        dstids = self.listMessages(dstconn, entry['uidnext'][1])
+        if dstids:
+            log("Found", len(dstids), "messages added to destination folder since the plan was made")
+        index = MessageIndex(self.getMessageKeys(dstconn, dstids, chunk).values())
+        return ids, keys, meta, sizes, index
+
+    def addPlanEntry(self, srcfolder, dstfolder, srcinfo, dstinfo, ids, sizes, keys, srcuidnext, dstuidnext):
+        """
+            Records the messages to copy from a folder, for --plan. The UID
+            ranges of a split folder are merged into a single entry.
+
+            @param srcuidnext: UIDNEXT after the scanned source messages, None
+                   for the UID ranges of a split folder but the last one
+        """
+        copy = [ [ int(i), sizes.get(i, 0), keys[i] ] for i in ids ]
+        with self.planLock:
+            entry = self.planEntries.get((srcfolder, dstfolder))
+            if entry is None:
+                entry = self.planEntries[(srcfolder, dstfolder)] = {
+                    'source': srcfolder.decode(errors='surrogateescape'),
+                    'destination': dstfolder.decode(errors='surrogateescape'),
+                    'uidvalidity': [ srcinfo['UIDVALIDITY'], dstinfo['UIDVALIDITY'] ],
+                    'uidnext': [ srcuidnext, dstuidnext ],
+                    'copy': [],
+                }
+            elif srcuidnext is not None:
+                entry['uidnext'][0] = srcuidnext
+            entry['copy'] += copy
+
+    def estimateCopy(self, sizes, rtt, rate, multi):
+        """
+            Estimates the time needed to copy messages, like copyMessages()
+            does: small messages are fetched and appended in batches, big ones
+            one by one, while downloads and uploads overlap
+
+            @param sizes: list of message sizes
+            @param rtt: dict server -> round-trip time, in seconds
+            @param rate: dict server -> bytes per second, 0 when unknown
+            @param multi: True when destination supports MULTIAPPEND
+            @return seconds
+        """
+        options = self.options
+        if not sizes:
+            return 0.0
+        if self.serverCopy:
+            return math.ceil(len(sizes) / options.chunk) * rtt['source']
+        small = [ s for s in sizes if s <= options.spool ]
+        batches = max(math.ceil(len(small) / options.batch), math.ceil(sum(small) / self.APPEND_BATCH_BYTES)) \
+                + len(sizes) - len(small)
+        appends = batches if multi else len(sizes)
+        total = sum(sizes)
+        return max(batches * rtt['source'] + (total / rate['source'] if rate['source'] else 0),
+                appends * rtt['destination'] + (total / rate['destination'] if rate['destination'] else 0))
+
+    def writePlan(self, path, dstconn):
+        """
+            Writes the copy plan to a JSON file, see --plan. Transfer rates
+            are the ones measured while scanning folders.
+        """
+        options = self.options
+        rate = { s: self.metrics.getThroughput(s, self.rtt[s]) for s in self.rtt }
+        multi = self.hasCapability(dstconn, 'MULTIAPPEND')
+        folders = list(self.planEntries.values())
+        for entry in folders:
+            entry['copy'].sort()
+            sizes = [ size for uid, size, key in entry['copy'] ]
+            entry['messages'] = len(sizes)
+            entry['bytes'] = sum(sizes)
+            entry['seconds'] = round(self.estimateCopy(sizes, self.rtt, rate, multi), 1)
+        # Folders are copied in parallel by the jobs
+        seconds = sum(e['seconds'] for e in folders) / options.jobs
+        seconds = max([ seconds ] + [ e['seconds'] for e in folders ])
+        plan = {
+            'version': self.PLAN_VERSION,
+            'created': datetime.datetime.now(datetime.timezone.utc).isoformat(timespec='seconds'),
+            'source': self.getAccount(self.src),
+            'destination': self.getAccount(self.dst),
+            'messages': sum(e['messages'] for e in folders),
+            'bytes': sum(e['bytes'] for e in folders),
+            'seconds': round(seconds, 1),
+            'jobs': options.jobs,
+            'links': { s: { 'rtt': self.rtt[s], 'bytes_per_sec': rate[s] } for s in self.rtt },
+            'folders': folders,
+        }
+        self.metrics.writeFile(path, json.dumps(plan))
+        print("Plan: {} messages ({}) to copy in about {}, written to {}".format(plan['messages'],
+                self.metrics.formatBytes(plan['bytes']), self.metrics.formatTime(seconds), path))
+
+    def openConnection(self, endpoint, server):
+        """
+            Opens an authenticated, instrumented, connection
+
+            @param server: label of the server in statistics
+        """
+        phase = self.metrics.timer()
+        phase('connect')
+        conn = self.connect(endpoint, self.options.compress)
+        if endpoint.get('maildir'):
+            phase(None)
+            return conn
+        conn = self.throttles[server].instrument(self.metrics.instrument(conn, server))
+        # Get HIGHESTMODSEQ on SELECT, for --sync-flags
+        if self.options.syncflags and self.hasCapability(conn, 'CONDSTORE') \
+                and self.hasCapability(conn, 'ENABLE'):
+            conn.enable('CONDSTORE')
+        phase(None)
+        return conn
+
+    def openSession(self, endpoint, server):
+        """ @return an ImapSession, reopening instrumented connections """
+        return ImapSession(lambda: self.openConnection(endpoint, server), self.options.retries)
+
+    def worker(self, sessions, srctype, work, failed):
+        """ Syncs folders from the work queue until it is empty """
+        while True:
+            try:
+                srcfolder, dstfolder, uids = work.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                self.syncFolderRetry(sessions, srctype, srcfolder, dstfolder, uids)
+            except Exception as e:
+                self.log(srcfolder, "Error syncing folder:", repr(e))
+                failed.append((srcfolder, e))
+
+    def log(self, folder, *args, **kwargs):
+        """ Prints a message, prefixed with the folder name when running parallel jobs """
+        with self.printLock:
+            if self.options.jobs > 1:
+                print('[{}]'.format(folder.decode(errors='replace')), *args, **kwargs)
+            else:
+                print(*args, **kwargs)
+
+    def splitFolder(self, conn, srcfolder, dstfolder):
+        """
+            Splits a source folder with more than --shard new messages into
+            contiguous UID ranges of --shard messages each, the last one
+            being open ended
+
+            @return list of work items (srcfolder, dstfolder, uids), uids being
+                    None for the whole folder or a tuple (FolderShards, min UID,
+                    max UID or None)
+        """
+        size = self.options.shard
+        whole = [ (srcfolder, dstfolder, None) ]
+        status = self.srcfolders[srcfolder].status or {}
+        if status.get(b'MESSAGES') is not None and status[b'MESSAGES'] <= size:
+            return whole
+        res, data = conn.select(self.quoteFolderName(srcfolder), True)
+        if res != 'OK':
+            return whole
+        info = self.getMailboxInfo(conn)
+        uidnext = None
+        if self.state and info['UIDVALIDITY']:
+            mb, uidnext = self.state.getMailbox(self.src['host'], self.src['port'], self.src['user'],
+                    srcfolder, info['UIDVALIDITY'])
+        uids = sorted(int(i) for i in self.listMessages(conn, uidnext))
+        if len(uids) <= size:
+            return whole
+        starts = [ uidnext or 1 ] + uids[size::size]
+        ends = [ s - 1 for s in starts[1:] ] + [ None ]
+        print("Splitting", srcfolder, "into", len(starts), "UID ranges of", size, "messages")
+        shards = FolderShards(len(starts))
+        return [ (srcfolder, dstfolder, (shards, s, e)) for s, e in zip(starts, ends) ]
+
+    def syncFolderRetry(self, sessions, srctype, srcfolder, dstfolder, uids=None):
+        """
+            Syncs a single source folder, reconnecting and syncing it again
+            when a connection drops.
+
+            Syncing again is safe: destination is scanned again, so messages
+            appended before the failure are skipped, and with --state the
+            messages journaled as copied are not even looked at.
+
+            The first THROTTLE_RETRIES throttling responses do not count as
+            failures, as long as rates can be lowered, see Throttle.
+
+            @param uids: UID range to sync, see splitFolder()
+        """
+        srcsession, dstsession = sessions
+        attempt = 0
+        throttled = 0
+        while True:
+            try:
+                return self.syncFolder(srcsession.conn, dstsession.conn, srctype, srcfolder, dstfolder, uids)
+            except ImapSession.ERRORS + (ThrottledError, ) as e:
+                if isinstance(e, ThrottledError):
+                    throttled += 1
+                if isinstance(e, ThrottledError) and e.slowed and throttled <= self.THROTTLE_RETRIES:
+                    self.log(srcfolder, "Throttled by server ({}), slowing down".format(e))
+                else:
+                    attempt += 1
+                    if attempt > self.options.retries:
+                        raise
+                    self.log(srcfolder, "Connection lost ({}), reconnecting, attempt {}/{}".format(
+                            e, attempt, self.options.retries))
+                srcsession.reconnect()
+                dstsession.reconnect()
+
+    def syncFolder(self, srcconn, dstconn, srctype, srcfolder, dstfolder, uids=None):
+        """
+            Syncs a single source folder into destination folder
+
+            @param uids: UID range to sync, see splitFolder()
+        """
+        options = self.options
+        fr = self.fr
+        to = self.to
+        shards, minuid, maxuid = uids or (None, None, None)
+        # Plan entry to execute, see --execute
+        entry = self.plan.get((srcfolder, dstfolder)) if self.plan is not None else None
+        # Planning never creates folders, a missing one is just empty
+        missing = options.plan and dstfolder not in self.dstfolders
+        label = srcfolder
+        if shards:
+            label += ' {}:{}'.format(minuid, maxuid or '*').encode()
+        log = lambda *args, **kwargs: self.log(label, *args, **kwargs)
+
+        if shards:
+            log("Syncing", srcfolder, 'UIDs {}:{}'.format(minuid, maxuid or '*'), 'into', dstfolder)
+        else:
+            log("Syncing", srcfolder, 'into', dstfolder)
+        start = time.monotonic()
+        phase = self.metrics.timer()
+        phase('select')
+
+        # Create dst mailbox when missing
+        if dstfolder not in self.dstfolders and not missing:
             dstconn.create(self.quoteFolderName(dstfolder))
 
-            # Select source mailbox readonly
-            res, data = srcconn.select(self.quoteFolderName(srcfolder), True)
-            if res == 'NO' and srctype == 'exchange' and 'special mailbox' in data[0]:
-                print("Skipping special Microsoft Exchange Mailbox", srcfolder)
-                continue
-            assert res == 'OK', (res, data)
+        # Skip empty and unchanged folders without selecting them
+        if not options.skel and not shards and not entry and self.isUnchanged(srcfolder, dstfolder, log):
+            phase(None)
+            return
+
+        # Select source mailbox readonly
+        res, data = srcconn.select(self.quoteFolderName(srcfolder), True)
+        if res == 'NO' and srctype == self.TYPE_EXCHANGE and b'special mailbox' in data[0]:
+            log("Skipping special Microsoft Exchange Mailbox", srcfolder)
+            phase(None)
+            return
+        if res != 'OK':
+            raise RuntimeError('Error selecting mailbox "{}": {}'.format(srcfolder.decode(), str(data)))
+        srcinfo = self.getMailboxInfo(srcconn)
+        if missing:
+            res, data = 'OK', None
+        else:
+            res, data = dstconn.select(self.quoteFolderName(dstfolder), bool(options.plan))
+        if res == 'OK':
+            pass
+        elif res == 'NO':
+            log('Error selecting folder: {}, trying to create it'.format(str(data)))
+            # Create and try again
+            res, data = dstconn.create(self.quoteFolderName(dstfolder))
+            if res != 'OK':
+                raise RuntimeError('Error creating mailboxr "{}": {}'.format(dstfolder.decode(), str(data)))
             res, data = dstconn.select(self.quoteFolderName(dstfolder), False)
-            if res == 'OK':
-                pass
-            elif res == 'NO':
-                print('Error selecting folder: {}, trying to create it'.format(str(data)))
-                # Create and try again
-                res, data = dstconn.create(self.quoteFolderName(dstfolder))
-                if res != 'OK':
-                    raise RuntimeError('Error creating mailboxr "{}": {}'.format(dstfolder.decode(), str(data)))
-                res, data = dstconn.select(self.quoteFolderName(dstfolder), False)
-                assert res == 'OK', (res, data)
-            else:
-                assert False, (res, data)
+        if res != 'OK':
+            raise RuntimeError('Error selecting mailbox "{}": {}'.format(dstfolder.decode(), str(data)))
+        if missing:
+            dstinfo = dict.fromkeys(('EXISTS', 'UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ'))
+        else:
+            dstinfo = self.getMailboxInfo(dstconn)
 
-            # Stop here if only copying skeleton
-            if options.skel:
-                print("Skipping message copy")
-                continue
+        # Stop here if only copying skeleton
+        if options.skel:
+            log("Skipping message copy")
+            phase(None)
+            return
 
-            # Fetch all destination messages imap IDS
-            dstids = self.listMessages(dstconn)
-            print("Found", len(dstids), "messages in destination folder")
+        # Load already known messages from the sync state
+        phase('scan')
+        state = self.state
+        hashed = self.fingerprints is not None
+        if state and srcinfo['UIDVALIDITY'] and dstinfo['UIDVALIDITY']:
+            srcmb, srcuidnext = state.getMailbox(self.src['host'], self.src['port'], self.src['user'],
+                    srcfolder, srcinfo['UIDVALIDITY'])
+            dstmb, dstuidnext = state.getMailbox(self.dst['host'], self.dst['port'], self.dst['user'],
+                    dstfolder, dstinfo['UIDVALIDITY'])
+            dstknown = state.getMessages(dstmb)
+            if any((k or '').startswith(MessageIndex.FINGERPRINT_PREFIX) != hashed for k in dstknown.values()):
+                log("Destination folder was synced with another --dedup mode, rescanning it")
+                state.resetMailbox(dstmb)
+                dstknown = {}
+                dstuidnext = None
+        else:
+            state = None
+            srcmb = dstmb = None
+            srcuidnext = dstuidnext = None
+            dstknown = {}
 
-            # Fetch destination messages ID
-            print("Acquiring destination message IDs...", end='', flush=True)
-            dstmexids = []
-            for idx, did in enumerate(dstids):
-                if idx % 100 == 0:
-                    print('.', end='', flush=True)
-                dstmexids.append(self.getMessageId(dstconn, did))
-            print(len(dstmexids), "message IDs acquired.")
-
-            # Fetch all source messages imap IDS
-            srcids = self.listMessages(srcconn)
-            print("Found", len(srcids), "messages in source folder")
-
-            # Sync data
+        if options.flagsonly:
+            if state and not options.simulate:
+                phase('flags')
+                self.syncFlags(srcconn, dstconn, srcmb, dstmb, srcinfo, log)
+            phase(None)
+            return
+
+        # Execute the plan, unless folders changed meanwhile
+        planned = entry and self.loadPlanEntry(srcconn, dstconn, entry, srcinfo, dstinfo, log)
+        if planned:
+            srcids, srcmexids, meta, sizes, dstmexids = planned
+            listed = srcids
+            # Only new messages are known to destination folder state
+            dstkeys = {}
+            dstuidnext = None
+
+        # Fetch all (new) source messages imap IDS, filtering by date
+        before = to + datetime.timedelta(days=1) if to else None
+        if shards:
+            srcuidnext = minuid
+        if planned:
+            pass
+        elif options.datefilter == 'client':
+            srcids = self.listMessages(srcconn, srcuidnext, maxuid=maxuid)
+            if fr or to:
+                srcids = self.filterByDate(srcconn, srcids, fr, before, options.chunk)
+        else:
+            srcids = self.listMessages(srcconn, srcuidnext, fr, before, options.datefilter == 'sent', maxuid)
+        if planned:
+            log("Copying", len(srcids), "messages from the plan")
+        elif srcuidnext:
+            log("Found", len(srcids), "new messages in source folder")
+        else:
+            log("Found", len(srcids), "messages in source folder")
+
+        # Skip messages copied by an interrupted run
+        listed = srcids
+        journal = state.getMessages(srcmb, srcuidnext) if state else None
+        if journal:
+            srcids = [ i for i in srcids if int(i) not in journal ]
+            log(len(listed) - len(srcids), "messages already copied by a previous run")
+
+        # Fingerprints never match --ignore Message-IDs, these are fetched
+        # on their own
+        if hashed and self.ignores:
+            mids = self.getMessageIds(srcconn, srcids, options.chunk)
             for sid in srcids:
-                # Check for date filter
-                if fr or to:
-                    h = self.getHeaders(srcconn, sid)
-                    if 'date' not in h:
-                        continue
-                    d = email.utils.parsedate(h['date'])
-                    if not d:
-                        continue
-                    date = datetime.date(d[0], d[1], d[2])
-                    if fr and date < fr:
-                        continue
-                    if to and date > to:
-                        continue
+                if mids[sid] in self.ignores:
+                    log("Ignoring message", mids[sid])
+            srcids = [ sid for sid in srcids if mids[sid] not in self.ignores ]
+
+        # Fetch source messages ID. Fingerprints are computed while copying,
+        # when messages get downloaded anyway
+        inline = hashed and not self.serverCopy and not options.simulate
+        # Flags, arrival dates and sizes are fetched in the same bulk commands
+        if planned:
+            pass
+        elif inline:
+            srcmexids = {}
+            res = self.fetchBulk(srcconn, srcids, self.META_ITEMS + ('RFC822.SIZE', ), options.chunk)
+            meta = self.parseMessageMeta(res)
+            sizes = self.parseSizes(res)
+            del res
+        elif hashed:
+            meta = {}
+            sizes = {}
+            srcmexids = self.getFingerprints(srcconn, srcids, options.chunk)
+        else:
+            res = self.fetchBulk(srcconn, srcids, self.KEY_ITEMS + self.META_ITEMS, options.chunk)
+            srcmexids = self.parseMessageKeys(res, srcids)
+            meta = self.parseMessageMeta(res)
+            sizes = self.parseSizes(res)
+            del res
+
+        # Scan destination, once for all the UID ranges of a split folder
+        searched = False
+        if planned:
+            pass
+        elif missing:
+            dstkeys, dstmexids, dstuidnext = {}, MessageIndex(), None
+        elif shards:
+            with shards.lock:
+                if shards.scan is None:
+                    shards.scan = self.scanDestination(dstconn, dstinfo, state, dstmb, dstknown, dstuidnext, log)
+                dstkeys, dstmexids, dstuidnext, searched = shards.scan
+        else:
+            dstkeys, dstmexids, dstuidnext, searched = self.scanDestination(dstconn, dstinfo, state, dstmb,
+                    dstknown, dstuidnext, log, srcmexids.values())
+
+        # Sync data. The index of destination messages may be shared with
+        # other jobs, keys added to it and not copied yet are kept in claimed
+        done = {}
+        tocopy = []
+        claimed = {}
+        with self.dedupLock:
+            for sid in srcids:
+                if inline:
+                    tocopy.append(sid)
+                    continue
                 # Get message id
-                mid = self.getMessageId(srcconn, sid)
-                if mid in ignores:
-                    print("Ignoring message", mid)
+                mid = srcmexids[sid]
+                if mid in self.ignores:
+                    log("Ignoring message", mid)
                 elif not mid in dstmexids:
                     # Message not found, syncing it
-                    print("Copying message", mid)
-                    if not options.simulate:
-                        mex = self.getMessage(srcconn, sid)
-                        dstconn.append(dstfolder, None, None, mex)
+                    log("Copying message", mid)
+                    tocopy.append(sid)
+                    dstmexids.add(mid)
+                    claimed[sid] = mid
                 else:
-                    print("Skipping message", mid)
+                    log("Skipping message", mid)
+                done[sid] = mid
 
-        # Logout
-        srcconn.logout()
-        dstconn.logout()
+        # Only record what would be copied, when planning
+        if options.plan:
+            self.addPlanEntry(srcfolder, dstfolder, srcinfo, dstinfo, tocopy, sizes, done,
+                    self.getUidNext(srcinfo, listed, srcuidnext) if maxuid is None else None, dstuidnext)
+            phase(None)
+            return
 
-        if options.simulate:
-            print("Simulated run, no action taken")
+        # Copy missing messages
+        phase('copy')
+        copied = []
+        size = 0
+        # Destination UID -> key of appended messages
+        appended = {}
+        if tocopy and not options.simulate and self.serverCopy:
+            log("Copying", len(tocopy), "messages on server")
+            with self.releaseOnError(claimed, dstmexids):
+                self.copyOnServer(srcconn, tocopy, dstfolder, options.chunk)
+            copied = tocopy
+        elif tocopy and not options.simulate:
+            track = self.metrics.progress(len(tocopy))
+
+            def progress(uids, chunksize, dstuids):
+                nonlocal size
+                size += chunksize
+                for i in uids:
+                    claimed.pop(i, None)
+                # Journal copied messages, for resuming an interrupted run
+                if state:
+                    state.addMessages(srcmb, { i: done[i] for i in uids })
+                    state.commit()
+                for (uidvalidity, dstuid), sid in zip(dstuids or (), uids):
+                    if uidvalidity == dstinfo['UIDVALIDITY']:
+                        appended[dstuid] = done[sid]
+                line = track(len(uids), chunksize)
+                if line:
+                    log(line)
+
+            def accept(sid, fp, msgsize):
+                mid = MessageIndex.getFingerprint(fp, self.STREAM_BLOCK)
+                done[sid] = mid
+                with self.dedupLock:
+                    if not dstmexids.add(mid):
+                        log("Skipping message", mid)
+                        return False
+                    claimed[sid] = mid
+                log("Copying message", mid)
+                return True
+
+            with self.releaseOnError(claimed, dstmexids):
+                copied = self.copyMessages(srcconn, dstconn, tocopy, dstfolder, options.spool, options.batch,
+                        progress, accept if inline else None, meta, sizes)
+            gone = len(tocopy) - (len(done) if inline else len(copied))
+            if gone:
+                log(gone, "messages disappeared from source folder")
+        seconds = time.monotonic() - start
+        self.metrics.addFolder(label.decode(errors='replace'), len(copied), size, seconds)
+        if copied:
+            log("Copied {} messages ({}) in {:.1f}s, {:.1f} msg/s".format(len(copied),
+                    self.metrics.formatBytes(size), seconds, len(copied) / seconds if seconds else 0))
+
+        # Save the new high-water marks, once all the UID ranges of a split
+        # folder are synced
+        phase('state')
+        if planned:
+            srcuidnext = entry['uidnext'][0]
+        else:
+            srcuidnext = self.getUidNext(srcinfo, listed, srcuidnext)
+        count = len(copied)
+        if shards:
+            with shards.lock:
+                shards.pending -= 1
+                if maxuid is None:
+                    shards.uidnext = srcuidnext
+                shards.copied += count
+                shards.appended.update(appended)
+                if shards.pending > 0:
+                    if state and not options.simulate:
+                        state.addMessages(srcmb, done)
+                        state.commit()
+                    phase(None)
+                    return
+                srcuidnext, count, appended = shards.uidnext, shards.copied, shards.appended
+        if state and not options.simulate:
+            state.addMessages(srcmb, done)
+            state.setUidNext(srcmb, srcuidnext)
+            # Destination messages scanned by a plan or searched are not
+            # known, next runs scan them again
+            if not planned and not searched:
+                state.addMessages(dstmb, dstkeys)
+                # Messages appended by this run are known too, unless something
+                # else has been added to the destination folder meanwhile
+                if appended and len(appended) == count and \
+                        sorted(appended) == list(range(dstuidnext, dstuidnext + len(appended))):
+                    state.addMessages(dstmb, appended)
+                    dstuidnext += len(appended)
+                state.setUidNext(dstmb, dstuidnext)
+            state.commit()
+
+        if options.syncflags and state and not options.simulate:
+            phase('flags')
+            self.syncFlags(srcconn, dstconn, srcmb, dstmb, srcinfo, log)
+        phase(None)
+
+    def scanDestination(self, dstconn, dstinfo, state, dstmb, dstknown, dstuidnext, log, srckeys=None):
+        """
+            Gets the keys of (new) messages in the selected destination folder
+
+            @param dstknown: messages known from the sync state, UID -> key
+            @param srckeys: keys of the source messages to copy, when the
+                   folder may be searched for them instead, see useSearch()
+            @return tuple (keys, index, uidnext, searched): keys of the new
+                    messages, by UID, index of all destination message keys,
+                    UIDNEXT to store after the sync and whether the folder
+                    has been searched, keys being only the ones of the
+                    found messages then
+        """
+        options = self.options
+        hashed = self.fingerprints is not None
+
+        # Fetch all (new) destination messages imap IDS
+        dstids = self.listMessages(dstconn, dstuidnext)
+        if dstknown and dstinfo['EXISTS'] is not None and len(dstknown) + len(dstids) != dstinfo['EXISTS']:
+            # Some messages have been removed, can't trust the state anymore
+            log("Destination folder changed since last run, rescanning it")
+            state.resetMailbox(dstmb)
+            dstknown = {}
+            dstids = self.listMessages(dstconn)
+        if dstknown:
+            log("Found", len(dstids), "new messages in destination folder,", len(dstknown), "already known")
+        else:
+            log("Found", len(dstids), "messages in destination folder")
+
+        # Look only for the messages to copy, when much less
+        if srckeys is not None:
+            srckeys = list(srckeys)
+            if self.useSearch(srckeys, dstids):
+                log("Searching destination folder for", len(srckeys), "messages")
+                dstkeys = self.getMessageKeys(dstconn, self.searchMessageKeys(dstconn, srckeys), options.chunk)
+                dstmexids = MessageIndex(list(dstknown.values()) + list(dstkeys.values()))
+                log(len(dstkeys), "messages found.")
+                return dstkeys, dstmexids, self.getUidNext(dstinfo, dstids, dstuidnext), True
+
+        # Fetch destination messages ID
+        if options.jobs > 1:
+            progress = None
+        elif hashed:
+            progress = lambda: print('.', end='', flush=True)
+            print("Fingerprinting destination messages...", end='', flush=True)
+        else:
+            progress = lambda: print('.', end='', flush=True)
+            print("Acquiring destination message IDs...", end='', flush=True)
+        if hashed:
+            dstkeys = self.getFingerprints(dstconn, dstids, options.chunk, progress)
+            dstmexids = self.fingerprints
+            with self.dedupLock:
+                for k in dstkeys.values():
+                    dstmexids.add(k)
+            log(len(dstkeys), "fingerprints computed.")
+        else:
+            dstkeys = self.getMessageKeys(dstconn, dstids, options.chunk, progress)
+            dstmexids = MessageIndex(list(dstknown.values()) + list(dstkeys.values()))
+            log(len(dstkeys), "message IDs acquired.")
+        return dstkeys, dstmexids, self.getUidNext(dstinfo, dstids, dstuidnext), False
+
+    def useSearch(self, srckeys, dstids):
+        """
+            Chooses how to find the messages to copy in destination folder:
+            fetching the keys of all its (new) messages takes a round trip
+            every --chunk messages, and transfers their headers; searching
+            takes a round trip every SEARCH_BATCH messages to copy, and
+            transfers just the headers of the found ones.
+
+            @param srckeys: keys of the source messages to copy
+            @param dstids: UIDs of the destination messages to scan otherwise
+            @return True when the folder should be searched
+        """
+        options = self.options
+        # Fingerprints can't be searched, and synced flags are matched
+        # through the destination folder state
+        if options.dedupsearch == 'never' or self.fingerprints is not None or options.syncflags \
+                or self.dst.get('maildir'):
+            return False
+        if not all(MessageIndex.isSearchable(k) for k in srckeys):
+            return False
+        if options.dedupsearch == 'always':
+            return True
+        return len(srckeys) <= self.DEDUP_SEARCH_MAX and len(srckeys) * self.DEDUP_SEARCH_RATIO <= len(dstids)
+
+    @contextlib.contextmanager
+    def releaseOnError(self, claimed, index):
+        """
+            Removes the keys of messages not copied from the index of
+            destination messages when copying fails, so syncing again, after
+            reconnecting, copies them
+
+            @param claimed: dict UID -> key of messages not copied yet
+        """
+        try:
+            yield
+        except BaseException:
+            with self.dedupLock:
+                for mid in claimed.values():
+                    index.discard(mid)
+            raise
+
+    def syncFlags(self, srcconn, dstconn, srcmb, dstmb, srcinfo, log):
+        """
+            Copies flag changes of already copied messages, for --sync-flags.
+            Source and destination messages are matched by their keys in the
+            sync state, so no message body is ever fetched.
+
+            When source supports CONDSTORE, only flags changed since the
+            HIGHESTMODSEQ stored by the last run are fetched; otherwise flags
+            of all known messages are fetched on both sides and compared.
+
+            @param srcinfo: source mailbox info, see getMailboxInfo()
+        """
+        state = self.state
+        chunk = self.options.chunk
+        modseq = srcinfo['HIGHESTMODSEQ']
+        since = state.getModSeq(srcmb)
+        if modseq and since == modseq:
+            log("No flag changes in source folder")
+            return
+
+        srckeys = state.getMessages(srcmb)
+        dstuids = {}
+        for uid, key in state.getMessages(dstmb).items():
+            if key:
+                dstuids.setdefault(key, []).append(uid)
+
+        if modseq and since:
+            srcflags = self.getFlags(srcconn, since=since)
+            dstflags = None
+        else:
+            srcflags = self.getFlags(srcconn, [ u for u, k in srckeys.items() if k in dstuids ], chunk=chunk)
+            dstflags = self.getFlags(dstconn, [ u for k, uids in dstuids.items() for u in uids ], chunk=chunk)
+
+        changes = {}
+        for uid, flags in srcflags.items():
+            for dstuid in dstuids.get(srckeys.get(int(uid)), ()):
+                if dstflags is None or dstflags.get(b'%d' % dstuid) != flags:
+                    changes[dstuid] = flags
+        if changes:
+            self.storeFlags(dstconn, changes, chunk)
+        log("Updated flags of", len(changes), "destination messages")
+
+        if modseq:
+            state.setModSeq(srcmb, modseq)
+            state.commit()
+
+    def indexFolder(self, conn, folder):
+        """
+            Adds the fingerprints of new messages in a destination folder to
+            the sync state, for --dedup=hash
+
+            @param folder: the MailFolder, not being synced
+        """
+        state = self.state
+        status = folder.status or {}
+        if status.get(b'MESSAGES') == 0:
+            return
+        if status.get(b'UIDVALIDITY'):
+            mb, uidnext = state.getMailbox(self.dst['host'], self.dst['port'], self.dst['user'],
+                    folder.name, status[b'UIDVALIDITY'])
+            if uidnext and uidnext == status.get(b'UIDNEXT') and state.countMessages(mb) == status.get(b'MESSAGES'):
+                return
+
+        res, data = conn.select(self.quoteFolderName(folder.name), True)
+        if res != 'OK':
+            return
+        info = self.getMailboxInfo(conn)
+        if not info['UIDVALIDITY']:
+            return
+        mb, uidnext = state.getMailbox(self.dst['host'], self.dst['port'], self.dst['user'],
+                folder.name, info['UIDVALIDITY'])
+        known = state.getMessages(mb)
+        ids = self.listMessages(conn, uidnext)
+        if known and (info['EXISTS'] is not None and len(known) + len(ids) != info['EXISTS']
+                or any(not (k or '').startswith(MessageIndex.FINGERPRINT_PREFIX) for k in known.values())):
+            state.resetMailbox(mb)
+            uidnext = None
+            ids = self.listMessages(conn)
+        if not ids:
+            return
+
+        print("Fingerprinting", len(ids), "messages in", folder.name)
+        keys = self.getFingerprints(conn, ids, self.options.chunk)
+        for k in keys.values():
+            self.fingerprints.add(k)
+        state.addMessages(mb, keys)
+        state.setUidNext(mb, self.getUidNext(info, ids, uidnext))
+        state.commit()
+
+    def runDaemon(self, sessions, srctype, folders):
+        """
+            Keeps folders in sync, for --daemon. Watched folders are synced as
+            soon as the source reports new messages, all of them every
+            --interval seconds. Only folders whose source UIDNEXT changed,
+            according to a LIST-STATUS or pipelined STATUS commands, are
+            selected, and only their new messages are looked at, so idle
+            folders cost next to nothing.
+
+            @param folders: list of (source folder, destination folder)
+        """
+        options = self.options
+        changed = queue.Queue()
+        watched = [ f for f in folders if any(w.match(f[0]) for w in self.watches) ]
+        self.startWatchers(sessions[0].conn, [ s for s, d in watched ], changed)
+        print("Waiting for new messages, checking all folders every", options.interval, "seconds")
+        check = time.monotonic() + options.interval
+        while True:
+            try:
+                names = { changed.get(timeout=max(0, check - time.monotonic())) }
+            except queue.Empty:
+                todo = folders
+                check = time.monotonic() + options.interval
+            else:
+                # New messages are often reported in bursts
+                time.sleep(self.DAEMON_DELAY)
+                while not changed.empty():
+                    names.add(changed.get())
+                todo = [ f for f in folders if f[0] in names ]
+            try:
+                self.refreshFolders(sessions, todo, todo is folders)
+            except ImapSession.ERRORS + (ThrottledError, ) as e:
+                print("Connection lost ({}), reconnecting".format(e))
+                try:
+                    for session in sessions:
+                        session.reconnect()
+                except ImapSession.ERRORS as e:
+                    # The server may be down for a while, don't give up on it
+                    print("Can't reconnect ({}), retrying in {} seconds".format(e, options.interval))
+                    check = time.monotonic() + options.interval
+                else:
+                    check = time.monotonic()
+                continue
+            except Exception as e:
+                # i.e. an odd LIST or STATUS reply, the next check may do better
+                print("Error checking folders:", repr(e))
+                continue
+            for srcfolder, dstfolder in todo:
+                if not self.isSourceChanged(srcfolder):
+                    continue
+                try:
+                    self.syncFolderRetry(sessions, srctype, srcfolder, dstfolder)
+                except Exception as e:
+                    self.log(srcfolder, "Error syncing folder:", repr(e))
+
+    def startWatchers(self, srcconn, folders, changed):
+        """
+            Starts threads watching source folders for new messages, for
+            --daemon. A single connection watches all folders when the source
+            supports NOTIFY (RFC 5465), otherwise every folder needs its own
+            connection, IDLEing (RFC 2177) on it; folders beyond the source
+            connection limit are only checked every --interval seconds.
+
+            @param folders: list of source folder names
+            @param changed: queue getting the names of changed folders
+        """
+        if not folders:
+            return
+        if self.src.get('maildir') or not self.hasCapability(srcconn, 'IDLE'):
+            print("Source does not support IDLE, checking folders every", self.options.interval, "seconds")
+            return
+        # The daemon already uses a source connection
+        limit = self.throttles['source'].connections
+        available = limit - 1 if limit else len(folders)
+        if self.hasCapability(srcconn, 'NOTIFY'):
+            groups = [ folders ] if available else []
+        else:
+            groups = [ [ f ] for f in folders[:available] ]
+        if sum(len(g) for g in groups) < len(folders):
+            print("Only watching", sum(len(g) for g in groups), "folders, because of the connection limits")
+        for group in groups:
+            print("Watching", ', '.join(f.decode(errors='replace') for f in group))
+            t = threading.Thread(target=self.watchFolders, args=(group, changed), daemon=True,
+                    name='watch-{}'.format(group[0].decode(errors='replace')))
+            t.start()
+
+    def watchFolders(self, folders, changed):
+        """
+            Watches source folders on a connection of its own, putting the
+            name of every folder with new messages into the changed queue,
+            see startWatchers(). Runs forever, reconnecting when the
+            connection drops.
+        """
+        try:
+            session = self.openSession(self.src, 'source')
+        except ImapSession.ERRORS as e:
+            print("Can't watch folders ({}), checking them every {} seconds".format(e, self.options.interval))
+            return
+
+        def untagged(line):
+            words = line.split(b' ', 2)
+            if len(folders) == 1 and len(words) > 2 and words[2].upper().startswith(b'EXISTS'):
+                changed.put(folders[0])
+            elif len(words) > 2 and words[1].upper() == b'STATUS':
+                try:
+                    name = self.tokenize([ words[2].rstrip(b'\r\n') ])[0]
+                except Exception:
+                    # Names sent as literals
+                    name = None
+                for f in folders:
+                    if name is None or f == name:
+                        changed.put(f)
+
+        while True:
+            try:
+                conn = session.conn
+                if len(folders) > 1:
+                    names = b' '.join(self.quoteFolderName(f, True) for f in folders)
+                    tag = self.sendCommand(conn, b'NOTIFY SET (MAILBOXES (' + names + b') (MessageNew MessageExpunge))')
+                    typ, text = self.readResponse(conn, tag)
+                    if typ != 'OK':
+                        raise RuntimeError('Unvalid reply: {} {}'.format(typ, text.decode(errors='replace')))
+                else:
+                    res, data = conn.select(self.quoteFolderName(folders[0]), True)
+                    if res != 'OK':
+                        raise RuntimeError('Error selecting mailbox "{}": {}'.format(folders[0].decode(), str(data)))
+                while True:
+                    self.idle(conn, untagged)
+            except ImapSession.ERRORS + (ThrottledError, ) as e:
+                print("Watch connection lost ({}), reconnecting".format(e))
+                try:
+                    session.reconnect()
+                except ImapSession.ERRORS as e:
+                    print("Can't watch folders ({}), checking them every {} seconds".format(
+                            e, self.options.interval))
+                    return
+                # Messages may have arrived meanwhile
+                for f in folders:
+                    changed.put(f)
+            except RuntimeError as e:
+                print("Can't watch folders ({}), checking them every {} seconds".format(e, self.options.interval))
+                session.logout()
+                return
+
+    def refreshFolders(self, sessions, folders, full):
+        """
+            Gets the status of folders again, for --daemon
+
+            @param folders: list of (source folder, destination folder)
+            @param full: when True, folders are listed again with their
+                   statuses, by a single LIST-STATUS when supported; so
+                   destination folders created meanwhile are known too.
+                   Otherwise only the source statuses are updated
+        """
+        srcconn, dstconn = sessions[0].conn, sessions[1].conn
+        if full:
+            self.listMailboxes(srcconn, True)
+            self.listMailboxes(dstconn, True)
+            self.srcfolders, self.dstfolders = srcconn.mailboxes, dstconn.mailboxes
+            self.getStatuses(dstconn, [ self.dstfolders[d] for s, d in folders if d in self.dstfolders ])
+        else:
+            for s, d in folders:
+                if s in self.srcfolders:
+                    self.srcfolders[s].status = None
+        self.getStatuses(srcconn, [ self.srcfolders[s] for s, d in folders if s in self.srcfolders ])
+
+    def isSourceChanged(self, srcfolder):
+        """
+            Checks the source folder status against the sync state, for
+            --daemon; unlike isUnchanged(), changes to destination folders
+            are ignored, since only new source messages are copied
+
+            @return True when the folder may have messages, or flag changes
+                    with --sync-flags, not synced yet
+        """
+        src = self.srcfolders.get(srcfolder)
+        if not src or not src.status or not src.status.get(b'UIDVALIDITY'):
+            return True
+        if src.status.get(b'MESSAGES') == 0:
+            return False
+        srcmb, srcuidnext = self.state.getMailbox(self.src['host'], self.src['port'], self.src['user'],
+                srcfolder, src.status[b'UIDVALIDITY'])
+        if srcuidnext is None or srcuidnext != src.status.get(b'UIDNEXT'):
+            return True
+        if self.options.syncflags:
+            modseq = src.status.get(b'HIGHESTMODSEQ')
+            return not modseq or modseq != self.state.getModSeq(srcmb)
+        return False
+
+    def isUnchanged(self, srcfolder, dstfolder, log):
+        """
+            Checks the folder statuses got by LIST-STATUS or STATUS against
+            the sync state
+
+            @return True when there is nothing to copy from source folder
+        """
+        src = self.srcfolders.get(srcfolder)
+        dst = self.dstfolders.get(dstfolder)
+        if not src or not src.status:
+            return False
+        if src.status.get(b'MESSAGES') == 0:
+            log("Source folder is empty")
+            return True
+        if not self.state or not dst or not dst.status:
+            return False
+        if not src.status.get(b'UIDVALIDITY') or not dst.status.get(b'UIDVALIDITY'):
+            return False
+        srcmb, srcuidnext = self.state.getMailbox(self.src['host'], self.src['port'], self.src['user'],
+                srcfolder, src.status[b'UIDVALIDITY'])
+        dstmb, dstuidnext = self.state.getMailbox(self.dst['host'], self.dst['port'], self.dst['user'],
+                dstfolder, dst.status[b'UIDVALIDITY'])
+        if srcuidnext is None or srcuidnext != src.status.get(b'UIDNEXT'):
+            return False
+        if dstuidnext is None or dstuidnext != dst.status.get(b'UIDNEXT'):
+            return False
+        if self.state.countMessages(dstmb) != dst.status.get(b'MESSAGES'):
+            return False
+        if self.options.syncflags:
+            # Flag changes do not change UIDNEXT
+            modseq = src.status.get(b'HIGHESTMODSEQ')
+            if not modseq or modseq != self.state.getModSeq(srcmb):
+                return False
+        log("Folders unchanged since last run")
+        return True
+
+    def getUidNext(self, info, ids, default):
+        """ @return the UIDNEXT to store as high-water mark after a scan """
+        if info['UIDNEXT']:
+            return info['UIDNEXT']
+        if ids:
+            return max(int(i) for i in ids) + 1
+        return default
 
 
 if __name__ == '__main__':
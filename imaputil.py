@@ -22,27 +22,265 @@ You should have received a copy of the GNU General Public License
 along with this program. If not, see <http://www.gnu.org/licenses/>.
 """
 
+import os
 import imaplib
 import sys
 import re
 import pprint
 import email
+import email.utils
+import email.header
+import datetime
+import hashlib
+import tempfile
+import threading
+import queue
+import io
+import time
+import zlib
+import random
+
+from localstore import MaildirConnection
+
+
+class KeyIndex:
+    """ An insertion-ordered hash index, with constant-time membership test
+
+        Optionally maps every key to a value.
+    """
+
+    def __init__(self, keys=()):
+        self.keys = {}
+        for k in keys:
+            self.add(k)
+
+    def normalize(self, key):
+        """ @return the key actually stored for given key """
+        return key
+
+    def add(self, key, value=None):
+        """ Adds a key, @return True if it was not already present """
+        key = self.normalize(key)
+        if key in self.keys:
+            return False
+        self.keys[key] = value
+        return True
+
+    def get(self, key, default=None):
+        return self.keys.get(self.normalize(key), default)
+
+    def discard(self, key):
+        """ Removes a key, when present """
+        self.keys.pop(self.normalize(key), None)
+
+    def __contains__(self, key):
+        return self.normalize(key) in self.keys
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        return iter(self.keys)
+
+
+class HeaderFields:
+    """ Header fields of a message, parsed at the bytes level
+
+        A lightweight alternative to email.message_from_bytes(), for reading
+        a few fields of many messages: only the requested fields are kept,
+        values are unfolded and decoded only when asked for, and no Message
+        object is ever built. Like with email.message.Message, names are case
+        insensitive, the first value of a field is returned as a string and
+        missing fields are None.
+    """
+
+    # End of the header block
+    END_RE = re.compile(rb'\n\r?\n')
+    # Line breaks of folded values
+    FOLD_RE = re.compile(rb'\r?\n(?=[ \t])')
+    # Any field, for when all fields are requested
+    ANY_FIELD = rb'[!-9;-~]+'
+
+    # tuple of requested field names -> compiled regex
+    patterns = {}
+
+    def __init__(self, data=b'', fields=None):
+        """
+            @param data: bytes header block, parsed up to the first empty
+                   line, i.e. a BODY[HEADER.FIELDS (...)] section
+            @param fields: names of the fields to keep, all when None
+        """
+        # lowercase bytes name -> list of raw values
+        self.raw = {}
+        end = self.END_RE.search(data)
+        for m in self.getPattern(fields).finditer(data, 0, end.start() if end else len(data)):
+            self.raw.setdefault(m.group(1).lower(), []).append(m.group(2))
+
+    @classmethod
+    def getPattern(cls, fields):
+        """ @return the regex matching given fields and their folded values """
+        key = tuple(fields) if fields is not None else None
+        pattern = cls.patterns.get(key)
+        if pattern is None:
+            names = b'|'.join(re.escape(cls.encodeName(f)) for f in fields) if fields is not None else cls.ANY_FIELD
+            pattern = re.compile(rb'^(' + names + rb')[ \t]*:(.*(?:\r?\n[ \t].*)*)', re.I | re.M)
+            cls.patterns[key] = pattern
+        return pattern
+
+    @staticmethod
+    def encodeName(name):
+        """ @return the lowercase bytes version of a field name """
+        return (name.encode('ascii') if isinstance(name, str) else name).lower()
+
+    def getAll(self, name):
+        """ @return list of the unfolded bytes values of a field """
+        return [ self.FOLD_RE.sub(b'', v).strip() for v in self.raw.get(self.encodeName(name), ()) ]
+
+    def get(self, name, default=None):
+        """
+            @return the first value of a field as a string, 8-bit characters
+                    replaced like email.message.Message does
+        """
+        values = self.raw.get(self.encodeName(name))
+        if not values:
+            return default
+        return self.FOLD_RE.sub(b'', values[0]).strip().decode('ascii', 'replace')
+
+    def __getitem__(self, name):
+        return self.get(name)
+
+    def __contains__(self, name):
+        return self.encodeName(name) in self.raw
+
+    def __len__(self):
+        return len(self.raw)
+
+
+class MessageIndex(KeyIndex):
+    """ An index of messages, keyed by normalized Message-ID
+
+        Messages without a Message-ID are keyed by a hash of their Date, From
+        and Subject headers and size, so they are not collapsed together.
+
+        The index can also be keyed by content fingerprints, see
+        getFingerprint().
+    """
+
+    # Header fields needed to compute a message key
+    KEY_FIELDS = ('Message-ID', 'Date', 'From', 'Subject')
+
+    # Header fields included in content fingerprints, lowercase
+    FINGERPRINT_FIELDS = (b'message-id', b'date', b'from', b'to', b'cc', b'subject')
+    FINGERPRINT_PREFIX = 'sha1:'
+
+    MID_RE = re.compile(r'<[^<>]*>')
+    # Message-IDs that can be looked for with SEARCH HEADER, see isSearchable()
+    SEARCHABLE_RE = re.compile(r'^<[!-~]+>$')
+
+    def normalize(self, key):
+        if key is None or key.startswith(('hash:', self.FINGERPRINT_PREFIX)):
+            return key
+        return self.normalizeId(key)
+
+    @classmethod
+    def normalizeId(cls, mid):
+        """ @return given Message-ID in canonical <id> form, None if empty """
+        if mid is None:
+            return None
+        mid = ' '.join(str(mid).split())
+        m = cls.MID_RE.search(mid)
+        if m:
+            mid = m.group(0).replace(' ', '')
+        elif mid:
+            mid = '<' + mid.strip('<> ') + '>'
+        if mid in ('', '<>'):
+            return None
+        return mid
+
+    @classmethod
+    def isSearchable(cls, key):
+        """
+            @return True when the message with given key can be found with
+                    SEARCH HEADER: keys with 8-bit characters can't, since the
+                    original bytes are lost. Fallback hash keys can only be
+                    found among the messages without a Message-ID.
+        """
+        return key is not None and (key.startswith('hash:') or bool(cls.SEARCHABLE_RE.match(key)))
+
+    @classmethod
+    def getKey(cls, headers, size=None):
+        """
+            @param headers: HeaderFields or email.message.Message, with at least
+                   KEY_FIELDS
+            @param size: the message size in bytes, if known
+            @return the message key: normalized Message-ID or fallback hash
+        """
+        mid = cls.normalizeId(headers['Message-ID'])
+        if mid:
+            return mid
+        h = hashlib.sha1()
+        for field in cls.KEY_FIELDS[1:]:
+            h.update(' '.join(str(headers[field] or '').split()).encode('utf-8', 'replace'))
+            h.update(b'\0')
+        h.update(str(size).encode())
+        return 'hash:' + h.hexdigest()
+
+    @classmethod
+    def getFingerprint(cls, fp, block=65536):
+        """
+            Computes the content fingerprint of a message: the body size and
+            a digest of the FINGERPRINT_FIELDS headers and of the body. Other
+            headers, like Received, are ignored since servers may add them.
+
+            @param fp: binary file object positioned at the start of the
+                   message, read block by block and rewound afterwards
+            @return the fingerprint key
+        """
+        lines = []
+        for line in fp:
+            if not line.strip():
+                break
+            lines.append(line)
+        headers = HeaderFields(b''.join(lines), cls.FINGERPRINT_FIELDS)
+        h = hashlib.sha1()
+        for name in cls.FINGERPRINT_FIELDS:
+            for value in headers.getAll(name):
+                h.update(name + b':' + b' '.join(value.split()) + b'\0')
+        h.update(b'\0')
+        size = 0
+        while True:
+            data = fp.read(block)
+            if not data:
+                break
+            h.update(data)
+            size += len(data)
+        fp.seek(0)
+        return '{}{}:{}'.format(cls.FINGERPRINT_PREFIX, size, h.hexdigest())
 
 
 class MailFolder:
     """ A Mail Folder representation """
 
-    def __init__(self, srvtype, flags, delimiter, name):
+    def __init__(self, srvtype, flags, delimiter, name, status=None):
+        """
+            @param flags: list of bytes flags, i.e. [b'\\HasNoChildren']
+            @param status: dict of STATUS items (uppercase bytes) -> int, when known
+        """
         self.srvtype = srvtype
         self.delimiter = delimiter
         self.flags = flags
         self.name = name
+        self.status = status
+
+    def isSelectable(self):
+        return not any(f.upper() in (b'\\NOSELECT', b'\\NONEXISTENT') for f in self.flags)
 
     def getPath(self):
         """
             @return tuple: standardized path as a tuple
         """
-        path = self.name.split(self.delimiter)
+        # A NIL delimiter means a flat namespace, names are never split
+        path = [ self.name ] if self.delimiter is None else self.name.split(self.delimiter)
         if self.srvtype == ImapUtil.TYPE_COURIER:
             # Remove trailing inbox
             if path[0] != b'INBOX':
@@ -93,6 +331,109 @@ class MailFolder:
         return str(self.getPath())
 
 
+class DeflateStream(io.RawIOBase):
+    """ A COMPRESS=DEFLATE (RFC 4978) layer over an imaplib connection
+
+        Replaces the connection file, read by imaplib read() and readline(),
+        and its send() method; counts bytes on the wire and uncompressed.
+    """
+
+    # Bytes read from the socket at a time
+    BLOCK = 65536
+
+    def __init__(self, conn, level=zlib.Z_DEFAULT_COMPRESSION):
+        super().__init__()
+        self.sock = conn.sock
+        self.compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        self.decompressor = zlib.decompressobj(-15)
+        self.pending = b''
+        # direction -> bytes, for 'in' and 'out'
+        self.wire = { 'in': 0, 'out': 0 }
+        self.plain = { 'in': 0, 'out': 0 }
+        conn.file = io.BufferedReader(self, self.BLOCK)
+        conn.send = self.send
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        while not self.pending:
+            data = self.sock.recv(self.BLOCK)
+            if not data:
+                return 0
+            self.wire['in'] += len(data)
+            self.pending = self.decompressor.decompress(data)
+            self.plain['in'] += len(self.pending)
+        size = min(len(buf), len(self.pending))
+        buf[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def send(self, data):
+        out = self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+        self.plain['out'] += len(data)
+        self.wire['out'] += len(out)
+        self.sock.sendall(out)
+
+
+class ImapSession:
+    """ An IMAP connection that can be reopened after a failure
+
+        Only opens connections, with exponential backoff: callers decide what
+        to do again on the new connection, like SELECTing the mailbox and
+        resuming their work.
+    """
+
+    # Errors meaning the connection is gone
+    ERRORS = (imaplib.IMAP4.abort, OSError, EOFError)
+
+    # Max seconds between two connection attempts
+    MAX_BACKOFF = 60
+
+    def __init__(self, connect, retries=5, backoff=1):
+        """
+            @param connect: callable returning a new authenticated connection
+            @param retries: max number of connection attempts by reconnect()
+            @param backoff: seconds before the first attempt, doubled on
+                   every failed one
+        """
+        self.connect = connect
+        self.retries = retries
+        self.backoff = backoff
+        self.conn = connect()
+
+    def reconnect(self):
+        """
+            Drops the current connection and opens a new one, waiting longer
+            and longer between failed attempts
+
+            @return the new connection
+        """
+        self.close()
+        for attempt in range(self.retries):
+            delay = min(self.backoff * 2 ** attempt, self.MAX_BACKOFF)
+            time.sleep(delay * random.uniform(0.5, 1))
+            try:
+                self.conn = self.connect()
+                return self.conn
+            except self.ERRORS:
+                if attempt + 1 >= self.retries:
+                    raise
+
+    def close(self):
+        """ Closes the connection, ignoring errors of dead connections """
+        try:
+            self.conn.shutdown()
+        except self.ERRORS:
+            pass
+
+    def logout(self):
+        try:
+            self.conn.logout()
+        except self.ERRORS:
+            pass
+
+
 class ImapUtil:
 
     NAME = 'imaputil'
@@ -103,87 +444,1134 @@ class ImapUtil:
     TYPE_COURIER = 'courier'
     TYPE_UNKNOWN = 'unknown'
 
+    # Server types, guessed from the greeting
+    SERVER_TYPES = (
+        (TYPE_EXCHANGE, re.compile(b'Microsoft Exchange', re.I), 'MS Exchange'),
+        (TYPE_DOVECOT, re.compile(b'imapfront|dovecot', re.I), 'Dovecot'),
+        (TYPE_COURIER, re.compile(b'Courier', re.I), 'Courier'),
+    )
+
+    MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
     ATOM_SPECIALS = [ i.to_bytes(1, 'big') for i in range(0, 0x20) ] + \
         [ b'(', b')', b'{', b' ', b'%', b'*', b'"', b'\\', b']' ]
 
-    def listMailboxes(self, conn):
+    # Default number of messages requested by a single bulk FETCH
+    FETCH_CHUNK = 500
+
+    # Messages bigger than this are spooled on disk while copying
+    SPOOL_THRESHOLD = 1024 * 1024
+
+    # Max size of a single network read or write when streaming messages
+    STREAM_BLOCK = 64 * 1024
+
+    # Default max number of messages and bytes uploaded by a single APPEND
+    APPEND_BATCH = 50
+    APPEND_BATCH_BYTES = 16 * 1024 * 1024
+
+    # Items requested by STATUS and LIST-STATUS
+    STATUS_ITEMS = ('MESSAGES', 'UIDNEXT', 'UIDVALIDITY')
+
+    # Max number of pipelined STATUS commands
+    STATUS_WINDOW = 50
+
+    # Max number of Message-IDs ORed in a single SEARCH
+    SEARCH_BATCH = 50
+
+    # Seconds after which IDLE is restarted: servers may log out clients
+    # inactive for 30 minutes, RFC 2177 suggests restarting every 29
+    IDLE_TIMEOUT = 25 * 60
+
+    # Address fields in an ENVELOPE, starting from the 3rd item
+    ENVELOPE_FIELDS = ('From', 'Sender', 'Reply-To', 'To', 'Cc', 'Bcc')
+
+    # Items fetched to compute message keys, see getMessageKeys()
+    KEY_ITEMS = ('RFC822.SIZE', 'BODY.PEEK[HEADER.FIELDS ({})]'.format(' '.join(MessageIndex.KEY_FIELDS).upper()))
+
+    # Items fetched to preserve flags and arrival date, see parseMessageMeta()
+    META_ITEMS = ('FLAGS', 'INTERNALDATE')
+
+    FETCH_RE = re.compile(rb'^(?P<id>\d+) \(')
+    BODY_RE = re.compile(rb'(BODY\[\]|RFC822) \{\d+\}\r?\n?$', re.I)
+    APPENDUID_RE = re.compile(rb'\[APPENDUID (?P<uidvalidity>\d+) (?P<uids>[\d:,]+)\]', re.I)
+    ESEARCH_ALL_RE = re.compile(rb'\bALL ([\d:,]+)', re.I)
+    LITERAL_RE = re.compile(rb'\{(?P<size>\d+)\}$')
+
+    def parseEndpoint(self, spec):
         """
+            Parses an endpoint specification
+
+            @param spec: string in <user>:<password>:<host>:<port> format,
+                   host defaults to localhost and port to 143, or
+                   maildir:<path> for a local Maildir, see localstore
+            @return dict with user, pass, host and port keys, plus a maildir
+                    key holding the path for local endpoints
+        """
+        if spec.startswith('maildir:'):
+            path = os.path.abspath(spec[8:])
+            return { 'maildir': path, 'user': path, 'pass': None, 'host': 'maildir', 'port': None }
+        parts = spec.split(':')
+        if len(parts) < 2:
+            raise ValueError('Invalid endpoint: expected <user>:<password>[:<host>[:<port>]]')
+        return {
+            'user': parts[0],
+            'pass': parts[1],
+            'host': parts[2] if len(parts) > 2 else 'localhost',
+            'port': int(parts[3]) if len(parts) > 3 else 143,
+        }
+
+    def connect(self, endpoint, compress=True):
+        """
+            Opens an authenticated connection
+
+            @param endpoint: dict with user, pass, host and port keys
+            @param compress: enable COMPRESS=DEFLATE when supported, see
+                   startCompression()
+            @return the IMAP connection
+        """
+        if endpoint.get('maildir'):
+            return MaildirConnection(endpoint['maildir'])
+        if endpoint['port'] == 993:
+            conn = imaplib.IMAP4_SSL(endpoint['host'], endpoint['port'])
+        else:
+            conn = imaplib.IMAP4(endpoint['host'], endpoint['port'])
+        conn.login(endpoint['user'], endpoint['pass'])
+
+        # Capabilities may change after login
+        typ, data = conn.capability()
+        if typ == 'OK':
+            conn.capabilities = tuple(data[-1].upper().decode().split())
+        conn.deflate = None
+        if compress:
+            self.startCompression(conn)
+        return conn
+
+    def startCompression(self, conn):
+        """
+            Compresses all traffic with COMPRESS=DEFLATE (RFC 4978), when
+            supported by the server; the DeflateStream is kept in conn.deflate
+
+            @return True when compression has been enabled
+        """
+        if not self.hasCapability(conn, 'COMPRESS=DEFLATE'):
+            return False
+        tag = self.sendCommand(conn, b'COMPRESS DEFLATE')
+        typ, text = self.readResponse(conn, tag)
+        if typ != 'OK':
+            return False
+        conn.deflate = DeflateStream(conn)
+        return True
+
+    def listMailboxes(self, conn, status=False):
+        """
+            Lists all mailboxes. The result is also cached in conn.mailboxes,
+            a dict name -> MailFolder.
+
             @param conn: Active IMAP connection
+            @param status: when True and the server supports LIST-STATUS
+                   (RFC 5819), also get the STATUS_ITEMS of every mailbox in
+                   the same command, see getStatuses() for other servers
             @return Returns a list of Mailbox objects
         """
-        srvtype, srvdescr = self.getServerType(conn)
-        (res, data) = conn.list()
+        statuses = {}
+        if status and self.hasCapability(conn, 'LIST-STATUS'):
+            (res, data) = conn.xatom('LIST', '""', '*', 'RETURN',
+                    '(STATUS ({}))'.format(' '.join(self.getStatusItems(conn))))
+            data = conn.response('LIST')[1]
+            statuses = self.parseStatuses(conn.response('STATUS')[1])
+        else:
+            (res, data) = conn.list()
         if res != 'OK':
             raise RuntimeError('Invalid reply: ' + res)
-        list_re = re.compile(rb'\((?P<flags>.*)\)\s+"(?P<delimiter>.*)"\s+"?(?P<name>[^"]*)"?')
-        folders = []
+        folders = self.parseMailboxes(conn, data)
+        for f in folders:
+            f.status = statuses.get(f.name)
+        conn.mailboxes = { f.name: f for f in folders }
+        return folders
+
+    def getStatusItems(self, conn):
+        """
+            @return the STATUS_ITEMS, plus HIGHESTMODSEQ when the server
+                    supports CONDSTORE (RFC 7162)
+        """
+        if self.hasCapability(conn, 'CONDSTORE'):
+            return self.STATUS_ITEMS + ('HIGHESTMODSEQ', )
+        return self.STATUS_ITEMS
+
+    def parseResponses(self, data):
+        """
+            Splits imaplib untagged data into single responses, joining
+            responses with literals
+
+            @return list of lists of parts, see tokenize()
+        """
+        res = []
+        rest = False
         for d in data:
-            m = list_re.match(d)
-            if not m:
-                raise RuntimeError('No match: ' + d)
-            flags, delimiter, name = m.groups()
+            if d is None:
+                continue
+            if isinstance(d, tuple):
+                # Literal, starts a response or continues the previous one
+                if rest:
+                    res[-1].extend(d)
+                else:
+                    res.append(list(d))
+                rest = True
+            elif rest:
+                # Rest of a response after a literal
+                res[-1].append(d)
+                rest = False
+            else:
+                res.append([d])
+        return res
+
+    def parseMailboxes(self, conn, data):
+        """
+            Parses the data returned by a LIST command, mailbox names may be
+            atoms, quoted strings or literals
+
+            @return Returns a list of Mailbox objects
+        """
+        srvtype, srvdescr = self.getServerType(conn)
+        folders = []
+        for parts in self.parseResponses(data):
+            tokens = self.tokenize(parts)
+            if len(tokens) < 3 or not isinstance(tokens[0], list) or tokens[2] is None:
+                raise RuntimeError('Unvalid LIST reply: {}'.format(parts))
+            flags, delimiter, name = tokens[:3]
             folders.append(MailFolder(srvtype, flags, delimiter, name))
         return folders
 
-    def listMessages(self, conn):
+    def parseStatuses(self, data):
+        """
+            Parses STATUS responses
+
+            @return dict mailbox name -> dict item name (uppercase bytes) -> int
+        """
+        res = {}
+        for parts in self.parseResponses(data):
+            tokens = self.tokenize(parts)
+            if len(tokens) < 2 or not isinstance(tokens[1], list):
+                raise RuntimeError('Unvalid STATUS reply: {}'.format(parts))
+            attrs = tokens[1]
+            res[tokens[0]] = { attrs[i].upper(): int(attrs[i+1]) for i in range(0, len(attrs) - 1, 2) }
+        return res
+
+    def getStatuses(self, conn, folders):
+        """
+            Fills in the status of the given folders, when not known yet.
+            STATUS commands are pipelined, STATUS_WINDOW at a time.
+
+            @param folders: list of MailFolder; status is left to None for
+                   folders that can't be queried
+        """
+        todo = [ f for f in folders if f.status is None and f.isSelectable() ]
+        if isinstance(conn, MaildirConnection):
+            for f in todo:
+                f.status = conn.status(f.name)
+            return
+        items = ' '.join(self.getStatusItems(conn)).encode()
+        statuses = {}
+        # Parts of the response being read, names may be literals
+        response = []
+
+        def literal(line, size):
+            response.append(io.BytesIO())
+            return response[-1]
+
+        def untagged(line):
+            if response and not isinstance(response[-1], bytes):
+                response[-1] = response[-1].getvalue()
+            line = line.rstrip(b'\r\n')
+            response.append(line)
+            if self.LITERAL_RE.search(line):
+                return
+            if response[0][:9].upper() == b'* STATUS ':
+                response[0] = response[0][9:]
+                statuses.update(self.parseStatuses([tuple(response)] if len(response) > 1 else response))
+            response.clear()
+
+        tags = []
+        for f in todo:
+            try:
+                name = self.quoteFolderName(f.name, True)
+            except ValueError:
+                continue
+            tags.append(self.sendCommand(conn, b'STATUS ' + name + b' (' + items + b')'))
+            if len(tags) >= self.STATUS_WINDOW:
+                self.readResponse(conn, tags.pop(0), literal, untagged)
+        for tag in tags:
+            self.readResponse(conn, tag, literal, untagged)
+        for f in todo:
+            f.status = statuses.get(f.name)
+
+    def listMessages(self, conn, minuid=None, since=None, before=None, sent=False, maxuid=None):
         """
             List all messages in the given conn and current mailbox.
 
-            @returns a list of message imap identifiers
+            When the server supports ESEARCH (RFC 4731), UIDs are returned as
+            a compact uid-set instead of a list of all of them.
+
+            @param minuid: only list messages with an UID greater or equal than this
+            @param since: only list messages on or after this datetime.date
+            @param before: only list messages before this datetime.date
+            @param sent: when True, filter dates on the Date: header
+                   (SENTSINCE/SENTBEFORE) instead of the INTERNALDATE
+            @param maxuid: only list messages with an UID lower or equal than this
+            @returns a list of message UIDs
+        """
+        criteria = []
+        if minuid or maxuid:
+            criteria += ['UID', '{}:{}'.format(minuid or 1, maxuid or '*')]
+        if since:
+            criteria += ['SENTSINCE' if sent else 'SINCE', self.imapDate(since)]
+        if before:
+            criteria += ['SENTBEFORE' if sent else 'BEFORE', self.imapDate(before)]
+        msgids = self.searchUids(conn, criteria or ['ALL'])
+        if minuid and not maxuid:
+            # n:* always matches the highest UID, even when lower than n
+            msgids = [ i for i in msgids if int(i) >= minuid ]
+        return msgids
+
+    def searchUids(self, conn, criteria):
         """
-        (res, data) = conn.search(None, 'ALL')
+            Runs UID SEARCH in the current mailbox. When the server supports
+            ESEARCH (RFC 4731), UIDs are returned as a compact uid-set.
+
+            @param criteria: list of search keys, i.e. ['UID', '10:*']
+            @returns a list of message UIDs
+        """
+        if self.hasCapability(conn, 'ESEARCH'):
+            (res, data) = conn.uid('SEARCH', 'RETURN', '(ALL)', *criteria)
+            if res != 'OK':
+                raise RuntimeError('Unvalid reply: ' + res)
+            (res, data) = conn.response('ESEARCH')
+            m = self.ESEARCH_ALL_RE.search(data[-1] or b'')
+            return [ b'%d' % i for i in self.parseUidSet(m.group(1)) ] if m else []
+        (res, data) = conn.uid('SEARCH', *criteria)
         if res != 'OK':
             raise RuntimeError('Unvalid reply: ' + res)
-        msgids = data[0].split()
-        return msgids
+        return data[0].split()
+
+    def searchMessageKeys(self, conn, keys, batch=None):
+        """
+            Finds messages in the current mailbox by key, with SEARCH HEADER
+            Message-ID, many Message-IDs ORed in every command. HEADER also
+            matches substrings, so some found messages may have other keys.
+
+            @param keys: list of searchable keys, see MessageIndex.isSearchable()
+            @param batch: max number of Message-IDs in a single SEARCH
+            @return sorted list of message UIDs
+        """
+        mids = sorted(set(k for k in keys if not k.startswith('hash:')))
+        batch = batch or self.SEARCH_BATCH
+        uids = set()
+        for i in range(0, len(mids), batch):
+            part = mids[i:i + batch]
+            criteria = [ 'OR' ] * (len(part) - 1)
+            for mid in part:
+                criteria += [ 'HEADER', 'MESSAGE-ID', '"{}"'.format(mid.replace('\\', '\\\\').replace('"', '\\"')) ]
+            uids.update(self.searchUids(conn, criteria))
+        if len(mids) < len(set(keys)):
+            # Fallback keys: messages without a Message-ID, or with a
+            # blank one. Real ones always have a domain part after an @
+            uids.update(self.searchUids(conn, [ 'NOT', 'HEADER', 'MESSAGE-ID', '"@"' ]))
+        return sorted(uids, key=int)
+
+    def filterByDate(self, conn, ids, since=None, before=None, chunk=None):
+        """
+            Client side version of the date filter in listMessages(), checks
+            the Date: header fetched in bulk. Messages without a valid date
+            are filtered out.
+
+            @return the list of matching message UIDs
+        """
+        headers = self.fetchHeaderFields(conn, ids, ('Date', ), chunk)
+        res = []
+        for i in ids:
+            h = headers.get(i)
+            d = email.utils.parsedate(h['Date']) if h and h['Date'] else None
+            if not d:
+                continue
+            date = datetime.date(d[0], d[1], d[2])
+            if since and date < since:
+                continue
+            if before and date >= before:
+                continue
+            res.append(i)
+        return res
+
+    def imapDate(self, date):
+        """ @return given datetime.date in IMAP format, i.e. 1-Feb-2020 """
+        return '{}-{}-{}'.format(date.day, self.MONTHS[date.month - 1], date.year)
+
+    def getMailboxInfo(self, conn):
+        """
+            Reads the state of the mailbox just selected
+
+            @return dict with EXISTS, UIDVALIDITY, UIDNEXT and HIGHESTMODSEQ
+                    keys (int or None), HIGHESTMODSEQ is only reported when
+                    CONDSTORE is enabled
+        """
+        info = {}
+        for name in ('EXISTS', 'UIDVALIDITY', 'UIDNEXT', 'HIGHESTMODSEQ'):
+            typ, data = conn.response(name)
+            info[name] = int(data[-1]) if data and data[-1] is not None else None
+        return info
 
     def getMessageId(self, conn, imapid):
         """
             returns "Message-ID"
         """
-        (res, data) = conn.fetch(imapid, '(BODY.PEEK[HEADER])')
+        (res, data) = conn.uid('FETCH', imapid, '(BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])')
         if res != 'OK':
             raise RuntimeError('Unvalid reply: ' + res)
-        headers = email.message_from_bytes(data[0][1])
-        return headers['Message-ID']
+        return HeaderFields(data[0][1], ('Message-ID', ))['Message-ID']
+
+    def getSequenceSets(self, ids, chunk=None):
+        """
+            Splits the given UIDs (or sequence numbers) into compact sets
+            (i.e. b'1:500,502'), each one covering at most chunk identifiers.
+
+            @param ids: list of message UIDs, as returned by listMessages()
+            @param chunk: max number of identifiers in a set, defaults to FETCH_CHUNK
+            @return list of bytes sequence sets
+        """
+        if chunk is None:
+            chunk = self.FETCH_CHUNK
+        nums = sorted(set(int(i) for i in ids))
+        sets = []
+        for start in range(0, len(nums), chunk):
+            ranges = []
+            first = last = None
+            for n in nums[start:start+chunk]:
+                if last is not None and n == last + 1:
+                    last = n
+                    continue
+                if first is not None:
+                    ranges.append((first, last))
+                first = last = n
+            ranges.append((first, last))
+            sets.append(b','.join(b'%d' % a if a == b else b'%d:%d' % (a, b) for a, b in ranges))
+        return sets
+
+    def tokenize(self, parts):
+        """
+            Parses an IMAP response into nested lists.
+
+            @param parts: list of bytes; a part ending with a {size} literal
+                   marker must be followed by the literal itself
+            @return nested list; atoms and strings are bytes, NIL is None
+        """
+        root = []
+        stack = [root]
+        parts = list(parts)
+        while parts:
+            part = parts.pop(0)
+            lm = self.LITERAL_RE.search(part)
+            if lm:
+                part = part[:lm.start()]
+            i = 0
+            while i < len(part):
+                c = part[i:i+1]
+                if c == b' ':
+                    i += 1
+                elif c == b'(':
+                    stack[-1].append([])
+                    stack.append(stack[-1][-1])
+                    i += 1
+                elif c == b')':
+                    if len(stack) < 2:
+                        raise RuntimeError('Unbalanced response: {}'.format(part))
+                    stack.pop()
+                    i += 1
+                elif c == b'"':
+                    i += 1
+                    val = bytearray()
+                    while i < len(part) and part[i:i+1] != b'"':
+                        if part[i:i+1] == b'\\':
+                            i += 1
+                        val += part[i:i+1]
+                        i += 1
+                    i += 1
+                    stack[-1].append(bytes(val))
+                else:
+                    # Atom, may contain a [section] with spaces
+                    j = i
+                    depth = 0
+                    while j < len(part):
+                        cj = part[j:j+1]
+                        if cj == b'[':
+                            depth += 1
+                        elif cj == b']':
+                            depth -= 1
+                        elif depth == 0 and cj in (b' ', b'(', b')'):
+                            break
+                        j += 1
+                    atom = part[i:j]
+                    stack[-1].append(None if atom.upper() == b'NIL' else atom)
+                    i = j
+            if lm:
+                stack[-1].append(parts.pop(0))
+        return root
+
+    def parseFetch(self, data):
+        """
+            Parses the data returned by an imaplib FETCH command
+
+            @return dict sequence number -> dict item name (uppercase bytes) -> value
+        """
+        msgs = []
+        for d in data:
+            if d is None:
+                continue
+            if isinstance(d, tuple):
+                head, tail = d[0], [d[0], d[1]]
+            else:
+                head, tail = d, [d]
+            if self.FETCH_RE.match(head):
+                msgs.append(tail)
+            elif msgs:
+                msgs[-1].extend(tail)
+            else:
+                raise RuntimeError('Unvalid FETCH reply: {}'.format(head))
+        res = {}
+        for parts in msgs:
+            tokens = self.tokenize(parts)
+            if len(tokens) < 2 or not isinstance(tokens[1], list):
+                raise RuntimeError('Unvalid FETCH reply: {}'.format(parts[0]))
+            items = res.setdefault(tokens[0], {})
+            attrs = tokens[1]
+            for i in range(0, len(attrs) - 1, 2):
+                items[attrs[i].upper()] = attrs[i+1]
+        return res
+
+    def getSection(self, items, prefix=b'BODY['):
+        """ @return the value of the first fetched item starting with prefix """
+        for name, value in items.items():
+            if name.startswith(prefix):
+                return value
+        return None
+
+    def fetchBulk(self, conn, ids, items, chunk=None, progress=None):
+        """
+            Fetches the given items for many messages at once, using one FETCH
+            command for every chunk of messages.
+
+            @param ids: list of message UIDs
+            @param items: list of fetch items, i.e. ['RFC822.SIZE', 'FLAGS']
+            @param chunk: max number of messages for a single FETCH
+            @param progress: optional callable, called after every chunk
+            @return dict UID -> dict item name -> value, see parseFetch()
+        """
+        res = {}
+        for uid, attrs in self.iterFetch(conn, ids, items, chunk, progress):
+            res[uid] = attrs
+        return res
+
+    def iterFetch(self, conn, ids, items, chunk=None, progress=None):
+        """
+            Like fetchBulk(), but yields results chunk by chunk instead of
+            keeping them all in memory
+
+            @return generator of (UID, dict item name -> value) tuples
+        """
+        query = '(' + ' '.join(items) + ')'
+        for seqset in self.getSequenceSets(ids, chunk):
+            (typ, data) = conn.uid('FETCH', seqset, query)
+            if typ != 'OK':
+                raise RuntimeError('Unvalid reply: ' + typ)
+            for seq, attrs in self.parseFetch(data).items():
+                if b'UID' in attrs:
+                    yield attrs[b'UID'], attrs
+            if progress:
+                progress()
+
+    def fetchHeaderFields(self, conn, ids, fields, chunk=None, progress=None):
+        """
+            Fetches the given header fields for many messages at once
+
+            @param ids: list of message UIDs
+            @param fields: list of header field names
+            @return dict UID -> HeaderFields
+        """
+        item = 'BODY.PEEK[HEADER.FIELDS ({})]'.format(' '.join(fields).upper())
+        res = self.fetchBulk(conn, ids, [item], chunk, progress)
+        return { i: HeaderFields(self.getSection(d) or b'', fields) for i, d in res.items() }
+
+    def getMessageIds(self, conn, ids, chunk=None, progress=None):
+        """
+            Bulk version of getMessageId()
+
+            @param ids: list of message UIDs
+            @param chunk: max number of messages for a single FETCH
+            @param progress: optional callable, called after every chunk
+            @return dict UID -> "Message-ID"
+        """
+        headers = self.fetchHeaderFields(conn, ids, ('Message-ID', 'Date'), chunk, progress)
+        return { i: headers[i]['Message-ID'] if i in headers else None for i in ids }
+
+    def getMessageKeys(self, conn, ids, chunk=None, progress=None):
+        """
+            Like getMessageIds(), but messages without a Message-ID get a
+            fallback key, see MessageIndex.getKey()
+
+            @return dict UID -> MessageIndex key
+        """
+        res = self.fetchBulk(conn, ids, self.KEY_ITEMS, chunk, progress)
+        return self.parseMessageKeys(res, ids)
+
+    def getFingerprints(self, conn, ids, chunk=None, progress=None):
+        """
+            Computes content fingerprints of many messages, downloading them.
+            Small messages are fetched in bulk, up to APPEND_BATCH_BYTES at a
+            time, big ones are streamed through a spool file.
+
+            @return dict UID -> fingerprint, see MessageIndex.getFingerprint()
+        """
+        sizes = self.fetchBulk(conn, ids, ('RFC822.SIZE', ), chunk)
+        res = {}
+
+        def flush(batch):
+            for uid, attrs in self.fetchBulk(conn, batch, ('BODY.PEEK[]', )).items():
+                data = self.getSection(attrs) or b''
+                res[uid] = MessageIndex.getFingerprint(io.BytesIO(data))
+            if progress:
+                progress()
+
+        batch = []
+        total = 0
+        for uid in ids:
+            size = int(sizes.get(uid, {}).get(b'RFC822.SIZE') or 0)
+            if size > self.SPOOL_THRESHOLD:
+                msg = self.fetchToFile(conn, uid)
+                if msg:
+                    with msg[0] as fp:
+                        res[uid] = MessageIndex.getFingerprint(fp, self.STREAM_BLOCK)
+                continue
+            batch.append(uid)
+            total += size
+            if len(batch) >= (chunk or self.FETCH_CHUNK) or total >= self.APPEND_BATCH_BYTES:
+                flush(batch)
+                batch = []
+                total = 0
+        if batch:
+            flush(batch)
+        return res
+
+    def parseMessageKeys(self, res, ids):
+        """
+            @param res: fetched KEY_ITEMS, see fetchBulk()
+            @return dict UID -> MessageIndex key
+        """
+        keys = {}
+        for i in ids:
+            d = res.get(i, {})
+            headers = HeaderFields(self.getSection(d) or b'', MessageIndex.KEY_FIELDS)
+            size = d.get(b'RFC822.SIZE')
+            keys[i] = MessageIndex.getKey(headers, int(size) if size else None)
+        return keys
+
+    def parseSizes(self, res):
+        """
+            @param res: fetched RFC822.SIZE, see fetchBulk()
+            @return dict UID -> size
+        """
+        return { uid: int(d[b'RFC822.SIZE']) for uid, d in res.items() if d.get(b'RFC822.SIZE') }
+
+    def parseMessageMeta(self, res):
+        """
+            @param res: fetched META_ITEMS, see fetchBulk()
+            @return dict UID -> (flags, date), bytes to pass to appendFiles()
+        """
+        meta = {}
+        for uid, d in res.items():
+            flags = self.formatFlags(d.get(b'FLAGS') or ())
+            meta[uid] = (flags or None, d.get(b'INTERNALDATE'))
+        return meta
+
+    def formatFlags(self, flags):
+        """
+            @param flags: list of fetched flags
+            @return bytes flag list, without \\Recent that can't be set
+        """
+        return b' '.join(sorted(f for f in flags if f.upper() != b'\\RECENT'))
+
+    def getFlags(self, conn, ids=None, since=None, chunk=None):
+        """
+            Fetches the flags of many messages at once
+
+            @param ids: list of message UIDs, when since is None
+            @param since: a MODSEQ, only get the flags of all messages changed
+                   after it, with CHANGEDSINCE (RFC 7162)
+            @return dict UID -> bytes flag list, see formatFlags()
+        """
+        if since is None:
+            res = self.fetchBulk(conn, ids, ['FLAGS'], chunk)
+        else:
+            (typ, data) = conn.uid('FETCH', '1:*', '(FLAGS)', '(CHANGEDSINCE {})'.format(since))
+            if typ != 'OK':
+                raise RuntimeError('Unvalid reply: ' + typ)
+            res = { d[b'UID']: d for d in self.parseFetch(data).values() if b'UID' in d }
+        return { uid: self.formatFlags(d.get(b'FLAGS') or ()) for uid, d in res.items() }
+
+    def storeFlags(self, conn, flags, chunk=None):
+        """
+            Replaces the flags of many messages, using one STORE command for
+            every distinct flag list and chunk of messages
+
+            @param flags: dict UID -> bytes flag list
+        """
+        groups = {}
+        for uid, f in flags.items():
+            groups.setdefault(f, []).append(uid)
+        for f, uids in groups.items():
+            for seqset in self.getSequenceSets(uids, chunk):
+                (typ, data) = conn.uid('STORE', seqset, 'FLAGS.SILENT', b'(' + f + b')')
+                if typ != 'OK':
+                    raise RuntimeError('Unvalid reply: ' + typ)
+
+    def copyOnServer(self, conn, ids, mailbox, chunk=None):
+        """
+            Copies messages from the selected mailbox into another mailbox
+            of the same server with UID COPY, so data never leaves the server.
+            Flags and INTERNALDATE are preserved by the server.
+
+            @param ids: list of message UIDs
+            @param mailbox: bytes destination mailbox name
+            @param chunk: max number of messages for a single COPY
+        """
+        for seqset in self.getSequenceSets(ids, chunk):
+            (res, data) = conn.uid('COPY', seqset, self.quoteFolderName(mailbox))
+            if res != 'OK':
+                raise RuntimeError('Unvalid reply: {} {}'.format(res, data))
+
+    def getEnvelopeAddresses(self, envelope, fields=None):
+        """
+            Extracts the addresses from a parsed ENVELOPE
+
+            @param envelope: the ENVELOPE list, as returned by parseFetch()
+            @param fields: list of address fields to read, from ENVELOPE_FIELDS,
+                   defaults to all of them
+            @return list of (field, name, address) tuples; name is decoded
+                    from RFC 2047 and may be empty, address is lowercase
+        """
+        res = []
+        for idx, field in enumerate(self.ENVELOPE_FIELDS):
+            if fields is not None and field not in fields:
+                continue
+            addrs = envelope[idx + 2] if len(envelope) > idx + 2 else None
+            for addr in addrs or []:
+                # Group markers have a NIL host
+                if not isinstance(addr, list) or len(addr) < 4 or not addr[2] or not addr[3]:
+                    continue
+                address = (addr[2] + b'@' + addr[3]).decode('ascii', 'replace').lower()
+                name = ''
+                if addr[0]:
+                    try:
+                        name = str(email.header.make_header(email.header.decode_header(
+                                addr[0].decode('utf-8', 'replace'))))
+                    except (ValueError, LookupError):
+                        name = addr[0].decode('utf-8', 'replace')
+                res.append((field, name, address))
+        return res
 
     def getMessage(self, conn, imapid):
         """
             returns full RFC822 message
         """
-        (res, data) = conn.fetch(imapid, '(RFC822)')
+        (res, data) = conn.uid('FETCH', imapid, '(RFC822)')
         if res != 'OK':
             raise RuntimeError('Unvalid reply: ' + res)
         return data[0][1]
 
-    def getHeaders(self, conn, imapid):
+    def sendCommand(self, conn, command):
+        """
+            Sends a raw command on an imaplib connection, bypassing imaplib
+            buffering of responses
+
+            @param command: bytes command, without tag and CRLF
+            @return the command tag
+        """
+        tag = conn._new_tag()
+        conn.send(tag + b' ' + command + b'\r\n')
+        return tag
+
+    def readResponse(self, conn, tag, literal=None, untagged=None):
+        """
+            Reads responses to a command sent by sendCommand(), until its
+            tagged completion or a continuation request. Literals are read in
+            blocks of STREAM_BLOCK bytes.
+
+            @param literal: optional callable(line, size), returning a file
+                   object to write the literal announced by line to, or None
+                   to discard it
+            @param untagged: optional callable(line), called with every
+                   line but the tagged completion, i.e. untagged responses
+                   and their rest after a literal
+            @return tuple (type, text): type is '+' for a continuation request
+        """
+        while True:
+            line = conn.readline()
+            if not line:
+                raise conn.abort('socket error: EOF')
+            if line.startswith(tag + b' '):
+                typ, _, text = line[len(tag)+1:].rstrip(b'\r\n').partition(b' ')
+                del conn.tagged_commands[tag]
+                return typ.decode().upper(), text
+            if line.startswith(b'+'):
+                return '+', line[1:].strip()
+            if line.startswith(b'* BYE'):
+                raise conn.abort(line.decode(errors='replace').strip())
+            if untagged:
+                untagged(line)
+            m = self.LITERAL_RE.search(line.rstrip(b'\r\n'))
+            if m:
+                size = int(m.group('size'))
+                out = literal(line, size) if literal else None
+                while size > 0:
+                    block = conn.read(min(size, self.STREAM_BLOCK))
+                    if not block:
+                        raise conn.abort('socket error: EOF')
+                    if out is not None:
+                        out.write(block)
+                    size -= len(block)
+
+    def fetchToFile(self, conn, imapid, threshold=None):
+        """
+            Streams a full RFC822 message into a temporary file, without
+            ever holding it entirely in memory
+
+            @param threshold: messages bigger than this are spooled on disk,
+                   defaults to SPOOL_THRESHOLD
+            @return tuple (file, size), file is positioned at the start;
+                    None when the message does not exist
+        """
+        if threshold is None:
+            threshold = self.SPOOL_THRESHOLD
+        if isinstance(conn, MaildirConnection):
+            return conn.fetchFile(imapid, threshold)
+        found = []
+        def literal(line, size):
+            if not self.BODY_RE.search(line):
+                return None
+            fp = tempfile.SpooledTemporaryFile(max_size=threshold)
+            found.append((fp, size))
+            return fp
+        tag = self.sendCommand(conn, b'UID FETCH ' + imapid + b' (BODY.PEEK[])')
+        typ, text = self.readResponse(conn, tag, literal)
+        if typ != 'OK':
+            for fp, size in found:
+                fp.close()
+            raise RuntimeError('Unvalid reply: {} {}'.format(typ, text))
+        if not found:
+            return None
+        fp, size = found[0]
+        fp.seek(0)
+        return fp, size
+
+    def idle(self, conn, untagged, timeout=None):
+        """
+            Waits for untagged responses with IDLE (RFC 2177), until timeout
+            expires. Files of imaplib connections can't be read with a
+            timeout, so IDLE is ended by a timer thread sending DONE.
+
+            @param untagged: callable(line), called with every untagged
+                   response, i.e. b'* 12 EXISTS\r\n'
+            @param timeout: seconds to wait, defaults to IDLE_TIMEOUT
+        """
+        tag = self.sendCommand(conn, b'IDLE')
+        typ, text = self.readResponse(conn, tag, untagged=untagged)
+        if typ != '+':
+            raise RuntimeError('Unvalid reply: {} {}'.format(typ, text.decode(errors='replace')))
+        lock = threading.Lock()
+        idling = [ True ]
+
+        def done():
+            with lock:
+                if idling[0]:
+                    idling[0] = False
+                    conn.send(b'DONE\r\n')
+
+        timer = threading.Timer(timeout or self.IDLE_TIMEOUT, done)
+        timer.daemon = True
+        timer.start()
+        try:
+            typ, text = self.readResponse(conn, tag, untagged=untagged)
+        finally:
+            # The server may end IDLE by itself
+            with lock:
+                idling[0] = False
+            timer.cancel()
+        if typ != 'OK':
+            raise RuntimeError('Unvalid reply: {} {}'.format(typ, text.decode(errors='replace')))
+
+    def hasCapability(self, conn, name):
+        """ @return True if the server advertised the given capability """
+        return name.upper() in conn.capabilities
+
+    def sendLiteral(self, conn, fp, trailer=b''):
+        """ Sends the content of a file object, followed by trailer """
+        # The trailer goes out along with the last block, so small trailing
+        # writes do not get delayed by Nagle's algorithm
+        block = fp.read(self.STREAM_BLOCK)
+        while True:
+            nextblock = fp.read(self.STREAM_BLOCK)
+            if not nextblock:
+                conn.send(block + trailer)
+                break
+            conn.send(block)
+            block = nextblock
+
+    def appendFiles(self, conn, mailbox, messages):
+        """
+            Appends many messages to a mailbox, streaming them from file objects.
+
+            When the server supports MULTIAPPEND (RFC 3502), all messages are
+            sent in a single command; when it supports LITERAL+ (RFC 7888),
+            literals are sent without waiting for continuation requests and
+            multiple APPEND commands are pipelined.
+
+            @param mailbox: bytes mailbox name
+            @param messages: list of tuples (file, size, flags, date), flags
+                   and date are optional bytes, i.e. b'\\Seen \\Flagged'
+                   and an INTERNALDATE
+            @return list of (UIDVALIDITY, UID) of the appended messages, when
+                    reported by the server with APPENDUID (RFC 4315), or None
         """
-            Returns message headers
+        if isinstance(conn, MaildirConnection):
+            return conn.appendFiles(mailbox, messages)
+        multi = self.hasCapability(conn, 'MULTIAPPEND')
+        plus = self.hasCapability(conn, 'LITERAL+')
+        mailbox = self.quoteFolderName(mailbox)
+
+        def header(flags, date, size):
+            h = b''
+            if flags:
+                h += b' (' + flags + b')'
+            if date:
+                h += b' "' + date + b'"'
+            return h + (b' {%d+}' % size if plus else b' {%d}' % size)
+
+        def waitContinuation(tag):
+            typ, text = self.readResponse(conn, tag)
+            if typ != '+':
+                raise RuntimeError('Unvalid reply: {} {}'.format(typ, text))
+
+        appended = []
+
+        def waitCompletion(tag):
+            typ, text = self.readResponse(conn, tag)
+            if typ != 'OK':
+                raise RuntimeError('Unvalid reply: {} {}'.format(typ, text))
+            m = self.APPENDUID_RE.search(text)
+            if m:
+                appended.extend((int(m.group('uidvalidity')), uid) for uid in self.parseUidSet(m.group('uids')))
+
+        if multi and len(messages) > 1:
+            tag = None
+            for idx, (fp, size, flags, date) in enumerate(messages):
+                h = header(flags, date, size)
+                if tag is None:
+                    tag = self.sendCommand(conn, b'APPEND ' + mailbox + h)
+                else:
+                    conn.send(h + b'\r\n')
+                if not plus:
+                    waitContinuation(tag)
+                self.sendLiteral(conn, fp, b'\r\n' if idx == len(messages) - 1 else b'')
+            waitCompletion(tag)
+        elif plus:
+            tags = []
+            for fp, size, flags, date in messages:
+                tags.append(self.sendCommand(conn, b'APPEND ' + mailbox + header(flags, date, size)))
+                self.sendLiteral(conn, fp, b'\r\n')
+            for tag in tags:
+                waitCompletion(tag)
+        else:
+            for fp, size, flags, date in messages:
+                tag = self.sendCommand(conn, b'APPEND ' + mailbox + header(flags, date, size))
+                waitContinuation(tag)
+                self.sendLiteral(conn, fp, b'\r\n')
+                waitCompletion(tag)
+        return appended if len(appended) == len(messages) else None
+
+    def parseUidSet(self, uidset):
+        """ @return list of UIDs in a bytes uid-set, i.e. b'4,7:9' """
+        uids = []
+        for item in uidset.split(b','):
+            first, _, last = item.partition(b':')
+            first = int(first)
+            last = int(last) if last else first
+            uids.extend(range(min(first, last), max(first, last) + 1))
+        return uids
+
+    def appendFile(self, conn, mailbox, fp, size, flags=None, date=None):
+        """
+            Appends a message to a mailbox, streaming it from a file object
+
+            @param mailbox: bytes mailbox name
+            @param size: the message size
+            @param flags: optional bytes flag list, i.e. b'\\Seen \\Flagged'
+            @param date: optional bytes INTERNALDATE
+        """
+        self.appendFiles(conn, mailbox, [(fp, size, flags, date)])
+
+    def copyMessage(self, srcconn, dstconn, imapid, mailbox, threshold=None):
+        """
+            Copies a message from the source selected mailbox into the given
+            destination mailbox, streaming it through a spool file
+
+            @param threshold: messages bigger than this are spooled on disk
+            @return the message size or None when it does not exist anymore
+        """
+        res = self.fetchToFile(srcconn, imapid, threshold)
+        if res is None:
+            return None
+        fp, size = res
+        with fp:
+            self.appendFile(dstconn, mailbox, fp, size)
+        return size
+
+    def copyMessages(self, srcconn, dstconn, ids, mailbox, threshold=None, batch=None, progress=None,
+            accept=None, meta=None, sizes=None):
+        """
+            Copies many messages from the source selected mailbox into the
+            given destination mailbox.
+
+            Messages are fetched from source in the calling thread while a
+            second thread appends them to destination in batches, see
+            appendFiles(), so the two servers work at the same time.
+
+            When sizes are known, small messages are copied first, fetched in
+            bulk a batch at a time, then big ones are streamed one by one.
+
+            @param threshold: messages bigger than this are spooled on disk
+            @param batch: max number of messages appended by a single command,
+                   defaults to APPEND_BATCH
+            @param progress: optional callable(uids, size, appended), called
+                   from the append thread after every appended batch, see
+                   appendFiles() for appended
+            @param accept: optional callable(uid, file, size), called after
+                   every download, returning False when the message must not
+                   be copied after all; file must be rewound when read
+            @param meta: optional dict UID -> (flags, date) to preserve, see
+                   parseMessageMeta()
+            @param sizes: optional dict UID -> size, see parseSizes()
+            @return list of copied UIDs (missing ones are skipped)
+        """
+        if batch is None:
+            batch = self.APPEND_BATCH
+        if threshold is None:
+            threshold = self.SPOOL_THRESHOLD
+        pending = queue.Queue(maxsize=batch * 2)
+        errors = []
+
+        def flush(messages):
+            try:
+                if not errors:
+                    appended = self.appendFiles(dstconn, mailbox, [ m[:4] for m in messages ])
+                    if progress:
+                        progress([ m[4] for m in messages ], sum(m[1] for m in messages), appended)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                for m in messages:
+                    m[0].close()
+
+        def consumer():
+            messages = []
+            total = 0
+            while True:
+                item = pending.get()
+                if item is not None:
+                    messages.append(item)
+                    total += item[1]
+                # Send when the batch is full or there is nothing else ready
+                if messages and (item is None or len(messages) >= batch
+                        or total >= self.APPEND_BATCH_BYTES or pending.empty()):
+                    flush(messages)
+                    messages = []
+                    total = 0
+                if item is None:
+                    return
+
+        def fetchSmall(uids):
+            res = self.fetchBulk(srcconn, uids, ('BODY.PEEK[]', ))
+            for uid in uids:
+                data = self.getSection(res.get(uid, {}))
+                if data is not None:
+                    yield uid, io.BytesIO(data), len(data)
+
+        def fetched():
+            small = [ i for i in ids if sizes and sizes.get(i, threshold + 1) <= threshold ]
+            uids = []
+            total = 0
+            for imapid in small:
+                uids.append(imapid)
+                total += sizes[imapid]
+                if len(uids) >= batch or total >= self.APPEND_BATCH_BYTES:
+                    yield from fetchSmall(uids)
+                    uids = []
+                    total = 0
+            if uids:
+                yield from fetchSmall(uids)
+            small = set(small)
+            for imapid in ids:
+                if imapid not in small:
+                    res = self.fetchToFile(srcconn, imapid, threshold)
+                    if res is not None:
+                        yield (imapid, ) + res
+
+        thread = threading.Thread(target=consumer, name='append')
+        thread.start()
+        copied = []
+        try:
+            for imapid, fp, size in fetched():
+                if errors:
+                    fp.close()
+                    break
+                if accept and not accept(imapid, fp, size):
+                    fp.close()
+                    continue
+                flags, date = meta.get(imapid, (None, None)) if meta else (None, None)
+                pending.put((fp, size, flags, date, imapid))
+                copied.append(imapid)
+        finally:
+            pending.put(None)
+            thread.join()
+        if errors:
+            raise errors[0]
+        return copied
+
+    def getHeaders(self, conn, imapid, fields=None):
         """
-        (res, data) = conn.fetch(imapid, '(BODY[HEADER])')
+            Returns message headers, without setting the \\Seen flag
+
+            @param fields: names of the fields to get, all when None
+            @return HeaderFields
+        """
+        if fields:
+            item = '(BODY.PEEK[HEADER.FIELDS ({})])'.format(' '.join(fields).upper())
+        else:
+            item = '(BODY.PEEK[HEADER])'
+        (res, data) = conn.uid('FETCH', imapid, item)
         if res != 'OK':
             raise RuntimeError('Unvalid reply: ' + res)
-        parser = email.parser.HeaderParser()
-        return parser.parsestr(data[0][1])
+        return HeaderFields(data[0][1], fields)
 
     def getServerType(self, conn):
-        """ Try to guess IMAP server type
+        """ Try to guess IMAP server type, the result is cached in conn.serverType
         @return tuple (type, descr) Type is one of: unknown, exchange, dovecot
         """
-        regs = {
-            self.TYPE_EXCHANGE: re.compile(b'^.*Microsoft Exchange.*$', re.I),
-            self.TYPE_DOVECOT: re.compile(b'^.*(imapfront|dovecot).*$', re.I),
-            self.TYPE_COURIER: re.compile(b'^.*Courier.*$', re.I),
-        }
-        descr = {
-            self.TYPE_EXCHANGE: 'MS Exchange',
-            self.TYPE_DOVECOT: 'Dovecot',
-            self.TYPE_COURIER: 'Courier',
-        }
-        for r in regs.keys():
-            if regs[r].match(conn.welcome):
-                return ( r, descr[r] )
-        return ( self.TYPE_UNKNOWN, 'Unknown ({})'.format(conn.welcome.decode()) )
+        cached = getattr(conn, 'serverType', None)
+        if cached:
+            return cached
+        conn.serverType = ( self.TYPE_UNKNOWN, 'Unknown ({})'.format(conn.welcome.decode(errors='replace')) )
+        for srvtype, reg, descr in self.SERVER_TYPES:
+            if reg.search(conn.welcome):
+                conn.serverType = ( srvtype, descr )
+                break
+        return conn.serverType
 
     def translateFolderName(self, folder, srcformat, dstformat):
         """ Translates folder name from src server format do dst server format """
@@ -219,19 +1607,15 @@ class ImapUtil:
         # All chars must be 0-127, excluding CR and LF
         mustQuote = False
         for char in folder:
-            if char <= 0x00 or char == 0x10 or char == 0x13 or char > 0x7f:
-                raise ValueError('Folder name must not contain invalid chars, found "{}" ({})'.format(chr(char), ichar))
+            if char <= 0x00 or char == 0x0a or char == 0x0d or char > 0x7f:
+                raise ValueError('Folder name must not contain invalid chars, found "{}" ({})'.format(chr(char), char))
 
             if char.to_bytes(1, 'big') in self.ATOM_SPECIALS:
                 mustQuote = True
 
-        if b'"' in folder:
-            # Looks like escaping is not even supported by the protocol?
-            # Should probably use the literal form instead, see
-            # https://tools.ietf.org/html/rfc3501#section-4.3
-            raise NotImplementedError('Escaping is not supported')
-
         if alwaysQuote or mustQuote:
-            return rb'"%s"' % folder
+            # Quoted strings escape quotes and backslashes, see
+            # https://tools.ietf.org/html/rfc3501#section-4.3
+            return rb'"%s"' % folder.replace(b'\\', b'\\\\').replace(b'"', b'\\"')
 
         return folder
@@ -0,0 +1,494 @@
+#!/usr/bin/env python3
+# kate: space-indent on; tab-indent off;
+
+""" @package docstring
+Local Store
+
+Local Maildir endpoint for imapcp: a Maildir++ tree used as source or
+destination in place of an IMAP account, to export messages once and import
+them many times, or to sync with no network at all.
+
+MaildirConnection provides the subset of the imaplib.IMAP4 interface used by
+ImapUtil (LIST, SELECT, CREATE, UID SEARCH/FETCH/STORE/COPY), so the sync logic
+does not change; ImapUtil helpers speaking raw IMAP hand over to it instead.
+
+The root directory is INBOX, every other folder is a ".Name.Sub" directory in
+it, like Dovecot and Courier do. Maildir has no UIDs: they are assigned when a
+message is first seen, and kept, with the message size in IMAP (CRLF) format,
+in an UIDLIST_FILE inside every folder.
+
+@author Gabriele Tozzi <gabriele@tozzi.eu>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import re
+import time
+import shutil
+import socket
+import imaplib
+import datetime
+import tempfile
+import email.utils
+import itertools
+
+
+class MaildirFolder:
+    """ A Maildir folder, with IMAP-like UIDs """
+
+    # UIDs and sizes of the messages, see load()
+    UIDLIST_FILE = b'imapcp-uidlist'
+    UIDLIST_VERSION = b'1'
+
+    # Maildir info flags <-> IMAP flags
+    FLAGS = {
+        b'D': b'\\Draft',
+        b'F': b'\\Flagged',
+        b'P': b'$Forwarded',
+        b'R': b'\\Answered',
+        b'S': b'\\Seen',
+        b'T': b'\\Deleted',
+    }
+
+    # Size in CRLF format, added to file names by Dovecot
+    SIZE_RE = re.compile(rb',W=(\d+)')
+
+    # Unique part of new file names
+    counter = itertools.count()
+
+    def __init__(self, path):
+        """ @param path: bytes path of the folder, containing cur, new and tmp """
+        self.path = path
+        self.uidvalidity = None
+        self.uidnext = 1
+        # UID -> [ key, size ], sorted by UID
+        self.messages = {}
+        # key -> file name, relative to path
+        self.files = {}
+
+    @classmethod
+    def create(cls, path, subfolder=True):
+        """ Creates the folder directories, when missing """
+        for sub in (b'cur', b'new', b'tmp'):
+            os.makedirs(os.path.join(path, sub), exist_ok=True)
+        if subfolder:
+            open(os.path.join(path, b'maildirfolder'), 'ab').close()
+
+    def load(self):
+        """
+            Scans the folder, assigning UIDs to new messages and forgetting
+            the removed ones; the UID list is saved when changed
+        """
+        self.files = {}
+        for sub in (b'new', b'cur'):
+            for name in os.listdir(os.path.join(self.path, sub)):
+                if not name.startswith(b'.'):
+                    self.files[name.split(b':', 1)[0]] = os.path.join(sub, name)
+
+        changed = False
+        self.messages = {}
+        try:
+            with open(os.path.join(self.path, self.UIDLIST_FILE), 'rb') as f:
+                header = f.readline().split()
+                if len(header) == 3 and header[0] == self.UIDLIST_VERSION:
+                    self.uidvalidity = int(header[1])
+                    self.uidnext = int(header[2])
+                    for line in f:
+                        uid, size, key = line.split()
+                        if key in self.files:
+                            self.messages[int(uid)] = [ key, int(size) ]
+                        else:
+                            changed = True
+        except FileNotFoundError:
+            pass
+        if not self.uidvalidity:
+            self.uidvalidity = int(time.time())
+            self.uidnext = 1
+            changed = True
+
+        known = set(k for k, s in self.messages.values())
+        new = [ k for k in self.files if k not in known ]
+        new.sort(key=lambda k: (os.stat(self.getPath(k)).st_mtime, k))
+        for key in new:
+            self.messages[self.uidnext] = [ key, self.getSize(key) ]
+            self.uidnext += 1
+            changed = True
+        if changed:
+            self.save()
+
+    def save(self):
+        """ Saves the UID list; a read-only folder just gets new UIDs next time """
+        tmp = os.path.join(self.path, self.UIDLIST_FILE + b'.tmp')
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(b'%s %d %d\n' % (self.UIDLIST_VERSION, self.uidvalidity, self.uidnext))
+                for uid, (key, size) in self.messages.items():
+                    f.write(b'%d %d %s\n' % (uid, size, key))
+            os.replace(tmp, os.path.join(self.path, self.UIDLIST_FILE))
+        except OSError:
+            pass
+
+    def getPath(self, key):
+        return os.path.join(self.path, self.files[key])
+
+    def getSize(self, key):
+        """ @return the message size, with CRLF line endings """
+        m = self.SIZE_RE.search(self.files[key])
+        if m:
+            return int(m.group(1))
+        size = 0
+        with open(self.getPath(key), 'rb') as f:
+            for line in f:
+                size += len(line) + (1 if line.endswith(b'\n') and not line.endswith(b'\r\n') else 0)
+        return size
+
+    def read(self, uid):
+        """ @return the message, with CRLF line endings """
+        with open(self.getPath(self.messages[uid][0]), 'rb') as f:
+            data = f.read()
+        if data.count(b'\n') != data.count(b'\r\n'):
+            data = re.sub(rb'\r?\n', b'\r\n', data)
+        return data
+
+    def readHeader(self, uid):
+        """ @return the header block of a message, including the empty line """
+        lines = []
+        with open(self.getPath(self.messages[uid][0]), 'rb') as f:
+            for line in f:
+                line = line.rstrip(b'\r\n') + b'\r\n'
+                lines.append(line)
+                if line == b'\r\n':
+                    break
+        return b''.join(lines)
+
+    def open(self, uid, threshold):
+        """ @return tuple (file, size) with CRLF line endings, see ImapUtil.fetchToFile() """
+        key, size = self.messages[uid]
+        fp = tempfile.SpooledTemporaryFile(max_size=threshold)
+        with open(self.getPath(key), 'rb') as f:
+            for line in f:
+                fp.write(line.rstrip(b'\r\n') + b'\r\n' if line.endswith(b'\n') else line)
+        fp.seek(0)
+        return fp, size
+
+    def getFlags(self, uid):
+        """ @return list of IMAP flags """
+        name = self.files[self.messages[uid][0]]
+        info = name.split(b':2,', 1)[1] if b':2,' in name else b''
+        return [ self.FLAGS[c] for c in (bytes([c]) for c in info) if c in self.FLAGS ]
+
+    def getInfo(self, flags):
+        """ @return the Maildir info for a list of IMAP flags """
+        chars = { f.upper(): c for c, f in self.FLAGS.items() }
+        return b':2,' + b''.join(sorted(chars[f.upper()] for f in flags if f.upper() in chars))
+
+    def getInternalDate(self, uid):
+        """ @return the INTERNALDATE, without quotes, i.e. b'17-Jul-1996 02:44:25 +0000' """
+        return imaplib.Time2Internaldate(os.stat(self.getPath(self.messages[uid][0])).st_mtime).strip('"').encode()
+
+    def getDate(self, uid):
+        """ @return the INTERNALDATE, as a datetime.date """
+        return datetime.date.fromtimestamp(os.stat(self.getPath(self.messages[uid][0])).st_mtime)
+
+    def setFlags(self, uid, flags):
+        key = self.messages[uid][0]
+        name = os.path.join(b'cur', key + self.getInfo(flags))
+        if name != self.files[key]:
+            os.rename(os.path.join(self.path, self.files[key]), os.path.join(self.path, name))
+            self.files[key] = name
+
+    def newKey(self):
+        """ @return an unique file name, see https://cr.yp.to/proto/maildir.html """
+        return b'%d.P%dQ%d.%s' % (time.time(), os.getpid(), next(self.counter),
+                socket.gethostname().replace('/', '\\057').replace(':', '\\072').encode())
+
+    def add(self, messages):
+        """
+            Adds messages: all files are written to tmp, then synced and
+            moved to cur together
+
+            @param messages: list of tuples (file, size, flags, date) or
+                   (bytes, size, flags, date), see ImapUtil.appendFiles()
+            @return list of the new UIDs
+        """
+        written = []
+        try:
+            for data, size, flags, date in messages:
+                key = self.newKey()
+                tmp = os.path.join(self.path, b'tmp', key)
+                f = open(tmp, 'wb')
+                written.append((key, tmp, f, flags, date))
+                if isinstance(data, bytes):
+                    f.write(data)
+                else:
+                    shutil.copyfileobj(data, f)
+            uids = []
+            for key, tmp, f, flags, date in written:
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+                f.close()
+                if date:
+                    when = datetime.datetime.strptime(date.decode().strip(), '%d-%b-%Y %H:%M:%S %z').timestamp()
+                    os.utime(tmp, (when, when))
+                name = os.path.join(b'cur', key + self.getInfo((flags or b'').split()))
+                os.rename(tmp, os.path.join(self.path, name))
+                self.files[key] = name
+                self.messages[self.uidnext] = [ key, size ]
+                uids.append(self.uidnext)
+                self.uidnext += 1
+        finally:
+            for key, tmp, f, flags, date in written:
+                if not f.closed:
+                    f.close()
+                    os.unlink(tmp)
+        self.save()
+        return uids
+
+
+class MaildirConnection:
+    """ A Maildir++ tree, looking like an imaplib.IMAP4 connection """
+
+    welcome = b'* OK Local Maildir'
+    capabilities = ('IMAP4REV1', 'UIDPLUS', 'MULTIAPPEND')
+
+    # Items of the FETCH responses
+    ITEM_RE = re.compile(r'(BODY(?:\.PEEK)?\[[^\]]*\]|[A-Z0-9.]+)', re.I)
+
+    def __init__(self, path):
+        """ @param path: the Maildir root, created when missing """
+        self.path = os.fsencode(os.path.abspath(path))
+        # Same folder layout as Dovecot, see ImapUtil.getServerType()
+        self.serverType = ('dovecot', 'Local Maildir ({})'.format(path))
+        self.folder = None
+        self.readonly = True
+        self.untagged = {}
+        MaildirFolder.create(self.path, False)
+
+    def unquote(self, name):
+        """ @return a folder name, as quoted by ImapUtil.quoteFolderName() """
+        if isinstance(name, str):
+            name = name.encode()
+        if name.startswith(b'"') and name.endswith(b'"'):
+            name = re.sub(rb'\\(.)', rb'\1', name[1:-1])
+        return name
+
+    def getFolderPath(self, name):
+        name = self.unquote(name)
+        if name.upper() == b'INBOX':
+            return self.path
+        if b'/' in name or name.startswith(b'.') or b'..' in name:
+            raise ValueError('Invalid Maildir folder name: {}'.format(name))
+        return os.path.join(self.path, b'.' + name)
+
+    def getFolder(self, name):
+        """ @return the loaded MaildirFolder, or None when it does not exist """
+        path = self.getFolderPath(name)
+        if not os.path.isdir(os.path.join(path, b'cur')):
+            return None
+        folder = MaildirFolder(path)
+        folder.load()
+        return folder
+
+    def quote(self, name):
+        return b'"' + name.replace(b'\\', b'\\\\').replace(b'"', b'\\"') + b'"'
+
+    def list(self, directory='""', pattern='*'):
+        names = [ b'INBOX' ] + sorted(n[1:] for n in os.listdir(self.path)
+                if n.startswith(b'.') and n not in (b'.', b'..') and os.path.isdir(os.path.join(self.path, n, b'cur')))
+        data = []
+        for name in names:
+            children = any(n.startswith(name + b'.') for n in names)
+            data.append(b'(\\%s) "." %s' % (b'HasChildren' if children else b'HasNoChildren', self.quote(name)))
+        return 'OK', data
+
+    def status(self, name):
+        """ @return dict of STATUS items, see ImapUtil.parseStatuses(), or None """
+        folder = self.getFolder(name)
+        if folder is None:
+            return None
+        return { b'MESSAGES': len(folder.messages), b'UIDNEXT': folder.uidnext, b'UIDVALIDITY': folder.uidvalidity }
+
+    def create(self, name):
+        MaildirFolder.create(self.getFolderPath(name))
+        return 'OK', [b'CREATE completed']
+
+    def select(self, name='INBOX', readonly=False):
+        self.folder = self.getFolder(name)
+        self.readonly = readonly
+        if self.folder is None:
+            return 'NO', [b'Mailbox does not exist']
+        self.untagged = {
+            'EXISTS': [ b'%d' % len(self.folder.messages) ],
+            'UIDVALIDITY': [ b'%d' % self.folder.uidvalidity ],
+            'UIDNEXT': [ b'%d' % self.folder.uidnext ],
+        }
+        return 'OK', self.untagged['EXISTS']
+
+    def response(self, code):
+        return code, self.untagged.pop(code.upper(), [None])
+
+    def uid(self, command, *args):
+        method = getattr(self, 'uid' + command.capitalize(), None)
+        if method is None:
+            return 'BAD', [b'Unsupported command: ' + command.encode()]
+        if self.folder is None:
+            return 'BAD', [b'No mailbox selected']
+        return method(*[ a.encode() if isinstance(a, str) else a for a in args ])
+
+    def getUids(self, seqset):
+        """ @return the sorted UIDs in a bytes uid-set, like 1:5,8 or 10:* """
+        uids = sorted(self.folder.messages)
+        last = uids[-1] if uids else 0
+        wanted = set()
+        for item in seqset.split(b','):
+            first, _, end = item.partition(b':')
+            first = last if first == b'*' else int(first)
+            end = first if not end else last if end == b'*' else int(end)
+            wanted.update(range(min(first, end), max(first, end) + 1))
+        return [ u for u in uids if u in wanted ]
+
+    def uidSearch(self, *criteria):
+        folder = self.folder
+        uids = sorted(folder.messages)
+        criteria = list(criteria)
+        while criteria:
+            key = criteria.pop(0).upper()
+            if key == b'ALL':
+                continue
+            if key == b'UID':
+                wanted = set(self.getUids(criteria.pop(0)))
+                uids = [ u for u in uids if u in wanted ]
+                continue
+            if key not in (b'SINCE', b'BEFORE', b'SENTSINCE', b'SENTBEFORE'):
+                return 'BAD', [b'Unsupported search key: ' + key]
+            date = datetime.datetime.strptime(criteria.pop(0).decode(), '%d-%b-%Y').date()
+            res = []
+            for u in uids:
+                if key.startswith(b'SENT'):
+                    d = email.utils.parsedate(email.message_from_bytes(folder.readHeader(u))['Date'] or '')
+                    d = datetime.date(*d[:3]) if d else None
+                else:
+                    d = folder.getDate(u)
+                if d is not None and (d >= date if key.endswith(b'SINCE') else d < date):
+                    res.append(u)
+            uids = res
+        return 'OK', [ b' '.join(b'%d' % u for u in uids) ]
+
+    def getSection(self, uid, section):
+        """ @return the content of a BODY[section] """
+        folder = self.folder
+        section = section.upper()
+        if not section:
+            return folder.read(uid)
+        header = folder.readHeader(uid)
+        if section == b'HEADER':
+            return header
+        m = re.match(rb'^HEADER\.FIELDS(\.NOT)? \((.*)\)$', section)
+        if not m:
+            raise ValueError('Unsupported section: {}'.format(section))
+        fields = set(m.group(2).split())
+        res = []
+        keep = False
+        for line in header.splitlines(True)[:-1]:
+            if line[:1] not in (b' ', b'\t'):
+                keep = (line.split(b':', 1)[0].strip().upper() in fields) != bool(m.group(1))
+            if keep:
+                res.append(line)
+        return b''.join(res) + b'\r\n'
+
+    def uidFetch(self, seqset, query, *modifiers):
+        """ @return fetched data in imaplib format, literals are (head, literal) tuples """
+        folder = self.folder
+        items = [ i.upper() for i in self.ITEM_RE.findall(query.decode()) ]
+        seqs = { u: i for i, u in enumerate(sorted(folder.messages), 1) }
+        data = []
+        for uid in self.getUids(seqset):
+            head = b'%d (UID %d' % (seqs[uid], uid)
+            for item in items:
+                if item == 'UID':
+                    continue
+                if item == 'RFC822.SIZE':
+                    head += b' RFC822.SIZE %d' % folder.messages[uid][1]
+                elif item == 'FLAGS':
+                    head += b' FLAGS (' + b' '.join(folder.getFlags(uid)) + b')'
+                elif item == 'INTERNALDATE':
+                    head += b' INTERNALDATE "' + folder.getInternalDate(uid) + b'"'
+                elif item == 'RFC822' or item.startswith('BODY'):
+                    name = 'RFC822' if item == 'RFC822' else item.replace('.PEEK', '')
+                    value = self.getSection(uid, item[item.index('[') + 1:-1].encode()) \
+                            if item != 'RFC822' else folder.read(uid)
+                    data.append((head + b' ' + name.encode() + b' {%d}' % len(value), value))
+                    head = b''
+                else:
+                    return 'BAD', [b'Unsupported fetch item: ' + item.encode()]
+            data.append(head + b')')
+        return 'OK', data or [None]
+
+    def uidStore(self, seqset, command, flags):
+        if self.readonly:
+            return 'NO', [b'Mailbox is read-only']
+        folder = self.folder
+        command = command.upper()
+        flags = flags.strip(b'()').split()
+        for uid in self.getUids(seqset):
+            old = folder.getFlags(uid)
+            if command.startswith(b'+'):
+                new = old + flags
+            elif command.startswith(b'-'):
+                new = [ f for f in old if f.upper() not in [ g.upper() for g in flags ] ]
+            else:
+                new = flags
+            folder.setFlags(uid, new)
+        return 'OK', [None]
+
+    def uidCopy(self, seqset, mailbox):
+        target = self.getFolder(mailbox)
+        if target is None:
+            return 'NO', [b'[TRYCREATE] Mailbox does not exist']
+        if target.path == self.folder.path:
+            target = self.folder
+        folder = self.folder
+        messages = []
+        for uid in self.getUids(seqset):
+            messages.append((folder.read(uid), None, b' '.join(folder.getFlags(uid)), folder.getInternalDate(uid)))
+        target.add(messages)
+        return 'OK', [b'COPY completed']
+
+    def fetchFile(self, uid, threshold):
+        """ @return tuple (file, size) or None, see ImapUtil.fetchToFile() """
+        uid = int(uid)
+        if self.folder is None or uid not in self.folder.messages:
+            return None
+        return self.folder.open(uid, threshold)
+
+    def appendFiles(self, mailbox, messages):
+        """ @return list of (UIDVALIDITY, UID) of the appended messages, see ImapUtil.appendFiles() """
+        folder = self.getFolder(mailbox)
+        if folder is None:
+            raise RuntimeError('Unvalid reply: NO [TRYCREATE] Mailbox does not exist')
+        if self.folder is not None and self.folder.path == folder.path:
+            folder = self.folder
+        return [ (folder.uidvalidity, uid) for uid in folder.add(messages) ]
+
+    def enable(self, capability):
+        return 'NO', [b'ENABLE not supported']
+
+    def shutdown(self):
+        self.folder = None
+
+    def logout(self):
+        self.shutdown()
+        return 'BYE', [b'Logging out']
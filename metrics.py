@@ -0,0 +1,357 @@
+#!/usr/bin/env python3
+# kate: space-indent on; tab-indent off;
+
+""" @package docstring
+Sync Metrics
+
+Timing and traffic instrumentation for imapcp: per-command latency histograms,
+bytes sent and received, per-folder throughput and a per-phase time breakdown.
+
+Connections are instrumented by wrapping their send(), read() and readline()
+methods, so every command is measured from the moment it is sent until its
+tagged completion is read, whether it was issued through imaplib or through
+the raw ImapUtil helpers, pipelined commands included.
+
+Traffic is counted uncompressed; for compressed connections, bytes on the wire
+are reported too, see DeflateStream.
+
+@author Gabriele Tozzi <gabriele@tozzi.eu>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import re
+import time
+import json
+import threading
+
+
+class Histogram:
+    """ A latency histogram, with fixed buckets """
+
+    # Upper bounds of the buckets, in seconds
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.BUCKETS) and value > self.BUCKETS[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """ @return the upper bound of the bucket holding the q quantile """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def toDict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+            'buckets': { str(b): c for b, c in zip(self.BUCKETS + ('+Inf', ), self.counts) },
+        }
+
+
+class Metrics:
+    """ Collects metrics for a whole run, thread safe """
+
+    # Prefix of Prometheus metric names
+    PREFIX = 'imapcp'
+
+    # Min number of seconds between two progress lines of the same folder
+    PROGRESS_INTERVAL = 10
+
+    COMMAND_RE = re.compile(rb'^(?P<tag>[A-Z]+\d+) (?P<name>(?:UID )?[A-Za-z]+)')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+        # (server, command) -> Histogram
+        self.commands = {}
+        # (server, direction) -> bytes
+        self.traffic = {}
+        # phase -> seconds
+        self.phases = {}
+        # list of per-folder results
+        self.folders = []
+        # list of (server, DeflateStream) of compressed connections
+        self.streams = []
+        self.messages = 0
+        self.bytes = 0
+
+    def instrument(self, conn, server):
+        """
+            Instruments an imaplib connection
+
+            @param server: label of the server, i.e. 'source'
+            @return the connection
+        """
+        if getattr(conn, 'deflate', None):
+            with self.lock:
+                self.streams.append((server, conn.deflate))
+        send, read, readline = conn.send, conn.read, conn.readline
+        # tag -> (command, start time)
+        pending = {}
+
+        def isend(data):
+            if data.startswith(conn.tagpre):
+                m = self.COMMAND_RE.match(data)
+                if m:
+                    pending[m.group('tag')] = (m.group('name').upper().decode(), time.monotonic())
+            self.count(server, 'out', len(data))
+            return send(data)
+
+        def iread(size):
+            data = read(size)
+            self.count(server, 'in', len(data))
+            return data
+
+        def ireadline():
+            line = readline()
+            self.count(server, 'in', len(line))
+            if pending and line[:1] != b'*':
+                tag = line.split(b' ', 1)[0]
+                if tag in pending:
+                    name, start = pending.pop(tag)
+                    self.observe(server, name, time.monotonic() - start)
+            return line
+
+        conn.send, conn.read, conn.readline = isend, iread, ireadline
+        return conn
+
+    def count(self, server, direction, size):
+        with self.lock:
+            key = (server, direction)
+            self.traffic[key] = self.traffic.get(key, 0) + size
+
+    def observe(self, server, command, seconds):
+        """ Records the latency of a command """
+        with self.lock:
+            key = (server, command)
+            if key not in self.commands:
+                self.commands[key] = Histogram()
+            self.commands[key].observe(seconds)
+
+    def getThroughput(self, server, rtt=0):
+        """
+            @param rtt: round-trip time, not counted as transfer time
+            @return bytes per second received from a server while commands
+                    were running, 0 when nothing has been measured
+        """
+        with self.lock:
+            busy = sum(max(0, h.sum - h.count * rtt) for (s, c), h in self.commands.items() if s == server)
+            size = self.traffic.get((server, 'in'), 0)
+        return size / busy if busy else 0
+
+    def timer(self):
+        """
+            Creates a phase timer, measuring the time spent in every phase of
+            the run. When folders are synced in parallel, every worker uses its
+            own timer and phase times are summed over all workers.
+
+            @return callable(name): ends the current phase and starts the
+                    given one, None just ends the current phase
+        """
+        current = [ None, time.monotonic() ]
+
+        def switch(name):
+            now = time.monotonic()
+            if current[0]:
+                with self.lock:
+                    self.phases[current[0]] = self.phases.get(current[0], 0) + now - current[1]
+            current[0] = name
+            current[1] = now
+
+        return switch
+
+    def addFolder(self, folder, messages, size, seconds):
+        """ Records the result of a folder sync """
+        with self.lock:
+            self.messages += messages
+            self.bytes += size
+            self.folders.append({
+                'folder': folder,
+                'messages': messages,
+                'bytes': size,
+                'seconds': seconds,
+                'messages_per_sec': messages / seconds if seconds else 0,
+            })
+
+    def progress(self, total):
+        """
+            Creates a progress tracker for copying messages
+
+            @param total: number of messages to copy
+            @return callable(count, size), returning a progress description
+                    every PROGRESS_INTERVAL seconds and None otherwise
+        """
+        start = time.monotonic()
+        state = { 'done': 0, 'bytes': 0, 'shown': start }
+
+        def update(count, size):
+            state['done'] += count
+            state['bytes'] += size
+            now = time.monotonic()
+            if now - state['shown'] < self.PROGRESS_INTERVAL or state['done'] >= total:
+                return None
+            state['shown'] = now
+            rate = state['done'] / (now - start)
+            eta = (total - state['done']) / rate if rate else 0
+            return '{}/{} messages, {:.1f} msg/s, {}/s, ETA {}'.format(state['done'], total, rate,
+                    self.formatBytes(state['bytes'] / (now - start)), self.formatTime(eta))
+
+        return update
+
+    @staticmethod
+    def formatBytes(size):
+        for unit in ('B', 'KiB', 'MiB', 'GiB'):
+            if size < 1024 or unit == 'GiB':
+                return '{:.1f}{}'.format(size, unit)
+            size /= 1024
+
+    @staticmethod
+    def formatTime(seconds):
+        seconds = int(seconds)
+        return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+    def getCompression(self):
+        """ @return list of per-connection compression stats """
+        res = []
+        for idx, (server, stream) in enumerate(self.streams):
+            c = { 'server': server, 'connection': idx }
+            for d in ('in', 'out'):
+                c[d + '_wire_bytes'] = stream.wire[d]
+                c[d + '_bytes'] = stream.plain[d]
+                c[d + '_ratio'] = stream.plain[d] / stream.wire[d] if stream.wire[d] else 0
+            res.append(c)
+        return res
+
+    def toDict(self):
+        """ @return all metrics, as a JSON serializable dict """
+        with self.lock:
+            elapsed = time.monotonic() - self.start
+            return {
+                'seconds': elapsed,
+                'messages': self.messages,
+                'bytes': self.bytes,
+                'messages_per_sec': self.messages / elapsed if elapsed else 0,
+                'traffic': [ { 'server': s, 'direction': d, 'bytes': b }
+                        for (s, d), b in sorted(self.traffic.items()) ],
+                'commands': [ dict(server=s, command=c, **h.toDict())
+                        for (s, c), h in sorted(self.commands.items()) ],
+                'phases': dict(self.phases),
+                'folders': list(self.folders),
+                'compression': self.getCompression(),
+            }
+
+    def writeJson(self, path):
+        """ Writes all metrics to a JSON file """
+        self.writeFile(path, json.dumps(self.toDict(), indent=2))
+
+    def writePrometheus(self, path):
+        """ Writes all metrics to a file in Prometheus text format """
+        p = self.PREFIX
+        data = self.toDict()
+        lines = [
+            '# HELP {}_run_seconds Duration of the run'.format(p),
+            '# TYPE {}_run_seconds gauge'.format(p),
+            '{}_run_seconds {}'.format(p, data['seconds']),
+            '# HELP {}_messages_copied Number of messages copied'.format(p),
+            '# TYPE {}_messages_copied gauge'.format(p),
+            '{}_messages_copied {}'.format(p, data['messages']),
+            '# HELP {}_traffic_bytes Bytes exchanged with IMAP servers'.format(p),
+            '# TYPE {}_traffic_bytes gauge'.format(p),
+        ]
+        for t in data['traffic']:
+            lines.append('{}_traffic_bytes{{server="{}",direction="{}"}} {}'.format(p,
+                    t['server'], t['direction'], t['bytes']))
+        lines += [
+            '# HELP {}_wire_bytes Bytes exchanged with IMAP servers over compressed connections, '
+                    'as sent on the wire'.format(p),
+            '# TYPE {}_wire_bytes gauge'.format(p),
+        ]
+        wire = {}
+        for c in data['compression']:
+            for d in ('in', 'out'):
+                key = (c['server'], d)
+                wire[key] = wire.get(key, 0) + c[d + '_wire_bytes']
+        for (server, direction), size in sorted(wire.items()):
+            lines.append('{}_wire_bytes{{server="{}",direction="{}"}} {}'.format(p, server, direction, size))
+        lines += [
+            '# HELP {}_phase_seconds Time spent in every phase of the run'.format(p),
+            '# TYPE {}_phase_seconds gauge'.format(p),
+        ]
+        for name, seconds in sorted(data['phases'].items()):
+            lines.append('{}_phase_seconds{{phase="{}"}} {}'.format(p, name, seconds))
+        lines += [
+            '# HELP {}_command_seconds IMAP command latency'.format(p),
+            '# TYPE {}_command_seconds histogram'.format(p),
+        ]
+        for c in data['commands']:
+            labels = 'server="{}",command="{}"'.format(c['server'], c['command'])
+            seen = 0
+            for bound, count in c['buckets'].items():
+                seen += count
+                lines.append('{}_command_seconds_bucket{{{},le="{}"}} {}'.format(p, labels, bound, seen))
+            lines.append('{}_command_seconds_sum{{{}}} {}'.format(p, labels, c['sum']))
+            lines.append('{}_command_seconds_count{{{}}} {}'.format(p, labels, c['count']))
+        self.writeFile(path, '\n'.join(lines) + '\n')
+
+    def writeFile(self, path, text):
+        """ Atomically replaces a file, so collectors never read partial data """
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, path)
+
+    def printProfile(self):
+        """ Prints the per-phase time breakdown and the slowest commands """
+        data = self.toDict()
+        print()
+        print("Time breakdown ({:.2f}s total):".format(data['seconds']))
+        for name, seconds in sorted(data['phases'].items(), key=lambda i: -i[1]):
+            print('  {:<12} {:>9.2f}s {:>6.1f}%'.format(name, seconds,
+                    100 * seconds / data['seconds'] if data['seconds'] else 0))
+        print("Commands:")
+        print('  {:<12} {:<20} {:>7} {:>9} {:>8} {:>8} {:>8}'.format('server', 'command',
+                'count', 'total', 'p50', 'p99', 'max'))
+        for c in sorted(data['commands'], key=lambda c: -c['sum']):
+            print('  {:<12} {:<20} {:>7} {:>8.2f}s {:>7.3f}s {:>7.3f}s {:>7.3f}s'.format(c['server'],
+                    c['command'], c['count'], c['sum'], c['p50'], c['p99'], c['max']))
+        for t in data['traffic']:
+            print('  {} {}: {}'.format(t['server'], t['direction'], self.formatBytes(t['bytes'])))
+        for c in data['compression']:
+            print('  {} connection {} compressed: in {} ({:.1f}x), out {} ({:.1f}x)'.format(c['server'],
+                    c['connection'], self.formatBytes(c['in_wire_bytes']), c['in_ratio'],
+                    self.formatBytes(c['out_wire_bytes']), c['out_ratio']))
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+# kate: space-indent on; tab-indent off;
+
+""" @package docstring
+Sync State
+
+Persistent, SQLite based, sync state for imapcp: remembers which messages have
+already been seen in every mailbox, so later runs only need to look at UIDs
+above the stored high-water mark.
+
+Messages are also journaled as soon as they are copied, so a run killed in the
+middle of a folder resumes from the last copied message.
+
+@author Gabriele Tozzi <gabriele@tozzi.eu>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import sqlite3
+import threading
+
+
+class SyncState:
+    """ The state store
+
+        Every mailbox is identified by (host, port, user, folder, UIDVALIDITY): when
+        the server changes the UIDVALIDITY, the stored state is discarded and
+        the mailbox gets scanned again from scratch.
+    """
+
+    SCHEMA = (
+        '''CREATE TABLE IF NOT EXISTS mailboxes (
+            id INTEGER PRIMARY KEY,
+            host TEXT NOT NULL,
+            port INTEGER,
+            user TEXT NOT NULL,
+            folder BLOB NOT NULL,
+            uidvalidity INTEGER NOT NULL,
+            uidnext INTEGER,
+            modseq INTEGER,
+            UNIQUE (host, port, user, folder)
+        )''',
+        '''CREATE TABLE IF NOT EXISTS messages (
+            mailbox INTEGER NOT NULL REFERENCES mailboxes(id) ON DELETE CASCADE,
+            uid INTEGER NOT NULL,
+            mid TEXT,
+            PRIMARY KEY (mailbox, uid)
+        )''',
+    )
+
+    def __init__(self, path):
+        """
+            @param path: the SQLite database file, created when missing
+        """
+        self.path = path
+        self.lock = threading.RLock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('PRAGMA foreign_keys = ON')
+        self.db.execute('PRAGMA journal_mode = WAL')
+        for sql in self.SCHEMA:
+            self.db.execute(sql)
+        # Upgrade state files written by older versions
+        columns = [ row[1] for row in self.db.execute('PRAGMA table_info(mailboxes)') ]
+        if 'modseq' not in columns:
+            self.db.execute('ALTER TABLE mailboxes ADD COLUMN modseq INTEGER')
+        if 'port' not in columns:
+            self.addPort()
+        self.db.commit()
+
+    def addPort(self):
+        """
+            Adds the port to the mailbox key, rebuilding the table since
+            SQLite can't change constraints. Mailboxes of older versions get
+            a NULL port, see getMailbox()
+        """
+        self.db.commit()
+        self.db.execute('PRAGMA foreign_keys = OFF')
+        self.db.execute('ALTER TABLE mailboxes RENAME TO old_mailboxes')
+        self.db.execute(self.SCHEMA[0])
+        self.db.execute('INSERT INTO mailboxes (id, host, user, folder, uidvalidity, uidnext, modseq) '
+                'SELECT id, host, user, folder, uidvalidity, uidnext, modseq FROM old_mailboxes')
+        self.db.execute('DROP TABLE old_mailboxes')
+        self.db.commit()
+        self.db.execute('PRAGMA foreign_keys = ON')
+
+    def getMailbox(self, host, port, user, folder, uidvalidity):
+        """
+            Looks up a mailbox, creating it when missing or when its
+            UIDVALIDITY changed. Mailboxes stored by older versions, without
+            a port, are taken over when their UIDVALIDITY matches, since
+            they may belong to another server on the same host.
+
+            @param port: the server port, None for local Maildirs
+            @return tuple (mailbox id, stored UIDNEXT or None)
+        """
+        port = port or 0
+        with self.lock:
+            row = self.db.execute('SELECT id, uidvalidity, uidnext FROM mailboxes '
+                    'WHERE host = ? AND port = ? AND user = ? AND folder = ?', (host, port, user, folder)).fetchone()
+            if row and row[1] == uidvalidity:
+                return row[0], row[2]
+            if row:
+                self.db.execute('DELETE FROM mailboxes WHERE id = ?', (row[0], ))
+            old = self.db.execute('SELECT id, uidnext FROM mailboxes WHERE host = ? AND port IS NULL '
+                    'AND user = ? AND folder = ? AND uidvalidity = ?', (host, user, folder, uidvalidity)).fetchone()
+            if old:
+                self.db.execute('UPDATE mailboxes SET port = ? WHERE id = ?', (port, old[0]))
+                self.db.commit()
+                return old
+            cur = self.db.execute('INSERT INTO mailboxes (host, port, user, folder, uidvalidity) '
+                    'VALUES (?, ?, ?, ?, ?)', (host, port, user, folder, uidvalidity))
+            self.db.commit()
+            return cur.lastrowid, None
+
+    def resetMailbox(self, mailbox):
+        """ Forgets everything known about a mailbox """
+        with self.lock:
+            self.db.execute('DELETE FROM messages WHERE mailbox = ?', (mailbox, ))
+            self.db.execute('UPDATE mailboxes SET uidnext = NULL, modseq = NULL WHERE id = ?', (mailbox, ))
+            self.db.commit()
+
+    def setUidNext(self, mailbox, uidnext):
+        """ Stores the high-water mark for a mailbox """
+        with self.lock:
+            self.db.execute('UPDATE mailboxes SET uidnext = ? WHERE id = ?', (uidnext, mailbox))
+
+    def getModSeq(self, mailbox):
+        """ @return the HIGHESTMODSEQ stored by the last flag sync, or None """
+        with self.lock:
+            return self.db.execute('SELECT modseq FROM mailboxes WHERE id = ?', (mailbox, )).fetchone()[0]
+
+    def setModSeq(self, mailbox, modseq):
+        """ Stores the HIGHESTMODSEQ up to which flags have been synced """
+        with self.lock:
+            self.db.execute('UPDATE mailboxes SET modseq = ? WHERE id = ?', (modseq, mailbox))
+
+    def getMessages(self, mailbox, minuid=None):
+        """
+            @param minuid: only return messages with an UID greater or equal than this
+            @return dict UID -> message key of all known messages in a mailbox
+        """
+        with self.lock:
+            return { uid: mid for uid, mid in self.db.execute(
+                    'SELECT uid, mid FROM messages WHERE mailbox = ? AND uid >= ?', (mailbox, minuid or 0)) }
+
+    def getAccountKeys(self, host, port, user):
+        """
+            @return list of message keys of all known messages in all mailboxes
+                    of an account, including mailboxes stored without a port
+        """
+        with self.lock:
+            return [ mid for mid, in self.db.execute('SELECT mid FROM messages JOIN mailboxes '
+                    'ON mailboxes.id = messages.mailbox WHERE host = ? AND (port = ? OR port IS NULL) '
+                    'AND user = ?', (host, port or 0, user)) ]
+
+    def countMessages(self, mailbox):
+        """ @return the number of known messages in a mailbox """
+        with self.lock:
+            return self.db.execute('SELECT COUNT(*) FROM messages WHERE mailbox = ?', (mailbox, )).fetchone()[0]
+
+    def addMessages(self, mailbox, messages):
+        """
+            Records messages as known
+            @param messages: dict UID -> message key
+        """
+        with self.lock:
+            self.db.executemany('INSERT OR REPLACE INTO messages (mailbox, uid, mid) VALUES (?, ?, ?)',
+                    [ (mailbox, int(uid), mid) for uid, mid in messages.items() ])
+
+    def commit(self):
+        with self.lock:
+            self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
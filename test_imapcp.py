@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# kate: space-indent on; tab-indent off;
+
+""" @package docstring
+imapcp end-to-end tests against fakeimap
+
+Run with: python3 -m unittest test_imapcp
+
+@author Gabriele Tozzi <gabriele@tozzi.eu>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import unittest
+
+import imapcp
+from fakeimap import FakeImapServer
+
+
+class TestImapCp(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.state = os.path.join(self.dir.name, 'state.db')
+        self.src = FakeImapServer('dovecot').start()
+        self.dst = FakeImapServer('dovecot').start()
+
+    def tearDown(self):
+        self.src.stop()
+        self.dst.stop()
+        self.dir.cleanup()
+
+    def copy(self, src, dst, *args):
+        """ Runs imapcp, returns its output """
+        argv = sys.argv
+        sys.argv = [ 'imapcp', src, dst ] + list(args)
+        out = io.StringIO()
+        try:
+            with contextlib.redirect_stdout(out):
+                imapcp.main().run()
+        finally:
+            sys.argv = argv
+        return out.getvalue()
+
+    def messages(self, server, user):
+        return collections.Counter(m.data for mb in server.account(user).mailboxes.values() for m in mb.messages)
+
+    def testShardedRerunSameUser(self):
+        # Same user on the same host: the servers differ by port only
+        self.src.addAccount('alice', 'p')
+        self.dst.addAccount('alice', 'p')
+        self.src.populate('alice', b'INBOX', 100, size=512, seed=1)
+        self.src.populate('alice', b'INBOX.Sent', 30, size=512, seed=2)
+        src = 'alice:p:127.0.0.1:{}'.format(self.src.port)
+        dst = 'alice:p:127.0.0.1:{}'.format(self.dst.port)
+
+        for run in range(2):
+            self.copy(src, dst, '-j', '3', '--shard', '20', '--state', self.state)
+            copied = self.messages(self.dst, 'alice')
+            self.assertEqual(copied, self.messages(self.src, 'alice'))
+        self.assertEqual(self.dst.stats.get('appended'), 130)
+
+    def testShardedRerunAfterFailure(self):
+        self.src.addAccount('alice', 'p')
+        self.dst.addAccount('bob', 'q')
+        self.src.populate('alice', b'INBOX', 200, size=512, seed=1)
+        src = 'alice:p:127.0.0.1:{}'.format(self.src.port)
+        dst = 'bob:q:127.0.0.1:{}'.format(self.dst.port)
+
+        # A range fails halfway, the others are journaled in the state
+        self.dst.dropAt('APPEND', 5)
+        with self.assertRaises(RuntimeError):
+            self.copy(src, dst, '-j', '4', '--shard', '30', '--retries', '0', '--state', self.state)
+        self.src.populate('alice', b'INBOX', 40, size=512, seed=2)
+        self.copy(src, dst, '-j', '4', '--shard', '30', '--state', self.state)
+        self.assertEqual(self.messages(self.dst, 'bob'), self.messages(self.src, 'alice'))
+        self.assertEqual(self.dst.stats.get('appended'), 240)
+
+
+if __name__ == '__main__':
+    unittest.main()
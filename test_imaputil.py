@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+# kate: space-indent on; tab-indent off;
+
+""" @package docstring
+ImapUtil tests
+
+Run with: python3 -m unittest test_imaputil
+
+@author Gabriele Tozzi <gabriele@tozzi.eu>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import email
+import unittest
+
+from imaputil import ImapUtil, HeaderFields, MessageIndex
+
+
+class FakeConnection:
+    """ Just what parseMailboxes() needs of an imaplib connection """
+
+    def __init__(self, welcome):
+        self.welcome = welcome
+
+
+class TestParseMailboxes(unittest.TestCase):
+
+    def setUp(self):
+        self.util = ImapUtil()
+
+    def parse(self, data, welcome=b'* OK Dovecot ready.'):
+        return self.util.parseMailboxes(FakeConnection(welcome), data)
+
+    def testNilDelimiter(self):
+        folders = self.parse([ b'(\\HasNoChildren) NIL "My Folder"', b'(\\HasNoChildren) NIL My/Folder' ])
+        self.assertEqual([ f.delimiter for f in folders ], [ None, None ])
+        self.assertEqual([ f.getPath() for f in folders ], [ (b'My Folder', ), (b'My/Folder', ) ])
+        self.assertEqual(folders[0].getPathBytes(ImapUtil.TYPE_EXCHANGE), b'My Folder')
+        self.assertEqual(folders[1].getPathBytes(ImapUtil.TYPE_DOVECOT), b'My-Folder')
+
+    def testDelimiter(self):
+        folders = self.parse([ b'(\\HasChildren) "." INBOX', b'(\\HasNoChildren) "." "INBOX.My Folder"' ])
+        self.assertEqual([ f.getPath() for f in folders ], [ (b'INBOX', ), (b'INBOX', b'My Folder') ])
+        self.assertEqual(folders[1].getPathBytes(ImapUtil.TYPE_EXCHANGE), b'INBOX/My Folder')
+
+
+class TestHeaderFields(unittest.TestCase):
+
+    HEADER = (b'Message-ID:\r\n <a.b@example.com>\r\n'
+            b'Subject: =?utf-8?q?Caff=C3=A8?=\r\n\tlatte\r\n'
+            b'From: J\xc3\xb6rg <j@example.com>\r\n'
+            b'message-id: <second@example.com>\r\n'
+            b'X-Other: x\r\n'
+            b'\r\n'
+            b'Message-ID: <body@example.com>\r\n')
+
+    def testFolded(self):
+        h = HeaderFields(self.HEADER)
+        self.assertEqual(h.get('Message-ID'), '<a.b@example.com>')
+        self.assertEqual(h['subject'], '=?utf-8?q?Caff=C3=A8?=\tlatte')
+
+    def testEncoded(self):
+        # Like email.message.Message: encoded words are kept, 8-bit characters replaced
+        h = HeaderFields(self.HEADER)
+        self.assertEqual(h['Subject'], email.message_from_bytes(self.HEADER)['Subject'].replace('\r\n', ''))
+        self.assertEqual(h['From'], 'J\ufffd\ufffdrg <j@example.com>')
+
+    def testDuplicate(self):
+        h = HeaderFields(self.HEADER)
+        self.assertEqual(h['Message-ID'], '<a.b@example.com>')
+        self.assertEqual(h.getAll('MESSAGE-ID'), [ b'<a.b@example.com>', b'<second@example.com>' ])
+
+    def testRequestedFields(self):
+        h = HeaderFields(self.HEADER, MessageIndex.KEY_FIELDS)
+        self.assertIn('message-id', h)
+        self.assertNotIn('X-Other', h)
+        self.assertIsNone(h['X-Other'])
+        self.assertEqual(h.get('Date', ''), '')
+
+    def testKey(self):
+        self.assertEqual(MessageIndex.getKey(HeaderFields(self.HEADER)), '<a.b@example.com>')
+        self.assertEqual(MessageIndex.normalizeId(' a.b@example.com '), '<a.b@example.com>')
+        self.assertIsNone(MessageIndex.normalizeId('<>'))
+        # Fallback keys must match the ones of messages parsed by email
+        data = b'Date: Mon, 1 Jan 2024 10:00:00 +0000\r\nFrom: a@example.com\r\nSubject: Hi\r\n\r\nbody'
+        key = MessageIndex.getKey(HeaderFields(data), 100)
+        self.assertTrue(key.startswith('hash:'))
+        self.assertEqual(key, MessageIndex.getKey(email.message_from_bytes(data), 100))
+
+
+if __name__ == '__main__':
+    unittest.main()
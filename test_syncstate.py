@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# kate: space-indent on; tab-indent off;
+
+""" @package docstring
+SyncState tests
+
+Run with: python3 -m unittest test_syncstate
+
+@author Gabriele Tozzi <gabriele@tozzi.eu>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from syncstate import SyncState
+
+
+class TestSyncState(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'state.db')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def testRoundTrip(self):
+        state = SyncState(self.path)
+        mb, uidnext = state.getMailbox('imap.example.com', 993, 'alice', b'INBOX', 100)
+        self.assertIsNone(uidnext)
+        state.addMessages(mb, { b'1': '<a@x>', b'2': '<b@x>' })
+        state.setUidNext(mb, 3)
+        state.setModSeq(mb, 42)
+        state.close()
+
+        state = SyncState(self.path)
+        self.assertEqual(state.getMailbox('imap.example.com', 993, 'alice', b'INBOX', 100), (mb, 3))
+        self.assertEqual(state.getMessages(mb), { 1: '<a@x>', 2: '<b@x>' })
+        self.assertEqual(state.getMessages(mb, 2), { 2: '<b@x>' })
+        self.assertEqual(state.countMessages(mb), 2)
+        self.assertEqual(state.getModSeq(mb), 42)
+        self.assertEqual(state.getAccountKeys('imap.example.com', 993, 'alice'), [ '<a@x>', '<b@x>' ])
+        state.close()
+
+    def testUidValidityChange(self):
+        state = SyncState(self.path)
+        mb, uidnext = state.getMailbox('imap.example.com', 993, 'alice', b'INBOX', 100)
+        state.addMessages(mb, { 1: '<a@x>' })
+        state.setUidNext(mb, 2)
+        state.commit()
+        newmb, uidnext = state.getMailbox('imap.example.com', 993, 'alice', b'INBOX', 200)
+        self.assertIsNone(uidnext)
+        self.assertEqual(state.getMessages(newmb), {})
+        self.assertEqual(state.getMessages(mb), {})
+        state.close()
+
+    def testSameUserOnOtherPort(self):
+        # i.e. two servers reached through SSH tunnels on localhost
+        state = SyncState(self.path)
+        src, uidnext = state.getMailbox('localhost', 1143, 'alice', b'INBOX', 100)
+        state.addMessages(src, { 1: '<a@x>' })
+        state.setUidNext(src, 2)
+        dst, uidnext = state.getMailbox('localhost', 2143, 'alice', b'INBOX', 200)
+        self.assertNotEqual(src, dst)
+        self.assertEqual(state.getMailbox('localhost', 1143, 'alice', b'INBOX', 100), (src, 2))
+        self.assertEqual(state.getMessages(src), { 1: '<a@x>' })
+        self.assertEqual(state.getAccountKeys('localhost', 2143, 'alice'), [])
+        state.close()
+
+    def testUpgradeWithoutPort(self):
+        db = sqlite3.connect(self.path)
+        db.execute('''CREATE TABLE mailboxes (id INTEGER PRIMARY KEY, host TEXT NOT NULL, user TEXT NOT NULL,
+                folder BLOB NOT NULL, uidvalidity INTEGER NOT NULL, uidnext INTEGER, UNIQUE (host, user, folder))''')
+        db.execute('''CREATE TABLE messages (mailbox INTEGER NOT NULL REFERENCES mailboxes(id) ON DELETE CASCADE,
+                uid INTEGER NOT NULL, mid TEXT, PRIMARY KEY (mailbox, uid))''')
+        db.execute("INSERT INTO mailboxes VALUES (7, 'localhost', 'alice', X'494E424F58', 100, 3)")
+        db.execute("INSERT INTO messages VALUES (7, 1, '<a@x>'), (7, 2, '<b@x>')")
+        db.commit()
+        db.close()
+
+        state = SyncState(self.path)
+        # Taken over by the server with the same UIDVALIDITY only
+        mb, uidnext = state.getMailbox('localhost', 2143, 'alice', b'INBOX', 200)
+        self.assertIsNone(uidnext)
+        self.assertEqual(state.getMailbox('localhost', 1143, 'alice', b'INBOX', 100), (7, 3))
+        self.assertEqual(state.getMessages(7), { 1: '<a@x>', 2: '<b@x>' })
+        state.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# kate: space-indent on; tab-indent off;
+
+""" @package docstring
+Throttle
+
+Per-server rate limits for imapcp: caps on bytes per second, commands per
+second and concurrent connections, shared by all connections to a server.
+
+Rates are enforced with token buckets, by wrapping the send(), read() and
+readline() methods of connections, like Metrics does. When the server answers
+with a throttling response, the rates are halved and all connections pause for
+a while, then rates are slowly raised again while the server stays quiet
+(additive increase, multiplicative decrease), so the copy settles just below
+the limit enforced by the server instead of alternating bursts and failures.
+
+@author Gabriele Tozzi <gabriele@tozzi.eu>
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program. If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import re
+import time
+import threading
+
+
+class ThrottledError(RuntimeError):
+    """ The server refused a command because of its rate limits
+
+        Not an imaplib error, that imaplib would replace with a plain one
+        when raised while reading a response. The connection is left in an
+        unknown state and must be reopened.
+    """
+
+    def __init__(self, message, slowed):
+        """
+            @param slowed: True when rates have been lowered, False when
+                   they already were at their minimum
+        """
+        super().__init__(message)
+        self.slowed = slowed
+
+
+class TokenBucket:
+    """ A token bucket, holding up to one second of tokens; not thread safe """
+
+    def __init__(self, rate):
+        """ @param rate: tokens per second """
+        self.rate = rate
+        self.tokens = rate
+        self.stamp = time.monotonic()
+
+    def take(self, count, factor=1.0):
+        """
+            Takes tokens, going in debt when there are not enough
+
+            @param factor: fraction of the rate currently allowed
+            @return seconds to wait before the debt is paid back
+        """
+        now = time.monotonic()
+        rate = self.rate * factor
+        self.tokens = min(rate, self.tokens + (now - self.stamp) * rate)
+        self.stamp = now
+        self.tokens -= count
+        return -self.tokens / rate if self.tokens < 0 else 0
+
+
+class Throttle:
+    """ Rate limits for all connections to a server, thread safe """
+
+    # Throttling responses: temporary RFC 5530 response codes and explicit
+    # rate texts. [LIMIT] and texts like "too many" or "limit exceeded" are
+    # left out, servers also use them for permanent failures, i.e. message
+    # too large, too many recipients or quota exceeded
+    THROTTLED_RE = re.compile(rb'\[(UNAVAILABLE|INUSE|THROTTLED)\]|throttl|try again later', re.I)
+
+    # Rates are never lowered below this fraction of the configured ones
+    MIN_FACTOR = 1 / 16
+
+    # Throttling responses within this many seconds are a single event
+    HOLDOFF = 1
+
+    # Rates are raised by MIN_FACTOR after this many seconds without throttling
+    RECOVERY = 10
+
+    # Max seconds of pause after a throttling response
+    MAX_PAUSE = 60
+
+    # Units accepted in limits, see parseLimits()
+    UNITS = { '': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3 }
+
+    def __init__(self, bytes=None, commands=None, connections=None):
+        """
+            @param bytes: max bytes per second, sent and received
+            @param commands: max commands per second
+            @param connections: max concurrent connections, enforced by the
+                   caller
+        """
+        self.lock = threading.Lock()
+        self.bytes = TokenBucket(bytes) if bytes else None
+        self.commands = TokenBucket(commands) if commands else None
+        self.connections = connections
+        # Fraction of the configured rates currently allowed
+        self.factor = 1.0
+        # Consecutive throttling events, time of the last one and of the
+        # last rate increase
+        self.penalties = 0
+        self.penalized = 0
+        self.recovered = 0
+        # All connections wait until this time
+        self.resume = 0
+        # Commands sent, to guess a rate when none is configured
+        self.sent = 0
+        self.start = time.monotonic()
+
+    @classmethod
+    def parseLimits(cls, spec):
+        """
+            Parses a limits specification
+
+            @param spec: comma separated list of name=value, names being
+                   bytes, commands and connections; values may end with a
+                   k, M or G unit, i.e. 'bytes=2M,commands=20'
+            @return dict of keyword arguments for the constructor
+        """
+        limits = {}
+        for item in spec.split(','):
+            name, sep, value = item.strip().partition('=')
+            if not sep or name not in ('bytes', 'commands', 'connections'):
+                raise ValueError('Invalid limit "{}": expected bytes, commands or connections=<value>'.format(item))
+            m = re.match(r'^(\d+(?:\.\d+)?)([kmg]?)$', value.strip(), re.I)
+            if not m:
+                raise ValueError('Invalid limit value "{}"'.format(value))
+            limits[name] = float(m.group(1)) * cls.UNITS[m.group(2).lower()]
+        if 'connections' in limits:
+            limits['connections'] = max(1, int(limits['connections']))
+        return limits
+
+    def instrument(self, conn):
+        """
+            Makes a connection obey the limits, raising ThrottledError on
+            throttling responses
+
+            @return the connection
+        """
+        send, read, readline = conn.send, conn.read, conn.readline
+
+        def tsend(data):
+            if data.startswith(conn.tagpre):
+                self.take('commands', 1)
+            self.take('bytes', len(data))
+            return send(data)
+
+        def tread(size):
+            data = read(size)
+            self.take('bytes', len(data))
+            return data
+
+        def treadline():
+            line = readline()
+            self.take('bytes', len(line))
+            if self.isThrottled(conn, line):
+                raise ThrottledError(line.decode(errors='replace').strip(), self.penalize())
+            return line
+
+        conn.send, conn.read, conn.readline = tsend, tread, treadline
+        return conn
+
+    def isThrottled(self, conn, line):
+        """ @return True when line is a BYE or a tagged failure because of rate limits """
+        words = line.split(b' ', 2)
+        if len(words) < 3:
+            return False
+        if words[0] == b'*':
+            failed = words[1].upper() == b'BYE'
+        else:
+            failed = words[0].startswith(conn.tagpre) and words[1].upper() in (b'NO', b'BAD')
+        return failed and bool(self.THROTTLED_RE.search(words[2]))
+
+    def take(self, name, count):
+        """ Takes tokens from a bucket, waiting when over the limit """
+        with self.lock:
+            now = time.monotonic()
+            if name == 'commands':
+                self.sent += count
+            if self.factor < 1 and now - max(self.penalized, self.recovered) > self.RECOVERY:
+                self.factor = min(1.0, self.factor + self.MIN_FACTOR)
+                self.penalties = 0
+                self.recovered = now
+            bucket = getattr(self, name)
+            delay = max(0, self.resume - now)
+            if bucket:
+                delay += bucket.take(count, self.factor)
+        if delay:
+            time.sleep(delay)
+
+    def penalize(self):
+        """
+            Records a throttling response: pauses all connections and halves
+            the rates. When no command rate is configured, half of the rate
+            seen so far is enforced.
+
+            @return True when rates have been lowered
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now - self.penalized < self.HOLDOFF:
+                return True
+            self.penalties += 1
+            self.penalized = now
+            self.resume = max(self.resume, now + min(2 ** (self.penalties - 1), self.MAX_PAUSE))
+            if self.commands is None:
+                self.commands = TokenBucket(max(1.0, self.sent / max(now - self.start, 1)))
+            if self.factor <= self.MIN_FACTOR:
+                return False
+            self.factor = max(self.MIN_FACTOR, self.factor / 2)
+            return True